@@ -0,0 +1,217 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+import dotenv
+
+from compaction import compact, list_checkpoints
+from importer import FORMATS, IMPORT_AUTHOR, export_tree, import_tree
+from merkle import compute_hashes
+from schema import has_search_index, node_edges, tree_version
+from snapshot import SNAPSHOT_MAGIC, export_snapshot, import_snapshot
+
+# A tree is imported into a new database file next to its path, numbered after the last one (tree.db.1, tree.db.2,
+# ...), while the server carries on serving the old file. The path is then made a symbolic link to the new file, in
+# one atomic rename: each server process notices at its next request and switches to the new file, closing its
+# connections to the old one once the requests using them are done (see Tree.check_file in server.py). The change
+# numbering of the new file carries on from the old one, whose cursors expire like those into a compacted history,
+# and the files from before the old one are removed. Changes made to the old file while the import runs are lost.
+
+# Define a function to get the numbered database files of a tree, as (number, path) pairs from oldest to newest
+def generations(tree_file):
+    directory, name = os.path.split(os.path.abspath(tree_file))
+    found = []
+    for entry in os.listdir(directory):
+        number = entry[len(name) + 1:]
+        if entry.startswith(name + '.') and number.isdigit():
+            found.append((int(number), os.path.join(directory, entry)))
+    return sorted(found)
+
+# Define a function to delete a database file along with the files SQLite and the server keep next to it (or only
+# those, with keep_file set)
+def remove_database(path, keep_file=False):
+    for suffix in ('-wal', '-shm', '-journal', '-writelock') if keep_file else ('', '-wal', '-shm', '-journal', '-writelock'):
+        if os.path.lexists(path + suffix):
+            os.remove(path + suffix)
+
+# Define a function to check whether a file is a snapshot (see snapshot.py) rather than a tree file
+def is_snapshot(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+# Define a function to point the path of a tree at a new database file, returning the sequence number that the new
+# file's changes carry on from
+def replace_database(tree_file, new_file):
+    old_file = os.path.realpath(tree_file) if os.path.exists(tree_file) else None
+    conn = sqlite3.connect(new_file)
+    c = conn.cursor()
+    # the import ran without syncing, so commit with a full sync (outside of WAL mode this syncs the whole file)
+    # before the file goes live
+    c.execute("PRAGMA synchronous = FULL")
+    seq = tree_version(c)
+    if old_file is not None:
+        old_conn = sqlite3.connect(old_file)
+        seq = max(seq, tree_version(old_conn.cursor()) + 1)
+        old_conn.close()
+        # the cursors into the old file have missed the import, so its whole history counts as compacted
+        c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('history_horizon', ?)", (str(seq + 1),))
+    c.execute("DELETE FROM sqlite_sequence WHERE name = 'history'")
+    c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('history', ?)", (seq,))
+    conn.commit()
+    c.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+
+    link = '%s.%d.link' % (tree_file, os.getpid())
+    os.symlink(os.path.basename(new_file), link)
+    os.replace(link, tree_file)
+
+    for checkpoint_seq, path in list_checkpoints(tree_file + '-checkpoints'):
+        if checkpoint_seq < seq:
+            os.remove(path)
+    # the old file is kept until the next import, so that the servers have time to finish with it (including the
+    # tree's original file, which the link replaced, and of which only the files next to it are left by then)
+    for number, path in generations(tree_file):
+        if os.path.realpath(path) not in (old_file, os.path.realpath(new_file)):
+            remove_database(path)
+    original_file = os.path.join(os.path.realpath(os.path.dirname(os.path.abspath(tree_file))), os.path.basename(tree_file))
+    if old_file != original_file:
+        remove_database(original_file, keep_file=True)
+    return seq
+
+# Define a function to import a tree file or a snapshot into a new database file for a tree, then switch the tree
+# over to it. Returns the import statistics.
+def import_database(tree_file, source, fmt=None, author=IMPORT_AUTHOR):
+    numbers = generations(tree_file)
+    new_file = '%s.%d' % (tree_file, numbers[-1][0] + 1 if numbers else 1)
+    try:
+        if is_snapshot(source):
+            stats = import_snapshot(new_file, source, replace=True)
+        else:
+            stats = import_tree(new_file, source, fmt, author, replace=True)
+        seq = replace_database(tree_file, new_file)
+    except BaseException:
+        remove_database(new_file)
+        raise
+    return dict(stats, file=new_file, seq=seq)
+
+# Define a function to check a tree database for corruption and for derived data that doesn't match the nodes: the
+# edges (which should all come from the parent and children lists of the nodes), the hashes, the search index, and
+# the text versions. Returns the problems found.
+def verify(tree_file):
+    conn = sqlite3.connect(tree_file)
+    c = conn.cursor()
+    problems = [row[0] for row in c.execute("PRAGMA integrity_check").fetchall() if row[0] != 'ok']
+    if problems:
+        conn.close()
+        return problems
+    c.execute("BEGIN")
+    listed = set()
+    for node_id, parent_ids, children_ids in c.execute("SELECT id, parent_ids, children_ids FROM nodes").fetchall():
+        listed.update(node_edges(node_id, parent_ids, children_ids))
+    unlisted = [edge for edge in c.execute("SELECT parent_id, child_id FROM edges").fetchall() if edge not in listed]
+    if unlisted:
+        problems.append('%d edges are not listed by their nodes, such as %s -> %s' % ((len(unlisted),) + unlisted[0]))
+    hashes = compute_hashes(c)
+    stored = {row[0]: row[1:] for row in c.execute("SELECT id, content_hash, subtree_hash FROM hashes").fetchall()}
+    for description, node_ids in (('have no hashes', [node_id for node_id in hashes if node_id not in stored]),
+                                  ('have hashes that are out of date',
+                                   [node_id for node_id in hashes if node_id in stored and stored[node_id] != hashes[node_id]]),
+                                  ('have hashes but no longer exist', [node_id for node_id in stored if node_id not in hashes])):
+        if node_ids:
+            problems.append('%d nodes %s, such as %s' % (len(node_ids), description, node_ids[0]))
+    if has_search_index(c):
+        try:
+            c.execute("INSERT INTO nodes_fts (nodes_fts) VALUES ('integrity-check')")
+        except sqlite3.DatabaseError as e:
+            problems.append('The search index is out of date (%s)' % e)
+    c.execute("SELECT COUNT(*) FROM text_versions WHERE id NOT IN (SELECT id FROM nodes)")
+    orphans = c.fetchone()[0]
+    if orphans:
+        problems.append('%d text versions belong to nodes that no longer exist' % orphans)
+    conn.rollback()
+    conn.close()
+    return problems
+
+# Define a function to run the server, over ASGI unless the development server is asked for
+# (the server is only imported here, since it reads its settings from the environment as it is imported)
+def serve(port=None, workers=None, dev=False):
+    if port is not None:
+        os.environ['SERVER_PORT'] = str(port)
+    if workers is not None:
+        os.environ['WORKERS'] = str(workers)
+    if dev:
+        import server
+        server.create_app().run(host='0.0.0.0', port=server.SERVER_PORT, debug=True)
+    else:
+        import asgi
+        asgi.serve()
+
+if __name__ == '__main__':
+    dotenv.load_dotenv()
+    parser = argparse.ArgumentParser(description='Run and maintain a Multiloom server and its databases.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    tree_parser = argparse.ArgumentParser(add_help=False)
+    tree_parser.add_argument('--tree-file', default=os.getenv('TREE_FILE'), help='the tree database (TREE_FILE by default)')
+
+    serve_parser = subparsers.add_parser('serve', help='run the server')
+    serve_parser.add_argument('--port', type=int, help='the port to listen on (SERVER_PORT by default)')
+    serve_parser.add_argument('--workers', type=int, help='the number of worker processes (WORKERS by default)')
+    serve_parser.add_argument('--dev', action='store_true', help="run Flask's development server instead")
+
+    import_parser = subparsers.add_parser('import', parents=[tree_parser],
+                                          help='import a tree file or snapshot into a new database, and switch the tree over to it')
+    import_parser.add_argument('source', nargs='?', default=os.getenv('TREE_SNAPSHOT') or os.getenv('TREE_JSON'),
+                               help='the tree file or snapshot to import (TREE_SNAPSHOT or TREE_JSON by default)')
+    import_parser.add_argument('--format', choices=FORMATS, default=os.getenv('TREE_FORMAT'),
+                               help='the format of the tree file (detected if not given)')
+    import_parser.add_argument('--author', default=IMPORT_AUTHOR, help='the author to record for nodes that do not have one')
+
+    export_parser = subparsers.add_parser('export', parents=[tree_parser], help='export a database to a tree file or snapshot')
+    export_parser.add_argument('output', help='the file to write')
+    export_parser.add_argument('--format', choices=('json', 'snapshot'),
+                               help='what to write (a snapshot if the file name ends in .snapshot, JSON otherwise)')
+
+    subparsers.add_parser('verify', parents=[tree_parser], help='check a database for corruption and inconsistencies')
+
+    compact_parser = subparsers.add_parser('compact', parents=[tree_parser],
+                                           help='compact the history of a database and vacuum it (with the server stopped)')
+    compact_parser.add_argument('--keep-count', type=int, help='keep at least this many of the latest operations')
+    compact_parser.add_argument('--keep-days', type=float, help='keep the operations from the last this many days')
+    compact_parser.add_argument('--checkpoint-dir', help='write a checkpoint here first (the history after it is always kept)')
+    compact_parser.add_argument('--checkpoint-keep', type=int, default=2, help='the number of checkpoints to keep')
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.port, args.workers, args.dev)
+        sys.exit()
+    if not args.tree_file:
+        parser.error('no tree database given (set TREE_FILE or pass --tree-file)')
+    if args.command == 'import':
+        if not args.source:
+            parser.error('nothing to import (set TREE_JSON or TREE_SNAPSHOT, or pass the file)')
+        stats = import_database(args.tree_file, args.source, args.format, args.author)
+        print('Imported %(nodes)d nodes into %(file)s in %(seconds).2fs (%(nodes_per_second)d nodes/s), '
+              'changes carry on from %(seq)d' % stats)
+    elif args.command == 'export':
+        start = time.perf_counter()
+        if (args.format or ('snapshot' if args.output.endswith('.snapshot') else 'json')) == 'snapshot':
+            export_snapshot(args.tree_file, args.output)
+            print('Exported %s to %s in %.2fs' % (args.tree_file, args.output, time.perf_counter() - start))
+        else:
+            node_count = export_tree(args.tree_file, args.output)
+            print('Exported %d nodes to %s in %.2fs' % (node_count, args.output, time.perf_counter() - start))
+    elif args.command == 'verify':
+        if not os.path.exists(args.tree_file):
+            sys.exit('%s does not exist' % args.tree_file)
+        problems = verify(args.tree_file)
+        for problem in problems:
+            print(problem)
+        if problems:
+            sys.exit(1)
+        print('%s is consistent' % args.tree_file)
+    elif args.command == 'compact':
+        stats = compact(args.tree_file, args.keep_count, args.keep_days, args.checkpoint_dir, args.checkpoint_keep)
+        print('Removed %(removed)d of %(operations)d operations (history now starts at %(horizon)d), '
+              '%(bytes_before)d -> %(bytes_after)d bytes in %(seconds).2fs' % stats)
@@ -0,0 +1,368 @@
+import asyncio
+import contextvars
+import io
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import request
+
+import metrics
+import server
+
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 32))
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', 30))
+KEEPALIVE_TIMEOUT = float(os.getenv('KEEPALIVE_TIMEOUT', 5))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', 30))
+RESPONSE_BUFFER_SIZE = 65536
+
+# Define a class for a change feed subscriber that waits on the event loop instead of holding a thread
+# The hub calls put() on the thread that committed the change, so the change is handed over to the loop
+class AsyncSubscriber:
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=server.EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+    def put(self, change):
+        try:
+            self.loop.call_soon_threadsafe(self.deliver, change)
+        except RuntimeError:
+            # the loop has been closed
+            self.overflowed = True
+
+    def deliver(self, change):
+        try:
+            self.queue.put_nowait(change)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+# Define a function to build the WSGI environ of an ASGI HTTP request
+def build_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', None)
+    client = scope.get('client')
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port or 80),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0] if client else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+# Define a function to call the Flask app, returning its status, headers, body iterable and first chunk of the body
+def start_wsgi(environ):
+    started = {}
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = headers
+    iterable = server.app(environ, start_response)
+    try:
+        chunks = iter(iterable)
+        body, more = read_chunks(chunks)
+    except BaseException:
+        close_iterable(iterable)
+        raise
+    return started['status'], started['headers'], iterable, chunks, body, more
+
+# Define a function to read the next part of a WSGI response body, returning it and whether there is more
+def read_chunks(chunks):
+    parts = []
+    size = 0
+    for chunk in chunks:
+        parts.append(chunk)
+        size += len(chunk)
+        if size >= RESPONSE_BUFFER_SIZE:
+            return b''.join(parts), True
+    return b''.join(parts), False
+
+def close_iterable(iterable):
+    if hasattr(iterable, 'close'):
+        iterable.close()
+
+# Define a function to read a page of the change log after a sequence number
+def read_changes(tree, since):
+    with tree.pool.reader() as conn:
+        return server.get_changes(conn.cursor(), since, server.CHANGES_PAGE_SIZE)
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+# Define an ASGI app serving the Flask app from a bounded thread pool
+# Every request runs in the pool, with its SQLite work, but the change feed (GET /events) waits for changes on the
+# event loop, so idle collaborators cost a coroutine rather than a thread. Requests that take longer than
+# REQUEST_TIMEOUT get a 504 (the work itself carries on in its thread, and its response is dropped).
+class ASGIApp:
+    def __init__(self, app, threads=ASGI_THREADS):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+        self.closing = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.active = 0
+        self.loop = None
+
+    async def __call__(self, scope, receive, send):
+        self.loop = asyncio.get_running_loop()
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        self.active += 1
+        self.idle.clear()
+        try:
+            if self.closing.is_set():
+                return await self.send_json(send, 503, {'success': False, 'error': 'Server is shutting down'})
+            body = await self.read_body(receive)
+            if body is None:
+                return
+            environ = build_environ(scope, body)
+            if scope['method'] == 'GET' and scope['path'] == '/events':
+                return await self.events(environ, receive, send)
+            return await self.wsgi(environ, send)
+        finally:
+            self.active -= 1
+            if not self.active:
+                self.idle.set()
+
+    async def read_body(self, receive):
+        parts = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return None
+            parts.append(message.get('body', b''))
+            if not message.get('more_body'):
+                return b''.join(parts)
+
+    # Run a blocking function in the pool, waiting at most REQUEST_TIMEOUT for it
+    # If it times out or the request is cancelled, abandon(result) is run once the function finishes
+    async def call(self, fn, *args, abandon=None):
+        future = self.loop.run_in_executor(self.executor, fn, *args)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), REQUEST_TIMEOUT)
+        except BaseException:
+            if abandon is not None:
+                future.add_done_callback(lambda done: self.abandon(done, abandon))
+            raise
+
+    def abandon(self, done, abandon):
+        if done.cancelled() or done.exception() is not None:
+            return
+        try:
+            self.executor.submit(abandon, done.result())
+        except RuntimeError:
+            # the pool has been shut down
+            abandon(done.result())
+
+    async def send_json(self, send, status, data):
+        body = json.dumps(data).encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    # Every part of the request runs in the same context, since the Flask contexts that streamed bodies keep pushed
+    # (see stream_with_context) live in context variables, and the parts can run on different threads
+    async def wsgi(self, environ, send):
+        context = contextvars.copy_context()
+        try:
+            status, headers, iterable, chunks, body, more = await self.call(
+                context.run, start_wsgi, environ, abandon=lambda result: context.run(close_iterable, result[2]))
+        except asyncio.TimeoutError:
+            return await self.send_json(send, 504, {'success': False, 'error': 'Request timed out'})
+        try:
+            await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+            while more:
+                await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+                try:
+                    body, more = await self.call(context.run, read_chunks, chunks,
+                                                 abandon=lambda result: context.run(close_iterable, iterable))
+                except asyncio.TimeoutError:
+                    # too late for an error response, so cut the response short
+                    iterable = None
+                    return
+            await send({'type': 'http.response.body', 'body': body})
+        finally:
+            # closing the body runs the request teardown, which releases its connections and tree
+            if iterable is not None:
+                await self.loop.run_in_executor(self.executor, context.run, close_iterable, iterable)
+
+    # Serve the change feed: check the request and subscribe in the pool, then wait for changes on the loop
+    async def events(self, environ, receive, send):
+        start = time.perf_counter()
+        subscriber = AsyncSubscriber(self.loop)
+        try:
+            tree, last_seq, params, response = await self.call(
+                self.begin_events, environ, subscriber,
+                abandon=lambda result: result[0] and server.end_events(result[0], subscriber))
+        except asyncio.TimeoutError:
+            return await self.send_json(send, 504, {'success': False, 'error': 'Request timed out'})
+        if response is not None:
+            status, headers, body = response
+            await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+            return await send({'type': 'http.response.body', 'body': body})
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        closing = asyncio.ensure_future(self.closing.wait())
+        status = 200
+        try:
+            since = params['since']
+            if params['poll']:
+                if since is None:
+                    since = last_seq
+                changes = await self.call(read_changes, tree, since)
+                if not changes:
+                    # wait for the next commit, then collect whatever else arrived with it
+                    change = await self.next_change(subscriber, (disconnected, closing), params['timeout'])
+                    if change is not None:
+                        changes.append(change)
+                        while len(changes) < server.CHANGES_PAGE_SIZE and not subscriber.queue.empty():
+                            changes.append(subscriber.queue.get_nowait())
+                    changes = [change for change in changes if change['seq'] > since]
+                if disconnected.done():
+                    return
+                cursor = changes[-1]['seq'] if changes else since
+                return await self.send_json(send, 200, {'success': True, 'changes': changes, 'cursor': cursor,
+                                                        'more': len(changes) == server.CHANGES_PAGE_SIZE})
+
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+                                    (b'x-accel-buffering', b'no')]})
+            await self.send_event(send, 'retry: 1000\n\n')
+            cursor = last_seq
+            # replay the changes the client missed, then follow the live feed
+            if since is not None:
+                cursor = since
+                while True:
+                    changes = await self.call(read_changes, tree, cursor)
+                    for change in changes:
+                        await self.send_event(send, server.change_to_event(change))
+                        cursor = change['seq']
+                    if len(changes) < server.CHANGES_PAGE_SIZE:
+                        break
+            while not subscriber.overflowed:
+                change = await self.next_change(subscriber, (disconnected, closing), server.EVENTS_KEEPALIVE)
+                if disconnected.done() or closing.done():
+                    break
+                if change is None:
+                    await self.send_event(send, ': keepalive\n\n')
+                elif change['seq'] > cursor:
+                    await self.send_event(send, server.change_to_event(change))
+                    cursor = change['seq']
+            if not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            # the client went away mid-response
+            status = 499
+        finally:
+            disconnected.cancel()
+            closing.cancel()
+            await self.loop.run_in_executor(self.executor, server.end_events, tree, subscriber)
+            seconds = time.perf_counter() - start
+            metrics.requests_total.inc('/events', 'GET', str(status))
+            metrics.request_seconds.observe(seconds, '/events', 'GET')
+
+    def begin_events(self, environ, subscriber):
+        with self.app.request_context(environ):
+            tree, last_seq, response = server.begin_events(subscriber)
+            if response is not None:
+                return None, None, None, (response.status_code, response.headers.to_wsgi_list(), response.get_data())
+            timeout = min(request.args.get('timeout', server.EVENTS_POLL_TIMEOUT, type=float), server.EVENTS_POLL_TIMEOUT)
+            params = {'since': server.events_since(), 'poll': request.args.get('mode') == 'poll', 'timeout': timeout}
+            return tree, last_seq, params, None
+
+    async def send_event(self, send, event):
+        await send({'type': 'http.response.body', 'body': event.encode(), 'more_body': True})
+
+    # Wait for the next change, returning None if the timeout passes or any of the other tasks finishes first
+    async def next_change(self, subscriber, tasks, timeout):
+        if not subscriber.queue.empty():
+            return subscriber.queue.get_nowait()
+        getter = asyncio.ensure_future(subscriber.queue.get())
+        done, _ = await asyncio.wait((getter,) + tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if getter in done:
+            return getter.result()
+        getter.cancel()
+        return None
+
+    async def wait_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.watch_signals()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # End the change feeds as soon as the server is asked to stop, since servers wait for every open connection to
+    # finish before shutting the app down (the server's own handlers are still called)
+    def watch_signals(self):
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            previous = signal.getsignal(sig)
+            if not callable(previous):
+                continue
+            def handler(sig, frame, previous=previous):
+                self.close()
+                previous(sig, frame)
+            try:
+                signal.signal(sig, handler)
+            except ValueError:
+                # not on the main thread, so the server is left to shut the app down
+                return
+
+    # Start shutting down: new requests are turned away and change feeds end, so that clients reconnect elsewhere
+    # (safe to call from any thread, such as a signal handler)
+    def close(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.closing.set)
+
+    # Finish shutting down: wait for the requests in flight (up to SHUTDOWN_TIMEOUT), then close every tree
+    async def shutdown(self):
+        self.closing.set()
+        try:
+            await asyncio.wait_for(self.idle.wait(), SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        await self.loop.run_in_executor(None, self.executor.shutdown)
+        server.trees.close()
+
+# Define a function to get the ASGI app, for ASGI servers (such as `uvicorn --factory asgi:create_asgi_app`)
+def create_asgi_app():
+    return ASGIApp(server.create_app())
+
+# Define a function to serve the app with uvicorn, in WORKERS processes
+def serve(host='0.0.0.0', port=None):
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('Serving over ASGI needs an ASGI server: pip install uvicorn')
+    uvicorn.run('asgi:create_asgi_app', factory=True, host=host, port=int(port or server.SERVER_PORT or 8080),
+                workers=server.WORKERS, lifespan='on', timeout_keep_alive=KEEPALIVE_TIMEOUT,
+                timeout_graceful_shutdown=SHUTDOWN_TIMEOUT)
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,246 @@
+import argparse
+import importlib
+import itertools
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from schema import init_db, node_edges
+
+SHAPES = ('chain', 'wide', 'dag', 'text')
+PASSWORD = 'bench'
+TREE_ID = 'bench'
+HEADERS = {'Authorization': PASSWORD, 'Tree-Id': TREE_ID}
+BATCH_SIZE = 100
+WORDS = ('the', 'loom', 'weaves', 'a', 'branching', 'story', 'of', 'many', 'possible', 'futures', 'and', 'pasts')
+
+# Define a function to generate the rows of a synthetic tree:
+#   chain  every node is the child of the one before it (deep ancestry and subtrees)
+#   wide   every node has up to 100 children (big child lists)
+#   dag    nodes have one to three parents (multi-parent structure)
+#   text   a random tree whose nodes hold several KB of text (big bodies)
+def generate_tree(shape, size, seed=0):
+    rng = random.Random(seed)
+    ids = ['n%d' % i for i in range(size)]
+    parents = [[] for _ in range(size)]
+    children = [[] for _ in range(size)]
+    for i in range(1, size):
+        if shape == 'chain':
+            parent_indexes = [i - 1]
+        elif shape == 'wide':
+            parent_indexes = [(i - 1) // 100]
+        elif shape == 'dag':
+            parent_indexes = sorted({rng.randrange(max(0, i - 50), i) for _ in range(rng.randint(1, 3))})
+        else:
+            parent_indexes = [rng.randrange(i)]
+        for parent in parent_indexes:
+            parents[i].append(ids[parent])
+            children[parent].append(ids[i])
+    rows = []
+    for i in range(size):
+        words = rng.randint(500, 3000) if shape == 'text' else rng.randint(5, 30)
+        text = ' '.join(rng.choice(WORDS) for _ in range(words))
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1700000000 + i))
+        rows.append((ids[i], ','.join(parents[i]) if i else None, ','.join(children[i]), text, 'bench', timestamp))
+    return rows
+
+# Define a function to write a synthetic tree (and a create entry in the history for each node) to a database
+def build_database(tree_file, rows):
+    init_db(tree_file)
+    conn = sqlite3.connect(tree_file)
+    c = conn.cursor()
+    c.executemany("INSERT INTO nodes (id, parent_ids, children_ids, text, author, timestamp) VALUES (?, ?, ?, ?, ?, ?)", rows)
+    c.executemany("INSERT OR IGNORE INTO edges (parent_id, child_id) VALUES (?, ?)",
+                  [edge for row in rows for edge in node_edges(row[0], row[1], row[2])])
+    c.executemany("INSERT INTO history (id, timestamp, operation, author) VALUES (?, ?, 'create', ?)",
+                  [(row[0], row[5], row[4]) for row in rows])
+    conn.commit()
+    conn.close()
+
+# Define a function to import a fresh copy of the server against a database, with extra environment variables
+def load_server(tree_file, env):
+    os.environ.update({'TREE_FILE': tree_file, 'TREE_ID': TREE_ID, 'SERVER_PASSWORD': PASSWORD})
+    os.environ.update(env)
+    sys.modules.pop('server', None)
+    return importlib.import_module('server')
+
+def unload_server(server):
+    server.trees.close()
+    sys.modules.pop('server', None)
+
+# Define a function to get the scenarios driving every route, as (name, heavy, request) tuples where request
+# maps a request number to (method, path, json body). Heavy scenarios read the whole tree and run fewer times.
+def scenarios(rows):
+    ids = [row[0] for row in rows]
+    rng = random.Random(1)
+    pick = lambda i: ids[(i * 7919) % len(ids)]
+    root, leaf = ids[0], ids[-1]
+    middle = rows[len(rows) // 2][5]
+    node = lambda node_id, i: {'id': node_id, 'parentId': pick(i), 'text': 'bench node %d' % i, 'author': 'bench', 'timestamp': middle}
+    batch_ids = lambda i: ['b%d-%d' % (i, k) for k in range(BATCH_SIZE)]
+    return [
+        ('GET /nodes', True, lambda i: ('GET', '/nodes', None)),
+        ('GET /nodes?stream=ndjson', True, lambda i: ('GET', '/nodes?stream=ndjson', None)),
+        ('GET /nodes/ids', True, lambda i: ('GET', '/nodes/ids', None)),
+        ('GET /snapshot', True, lambda i: ('GET', '/snapshot', None)),
+        ('GET /nodes/get/<timestamp>', True, lambda i: ('GET', '/nodes/get/%s' % middle, None)),
+        ('GET /history', False, lambda i: ('GET', '/history', None)),
+        ('GET /history?since', False, lambda i: ('GET', '/history?since=%d' % (i % len(ids)), None)),
+        ('GET /history/<timestamp>', True, lambda i: ('GET', '/history/%s' % middle, None)),
+        ('GET /changes', False, lambda i: ('GET', '/changes?since=%d' % (i % len(ids)), None)),
+        ('GET /changes?delta', False, lambda i: ('GET', '/changes?since=%d&delta=1' % (i % len(ids)), None)),
+        ('GET /events?mode=poll', False, lambda i: ('GET', '/events?mode=poll&since=%d' % (i % len(ids)), None)),
+        ('GET /nodes/count', False, lambda i: ('GET', '/nodes/count', None)),
+        ('GET /nodes/<id>', False, lambda i: ('GET', '/nodes/%s' % pick(i), None)),
+        ('GET /nodes/exists/<id>', False, lambda i: ('GET', '/nodes/exists/%s' % pick(i), None)),
+        ('POST /nodes/exists', False, lambda i: ('POST', '/nodes/exists', {'nodeIds': rng.sample(ids, min(100, len(ids)))})),
+        ('GET /nodes/root', False, lambda i: ('GET', '/nodes/root', None)),
+        ('GET /nodes/<id>/children', False, lambda i: ('GET', '/nodes/%s/children' % pick(i), None)),
+        ('GET /nodes/<id>/parents', False, lambda i: ('GET', '/nodes/%s/parents' % pick(i), None)),
+        ('GET /nodes/<id>/ancestry', False, lambda i: ('GET', '/nodes/%s/ancestry' % leaf, None)),
+        ('GET /nodes/<id>/context', False, lambda i: ('GET', '/nodes/%s/context?max_chars=4000' % pick(i), None)),
+        ('GET /nodes/<id>/subtree', False, lambda i: ('GET', '/nodes/%s/subtree?depth=3&limit=1000' % root, None)),
+        ('GET /search', False, lambda i: ('GET', '/search?q=%s+%s' % (WORDS[i % len(WORDS)], WORDS[(i * 5) % len(WORDS)]), None)),
+        ('GET /search?under', False, lambda i: ('GET', '/search?q=%s&under=%s' % (WORDS[i % len(WORDS)], pick(i)), None)),
+        ('GET /stats/pool', False, lambda i: ('GET', '/stats/pool', None)),
+        ('GET /metrics', False, lambda i: ('GET', '/metrics', None)),
+        # the writes create, update and then delete their own nodes, leaving the tree as it was
+        ('POST /nodes', False, lambda i: ('POST', '/nodes', node('p%d' % i, i))),
+        ('POST /nodes/batch', False, lambda i: ('POST', '/nodes/batch', [node(node_id, i) for node_id in batch_ids(i)])),
+        ('PUT /nodes/<id>', False, lambda i: ('PUT', '/nodes/p%d' % i, {'text': 'updated %d' % i, 'author': 'bench', 'timestamp': middle})),
+        ('PUT /nodes/batch', False, lambda i: ('PUT', '/nodes/batch', [{'id': node_id, 'text': 'updated', 'author': 'bench', 'timestamp': middle} for node_id in batch_ids(i)])),
+        ('DELETE /nodes/<id>', False, lambda i: ('DELETE', '/nodes/p%d' % i, None)),
+        ('DELETE /nodes/batch', False, lambda i: ('DELETE', '/nodes/batch', [{'id': node_id} for node_id in batch_ids(i)])),
+    ]
+
+# Define a function to get a percentile of a sorted list of latencies
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+# Define a function to send a number of requests for a scenario from a number of threads, returning its statistics
+def run_scenario(app, request, count, concurrency):
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies, errors = [], [0]
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                i = next(counter)
+            if i >= count:
+                return
+            method, path, body = request(i)
+            start = time.perf_counter()
+            response = client.open(path, method=method, json=body, headers=HEADERS)
+            data = response.get_data()
+            seconds = time.perf_counter() - start
+            response.close()
+            failed = response.status_code >= 400
+            if not failed and response.mimetype == 'application/json':
+                failed = json.loads(data).get('success') is False
+            with lock:
+                latencies.append(seconds)
+                errors[0] += failed
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'requests': count,
+        'errors': errors[0],
+        'throughput': round(count / seconds, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3)
+    }
+
+# Define a function to measure the peak memory allocated by Python while serving one request of each scenario, in
+# MiB. It runs apart from the timed scenarios, since tracing allocations slows every request down, and it leaves out
+# memory allocated outside of Python (such as SQLite's page cache).
+def measure_memory(app, requests):
+    tracemalloc.start()
+    try:
+        for request in requests:
+            run_scenario(app, request, 1, 1)
+        return round(tracemalloc.get_traced_memory()[1] / 1048576, 1)
+    finally:
+        tracemalloc.stop()
+
+# Define a function to run every scenario against every tree shape, size and concurrency level
+def run(shapes, sizes, concurrency_levels, count, env, routes=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for shape in shapes:
+            for size in sizes:
+                tree_file = os.path.join(directory, '%s-%d.db' % (shape, size))
+                rows = generate_tree(shape, size)
+                build_database(tree_file, rows)
+                server = load_server(tree_file, env)
+                selected = [(name, heavy, request) for name, heavy, request in scenarios(rows)
+                            if not routes or any(route in name for route in routes)]
+                try:
+                    for concurrency in concurrency_levels:
+                        key = '%s/%d/c%d' % (shape, size, concurrency)
+                        results[key] = {}
+                        for name, heavy, request in selected:
+                            stats = run_scenario(server.app, request, max(1, count // 10) if heavy else count, concurrency)
+                            results[key][name] = stats
+                            print('%-16s %-28s %6d req %4d err %9.1f req/s  p50 %8.3fms  p99 %8.3fms' % (
+                                key, name, stats['requests'], stats['errors'], stats['throughput'], stats['p50_ms'], stats['p99_ms']))
+                    # the peak memory is measured once per tree, starting from nothing, so that every size gets its own
+                    key = '%s/%d' % (shape, size)
+                    results[key] = {'peak_memory_mb': measure_memory(server.app, [request for _, _, request in selected])}
+                    print('%-16s peak memory %.1f MiB' % (key, results[key]['peak_memory_mb']))
+                finally:
+                    unload_server(server)
+    return results
+
+# Define a function to compare results with a baseline, returning the scenarios whose median latency regressed
+# (differences under a millisecond are ignored as noise)
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, routes in results.items():
+        for name, stats in routes.items():
+            before = baseline.get(key, {}).get(name)
+            if not isinstance(stats, dict) or not isinstance(before, dict):
+                continue
+            if stats['p50_ms'] > before['p50_ms'] * threshold and stats['p50_ms'] - before['p50_ms'] > 1:
+                regressions.append((key, name, before['p50_ms'], stats['p50_ms']))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark every route of the server in-process against synthetic trees.')
+    parser.add_argument('--shapes', nargs='+', choices=SHAPES, default=list(SHAPES), help='the tree shapes to generate')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000], help='the numbers of nodes to generate')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8], help='the numbers of client threads')
+    parser.add_argument('--requests', type=int, default=50, help='requests per scenario (a tenth of that for whole-tree reads)')
+    parser.add_argument('--routes', nargs='+', help='only run the scenarios whose names contain one of these')
+    parser.add_argument('--env', nargs='+', default=[], metavar='KEY=VALUE', help='server settings, such as TREE_INDEX=1 or GROUP_COMMIT=1')
+    parser.add_argument('--save', metavar='PATH', help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare the results with a saved baseline, failing on regressions')
+    parser.add_argument('--threshold', type=float, default=1.25, help='how much slower a median may get before it counts as a regression')
+    args = parser.parse_args()
+    env = dict(setting.split('=', 1) for setting in args.env)
+    results = run(args.shapes, args.sizes, args.concurrency, args.requests, env, args.routes)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'env': env, 'results': results}, f, indent=2)
+        print('Saved the results to %s' % args.save)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.threshold)
+        for key, name, before, after in regressions:
+            print('REGRESSION %-16s %-28s p50 %.3fms -> %.3fms' % (key, name, before, after))
+        if regressions:
+            sys.exit(1)
+        print('No regressions against %s' % args.compare)
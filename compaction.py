@@ -0,0 +1,138 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from schema import has_search_index, init_db, tree_version
+from snapshot import snapshot_chunks
+
+# The history table is the change log that clients sync from, so it is compacted rather than truncated: past the
+# retention horizon, an operation is only removed once a later one supersedes it (every node keeps its last change,
+# which also keeps the tree version and the node version tags as they were), and deleted nodes lose their tombstones.
+# Cursors from before the horizon have missed changes for good, so those clients start again from a checkpoint:
+# a snapshot of the tree at a known sequence number, written every so many changes. The horizon never passes the
+# latest checkpoint, so every change after it is still there to replay.
+
+# Define a function to get the checkpoints in a directory, as (seq, path) pairs from oldest to newest
+def list_checkpoints(directory):
+    if not directory or not os.path.isdir(directory):
+        return []
+    checkpoints = []
+    for name in os.listdir(directory):
+        seq, extension = os.path.splitext(name)
+        if extension == '.snapshot' and seq.isdigit():
+            checkpoints.append((int(seq), os.path.join(directory, name)))
+    return sorted(checkpoints)
+
+def latest_checkpoint(directory):
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1][0] if checkpoints else None
+
+# Define a function to write a checkpoint of a tree database, keeping only the newest `keep` of them
+# The snapshot is written under a temporary name and renamed into place, so a checkpoint is never seen half-written
+# (and processes racing to write the same one just replace it with the same content). Returns its sequence number.
+def write_checkpoint(conn, directory, keep=2):
+    os.makedirs(directory, exist_ok=True)
+    c = conn.cursor()
+    c.execute("BEGIN")
+    try:
+        seq = tree_version(c)
+        path = os.path.join(directory, '%d.snapshot' % seq)
+        if not os.path.exists(path):
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in snapshot_chunks(c):
+                        f.write(chunk)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+    finally:
+        conn.rollback()
+    for _, old_path in list_checkpoints(directory)[:-keep]:
+        os.remove(old_path)
+    return seq
+
+# Define a function to get the sequence number before which the history can be compacted
+# An operation is kept while any of the limits keeps it: it is one of the last keep_count, or newer than keep_days.
+# The last change is always kept, and so is everything from the latest checkpoint on (if there is one).
+def retention_horizon(c, keep_count=None, keep_days=None, checkpoint_seq=None):
+    c.execute("SELECT COALESCE(MAX(seq), 0) FROM history")
+    last = c.fetchone()[0]
+    horizons = []
+    if keep_count:
+        horizons.append(last - keep_count + 1)
+    if keep_days:
+        cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time() - keep_days * 86400))
+        c.execute("SELECT MIN(seq) FROM history WHERE timestamp >= ?", (cutoff,))
+        horizons.append(c.fetchone()[0] or last)
+    if not horizons:
+        return 0
+    horizon = min(min(horizons), last)
+    if checkpoint_seq is not None:
+        horizon = min(horizon, checkpoint_seq)
+    return max(horizon, 0)
+
+# Define a function to get the sequence number the history was last compacted up to (0 if it never was)
+def compacted_horizon(c):
+    c.execute("SELECT value FROM meta WHERE key = 'history_horizon'")
+    row = c.fetchone()
+    return int(row[0]) if row else 0
+
+# Define a function to compact the history before a sequence number, returning how many operations were removed
+# It should run in a write transaction.
+def compact_history(c, horizon):
+    if horizon <= compacted_horizon(c):
+        return 0
+    c.execute("""DELETE FROM history WHERE seq < ? AND (operation = 'delete'
+                     OR EXISTS (SELECT 1 FROM history AS later WHERE later.id = history.id AND later.seq > history.seq))""",
+              (horizon,))
+    removed = c.rowcount
+    # the text of versions from before the horizon goes with them
+    c.execute("DELETE FROM text_versions WHERE seq < ?", (horizon,))
+    c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('history_horizon', ?)", (str(horizon),))
+    return removed
+
+# Define a function to compact a tree database offline: checkpoint it, compact its history, and vacuum it
+# (which rebuilds the search index too, since vacuuming can renumber the nodes it is keyed on). Returns the statistics.
+def compact(tree_file, keep_count=None, keep_days=None, checkpoint_dir=None, checkpoint_keep=2):
+    init_db(tree_file)
+    start = time.perf_counter()
+    size_before = os.path.getsize(tree_file)
+    conn = sqlite3.connect(tree_file, isolation_level=None)
+    checkpoint_seq = write_checkpoint(conn, checkpoint_dir, checkpoint_keep) if checkpoint_dir else None
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    c.execute("SELECT COUNT(*) FROM history")
+    operations = c.fetchone()[0]
+    removed = compact_history(c, retention_horizon(c, keep_count, keep_days, checkpoint_seq))
+    horizon = compacted_horizon(c)
+    c.execute("COMMIT")
+    c.execute("VACUUM")
+    if has_search_index(c):
+        c.execute("INSERT INTO nodes_fts (nodes_fts) VALUES ('rebuild')")
+    c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    return {
+        'operations': operations,
+        'removed': removed,
+        'horizon': horizon,
+        'checkpoint': checkpoint_seq,
+        'bytes_before': size_before,
+        'bytes_after': os.path.getsize(tree_file),
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compact the history of a Multiloom database and vacuum it (with the server stopped).')
+    parser.add_argument('tree_file', help='the database to compact')
+    parser.add_argument('--keep-count', type=int, help='keep at least this many of the latest operations')
+    parser.add_argument('--keep-days', type=float, help='keep the operations from the last this many days')
+    parser.add_argument('--checkpoint-dir', help='write a checkpoint here first (the history after it is always kept)')
+    parser.add_argument('--checkpoint-keep', type=int, default=2, help='the number of checkpoints to keep')
+    args = parser.parse_args()
+    stats = compact(args.tree_file, args.keep_count, args.keep_days, args.checkpoint_dir, args.checkpoint_keep)
+    print('Removed %(removed)d of %(operations)d operations (history now starts at %(horizon)d), '
+          '%(bytes_before)d -> %(bytes_after)d bytes in %(seconds).2fs' % stats)
@@ -0,0 +1,83 @@
+import gzip
+import threading
+import zlib
+
+# zstandard is optional; without it responses are only ever gzip-compressed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Define a function to pick the best encoding the client accepts (zstd if available, then gzip), or None
+def choose_encoding(accept_encoding):
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                pass
+        accepted[name.strip().lower()] = quality
+    for encoding in ('zstd', 'gzip'):
+        if encoding == 'zstd' and zstandard is None:
+            continue
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+# Define a function to compress a response body
+def compress(data, encoding, level=6):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+# Define a function to compress a streamed response chunk by chunk, flushing after each one so that the
+# client still sees bytes as soon as they are produced
+def compress_stream(chunks, encoding, level=6):
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        flush = lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        finish = compressor.flush
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+# Define a class caching the bodies of one response (such as the full tree) for the current tree version,
+# in each encoding it has been asked for
+class ResponseCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.bodies = {}
+
+    def get(self, version, encoding):
+        with self.lock:
+            if version == self.version:
+                return self.bodies.get(encoding)
+            return None
+
+    def put(self, version, encoding, body):
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.bodies = {}
+            self.bodies[encoding] = body
+
+    def clear(self):
+        with self.lock:
+            self.version = None
+            self.bodies = {}
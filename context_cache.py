@@ -0,0 +1,154 @@
+import json
+import threading
+from collections import OrderedDict
+
+# Define a class caching contexts: the concatenated text of the path from the root of the tree to a node, following
+# the first parent of multi-parent nodes (like /nodes/<node_id>/ancestry). It keeps the contexts of the nodes last
+# asked for and of their parents, up to a total number of characters, evicting the least recently used. A context is
+# built on the cached context of its nearest ancestor, so siblings share their parent's instead of each reading the
+# whole path again. Entries remember the nodes on their path, and are dropped when any of them changes.
+class ContextCache:
+    def __init__(self, max_chars, max_depth):
+        self.lock = threading.Lock()
+        self.max_chars = max_chars
+        self.max_depth = max_depth
+        # node id -> (text, path of node ids from the root, generation it was built at)
+        self.entries = OrderedDict()
+        self.chars = 0
+        # the generation each node last changed at (bumped after every change), and the one the cache was last
+        # cleared at: contexts read before a change to their path (or before a clear) are never cached
+        self.generation = 0
+        self.changed = {}
+        self.cleared = 0
+        self.counters = {'hits': 0, 'partial_hits': 0, 'misses': 0, 'evictions': 0}
+
+    # Get the context of a node, or None if it doesn't exist
+    # The rows of the nodes are read through the tree index if there is one.
+    def context(self, c, node_id, index=None):
+        with self.lock:
+            generation = self.generation
+            # the parents of a node never change, so a context is good for as long as the nodes on its path are
+            entry = self.lookup(node_id)
+            if entry is not None:
+                self.counters['hits'] += 1
+                return entry[0]
+        # the common case of a new node under one whose context was asked for, read without walking the path
+        rows = self.read_rows(c, [node_id], index)
+        if not rows:
+            return None
+        parent_ids, text = rows[0][1], rows[0][3] or ''
+        parent_id = parent_ids.split(',')[0] if parent_ids else None
+        with self.lock:
+            entry = self.lookup(parent_id) if parent_id else ('', ())
+            if entry is not None:
+                self.counters['partial_hits' if parent_id else 'misses'] += 1
+                text = entry[0] + text
+                self.put(entry[1] + (node_id,), text, generation)
+                return text
+        c.execute("""WITH RECURSIVE path(id, depth) AS (
+                         SELECT ?, 0
+                         UNION ALL
+                         SELECT CASE WHEN instr(nodes.parent_ids, ',') THEN substr(nodes.parent_ids, 1, instr(nodes.parent_ids, ',') - 1)
+                                     ELSE nodes.parent_ids END, path.depth + 1
+                         FROM path JOIN nodes ON nodes.id = path.id
+                         WHERE nodes.parent_ids != '' AND path.depth < ?)
+                     SELECT path.id, nodes.id IS NOT NULL FROM path LEFT JOIN nodes ON nodes.id = path.id
+                     ORDER BY path.depth DESC""", (node_id, self.max_depth))
+        rows = c.fetchall()
+        if not rows or not rows[-1][1]:
+            return None
+        # a path ending at a deleted parent is only read, not cached, since recreating that parent would change it
+        complete = rows[0][1]
+        path = tuple(row[0] for row in rows if row[1])
+
+        # start from the deepest ancestor with a cached context
+        prefix, start = '', 0
+        with self.lock:
+            for depth in range(len(path) - 1, -1, -1):
+                entry = self.lookup(path[depth], path[:depth + 1])
+                if entry is not None:
+                    prefix, start = entry[0], depth + 1
+                    break
+            self.counters['hits' if start == len(path) else 'partial_hits' if start else 'misses'] += 1
+        if start == len(path):
+            return prefix
+        rows = self.read_rows(c, path[start:], index)
+        texts = {row[0]: row[3] or '' for row in rows}
+        if len(texts) < len(path) - start:
+            # a node was deleted since the path was read
+            return None
+        texts = [texts[node_id] for node_id in path[start:]]
+        if complete:
+            parent = prefix + ''.join(texts[:-1])
+            with self.lock:
+                if len(path) > 1 and start < len(path) - 1:
+                    self.put(path[:-1], parent, generation)
+                text = parent + texts[-1]
+                self.put(path, text, generation)
+            return text
+        return prefix + ''.join(texts)
+
+    def read_rows(self, c, node_ids, index):
+        if index is not None:
+            return index.get_rows(c, list(node_ids))
+        c.execute("SELECT * FROM nodes WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(node_ids),))
+        return c.fetchall()
+
+    # Get the cached (text, path) context of a node if it is still valid, and its path is the one given if there is
+    # one (called with the lock held)
+    def lookup(self, node_id, path=None):
+        entry = self.entries.get(node_id)
+        if entry is None:
+            return None
+        text, entry_path, generation = entry
+        if path is not None and entry_path != path:
+            return None
+        if any(self.changed.get(path_id, -1) >= generation for path_id in entry_path):
+            self.remove(node_id)
+            return None
+        self.entries.move_to_end(node_id)
+        return text, entry_path
+
+    # Cache the context of the last node on a path, built from what the database held at a generation (called with
+    # the lock held). It is left out if any node on its path has changed since.
+    def put(self, path, text, generation):
+        if (len(text) > self.max_chars or generation < self.cleared
+                or any(self.changed.get(node_id, -1) >= generation for node_id in path)):
+            return
+        self.remove(path[-1])
+        self.entries[path[-1]] = (text, path, generation)
+        self.chars += len(text)
+        while self.chars > self.max_chars:
+            self.remove(next(iter(self.entries)))
+            self.counters['evictions'] += 1
+
+    def remove(self, node_id):
+        entry = self.entries.pop(node_id, None)
+        if entry is not None:
+            self.chars -= len(entry[0])
+
+    # Drop the contexts that the changes to a set of nodes (updates, deletes, or anything else) may have affected
+    # Contexts are checked against the changed nodes as they are read, rather than searched for here. The record
+    # of changes is cleared along with the cache once it gets large.
+    def invalidate(self, node_ids):
+        with self.lock:
+            if len(self.changed) > 10 * len(self.entries) + 10000:
+                self.reset()
+            for node_id in node_ids:
+                self.changed[node_id] = self.generation
+            self.generation += 1
+
+    def clear(self):
+        with self.lock:
+            self.reset()
+
+    def reset(self):
+        self.generation += 1
+        self.cleared = self.generation
+        self.entries.clear()
+        self.chars = 0
+        self.changed.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), chars=self.chars, max_chars=self.max_chars)
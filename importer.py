@@ -0,0 +1,194 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+from schema import bulk_load, init_db, rotate_token
+
+# ijson lets us parse huge exports incrementally; without it the whole file is loaded with json.load
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+IMPORT_BATCH_SIZE = 50000
+IMPORT_AUTHOR = 'Morpheus'
+FORMATS = ('loomsidian', 'bonsai', 'loom')
+
+# Define a function to work out the format of an already loaded tree
+# Returns the format and the key holding its nodes ('' if the document itself is the node list)
+def detect_format(data):
+    if isinstance(data, list):
+        return 'bonsai', ''
+    if 'root' in data:
+        return 'loom', 'root'
+    if isinstance(data.get('nodes'), list):
+        return 'bonsai', 'nodes'
+    return 'loomsidian', 'nodes'
+
+# Define a function to work out the format of a tree file by reading only as far as its top-level node container
+def sniff_format(f):
+    key = None
+    for prefix, event, value in ijson.parse(f):
+        if prefix == '' and event == 'start_array':
+            return 'bonsai', ''
+        if prefix == '' and event == 'map_key':
+            key = value
+        elif prefix == key == 'root' and event == 'start_map':
+            return 'loom', 'root'
+        elif prefix == key == 'nodes' and event in ('start_map', 'start_array'):
+            return ('loomsidian' if event == 'start_map' else 'bonsai'), 'nodes'
+    raise ValueError('Could not find any nodes in the tree file')
+
+# Define a function to read the nodes of a Loomsidian tree ({"nodes": {id: {"text", "parentId" or "parentIds", "childrenIds"}}})
+def loomsidian_nodes(items):
+    for node_id, node in items:
+        if 'parentIds' in node:
+            parent_ids = node['parentIds'] or []
+        else:
+            parent_ids = [node['parentId']] if node.get('parentId') else []
+        yield node_id, parent_ids, node.get('childrenIds'), node['text'], None
+
+# Define a function to read the nodes of a Bonsai tree (a flat list of nodes, each with an id and its parent id(s))
+def bonsai_nodes(items):
+    for node in items:
+        if 'parentIds' in node:
+            parent_ids = node['parentIds'] or []
+        else:
+            parent_id = node.get('parentId', node.get('parent'))
+            parent_ids = [parent_id] if parent_id else []
+        children_ids = node.get('childrenIds', node.get('children'))
+        yield str(node['id']), [str(parent_id) for parent_id in parent_ids], children_ids, node.get('text', node.get('content', '')), node.get('author')
+
+# Define a function to read the nodes of a python-Loom tree (a nested "root" node, each node holding its "children")
+def loom_nodes(root):
+    # walk the tree with an explicit stack, since stories can be far deeper than the recursion limit
+    stack = [(root, None)]
+    while stack:
+        node, parent_id = stack.pop()
+        children = node.get('children', [])
+        yield node['id'], [parent_id] if parent_id else [], [child['id'] for child in children], node.get('text', ''), None
+        stack.extend((child, node['id']) for child in reversed(children))
+
+# Define a function to read the nodes of a tree file as (id, parent ids, children ids or None, text, author) tuples
+def read_tree(path, fmt=None):
+    with open(path, 'rb') as f:
+        if ijson is not None:
+            # the container of the nodes is always found by sniffing, even when the format is given, since Bonsai
+            # files can hold their nodes either at the top level or under "nodes"
+            detected, key = sniff_format(f)
+            fmt = fmt or detected
+            f.seek(0)
+            if fmt == 'loomsidian':
+                yield from loomsidian_nodes(ijson.kvitems(f, key))
+            elif fmt == 'bonsai':
+                yield from bonsai_nodes(ijson.items(f, key + '.item' if key else 'item'))
+            else:
+                yield from loom_nodes(next(ijson.items(f, key)))
+            return
+        data = json.load(f)
+    detected, key = detect_format(data)
+    fmt = fmt or detected
+    nodes = data[key] if key else data
+    if fmt == 'loomsidian':
+        yield from loomsidian_nodes(nodes.items())
+    elif fmt == 'bonsai':
+        yield from bonsai_nodes(nodes)
+    else:
+        yield from loom_nodes(nodes)
+
+# Define a function to import a tree file into a tree database
+# Nodes are inserted with executemany in large transactions, and the children of nodes that do not list
+# their own are filled in from a child index built during the same pass. Returns the import statistics.
+def import_tree(tree_file, path, fmt=None, author=IMPORT_AUTHOR, replace=False):
+    if replace and os.path.exists(tree_file):
+        os.remove(tree_file)
+    init_db(tree_file)
+    start = time.perf_counter()
+    conn = sqlite3.connect(tree_file)
+    c = conn.cursor()
+    # the import can simply be rerun if it fails, so trade durability for speed while it runs
+    c.execute("PRAGMA synchronous = OFF")
+    c.execute("PRAGMA journal_mode = MEMORY")
+    c.execute("PRAGMA cache_size = -262144")
+    c.execute("PRAGMA temp_store = MEMORY")
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+
+    children = {}
+    missing_children = []
+    rows, edges = [], []
+    node_count = 0
+
+    def flush():
+        c.executemany("INSERT INTO nodes (id, parent_ids, children_ids, text, author, timestamp) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        c.executemany("INSERT OR IGNORE INTO edges (parent_id, child_id) VALUES (?, ?)", edges)
+        conn.commit()
+        rows.clear()
+        edges.clear()
+
+    with bulk_load(c):
+        for node_id, parent_ids, children_ids, text, node_author in read_tree(path, fmt):
+            for parent_id in parent_ids:
+                children.setdefault(parent_id, []).append(node_id)
+                edges.append((parent_id, node_id))
+            if children_ids is None:
+                missing_children.append(node_id)
+            else:
+                edges.extend((node_id, child_id) for child_id in children_ids)
+            rows.append((node_id, ','.join(parent_ids) or None, ','.join(children_ids or []), text, node_author or author, timestamp))
+            node_count += 1
+            if len(rows) >= IMPORT_BATCH_SIZE:
+                flush()
+        flush()
+
+        c.executemany("UPDATE nodes SET children_ids = ? WHERE id = ?",
+                      ((','.join(children.get(node_id, [])), node_id) for node_id in missing_children))
+    rotate_token(c)
+    conn.commit()
+    edge_count = c.execute("SELECT COUNT(*) FROM edges").fetchone()[0]
+    conn.close()
+
+    seconds = time.perf_counter() - start
+    return {
+        'nodes': node_count,
+        'edges': edge_count,
+        'seconds': round(seconds, 3),
+        'nodes_per_second': round(node_count / seconds) if seconds else node_count
+    }
+
+# Define a function to export a tree database to a tree file in the Bonsai format (a flat list of nodes, which keeps
+# their authors), written node by node from one read transaction. Returns the number of nodes written.
+def export_tree(tree_file, path):
+    conn = sqlite3.connect(tree_file)
+    c = conn.cursor()
+    c.execute("BEGIN")
+    c.execute("SELECT id, parent_ids, children_ids, text, author, timestamp FROM nodes ORDER BY rowid")
+    node_count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"nodes": [')
+        while True:
+            rows = c.fetchmany(IMPORT_BATCH_SIZE)
+            if not rows:
+                break
+            for node_id, parent_ids, children_ids, text, author, timestamp in rows:
+                node = {'id': node_id, 'parentIds': parent_ids.split(',') if parent_ids else [],
+                        'childrenIds': children_ids.split(',') if children_ids else [], 'text': text, 'author': author,
+                        'timestamp': timestamp}
+                f.write((',\n' if node_count else '\n') + json.dumps(node, ensure_ascii=False))
+                node_count += 1
+        f.write('\n]}\n')
+    conn.rollback()
+    conn.close()
+    return node_count
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import a Loomsidian, Bonsai or python-Loom tree into a Multiloom database.')
+    parser.add_argument('tree_json', help='the tree file to import')
+    parser.add_argument('tree_file', help='the database to import into')
+    parser.add_argument('--format', choices=FORMATS, help='the format of the tree file (detected if not given)')
+    parser.add_argument('--author', default=IMPORT_AUTHOR, help='the author to record for nodes that do not have one')
+    parser.add_argument('--replace', action='store_true', help='delete the existing database first')
+    args = parser.parse_args()
+    stats = import_tree(args.tree_file, args.tree_json, args.format, args.author, args.replace)
+    print('Imported %(nodes)d nodes and %(edges)d edges in %(seconds).2fs (%(nodes_per_second)d nodes/s)' % stats)
@@ -0,0 +1,106 @@
+import hashlib
+import json
+
+# Every node has two hashes, kept in the hashes table by the write routes (as SHA-256 hex digests):
+#   content hash: of the JSON array [id, text, author, timestamp], encoded compactly as UTF-8
+#   subtree hash: of the content hash followed by the subtree hashes of the node's children, sorted
+# and the tree hash is of the subtree hashes of the roots (the nodes without parents), sorted.
+# Two copies of a tree with the same tree hash hold the same nodes; where they differ, comparing the subtree hashes
+# of the children of a node whose subtree hashes differ finds the branches that do, one level at a time.
+
+content_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+def content_hash(node_id, text, author, timestamp):
+    return hashlib.sha256(content_encoder.encode([node_id, text, author, timestamp]).encode()).hexdigest()
+
+def subtree_hash(node_content_hash, child_hashes):
+    return hashlib.sha256((node_content_hash + ''.join(sorted(child_hashes))).encode()).hexdigest()
+
+def tree_hash(root_hashes):
+    return hashlib.sha256(''.join(sorted(root_hashes)).encode()).hexdigest()
+
+# Define a function to compute the subtree hashes of a set of nodes, children first, given their content hashes, the
+# edges from them to their existing children, and the (unchanged) subtree hashes of the children outside the set.
+# Nodes caught in a cycle of edges are hashed with the hashes their children had before.
+def hash_subtrees(content_hashes, children, known):
+    pending = {node_id: sum(1 for child_id in children.get(node_id, ()) if child_id in content_hashes)
+               for node_id in content_hashes}
+    parents = {}
+    for parent_id, child_ids in children.items():
+        for child_id in child_ids:
+            if child_id in content_hashes and parent_id in content_hashes:
+                parents.setdefault(child_id, []).append(parent_id)
+    ready = [node_id for node_id, count in pending.items() if count == 0]
+    hashes = dict(known)
+    while ready:
+        node_id = ready.pop()
+        hashes[node_id] = subtree_hash(content_hashes[node_id], [hashes[child_id] or '' for child_id in children.get(node_id, ())])
+        for parent_id in parents.get(node_id, ()):
+            pending[parent_id] -= 1
+            if pending[parent_id] == 0:
+                ready.append(parent_id)
+    for node_id, count in pending.items():
+        if count:
+            hashes[node_id] = subtree_hash(content_hashes[node_id],
+                                           [hashes.get(child_id) or '' for child_id in children.get(node_id, ())])
+    return hashes
+
+# Define a function to update the hashes after a write, given the nodes it created, updated or deleted, and the nodes
+# whose children it changed (such as the parents of deleted nodes). It should run in the write's transaction.
+# The content hashes of the nodes are recomputed, then the subtree hashes of them and all of their ancestors.
+def update_hashes(c, node_ids, changed_parent_ids=()):
+    node_ids = list(node_ids)
+    c.execute("SELECT id, text, author, timestamp FROM nodes WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(node_ids),))
+    rows = c.fetchall()
+    existing = {row[0] for row in rows}
+    c.executemany("DELETE FROM hashes WHERE id = ?", [(node_id,) for node_id in node_ids if node_id not in existing])
+    content_hashes = {row[0]: content_hash(*row) for row in rows}
+    c.execute("""WITH RECURSIVE up(id) AS (
+                     SELECT value FROM json_each(?)
+                     UNION
+                     SELECT edges.parent_id FROM up JOIN edges ON edges.child_id = up.id)
+                 SELECT up.id, hashes.content_hash FROM up JOIN nodes ON nodes.id = up.id LEFT JOIN hashes ON hashes.id = up.id""",
+              (json.dumps(list(existing) + list(changed_parent_ids)),))
+    for node_id, stored_hash in c.fetchall():
+        if node_id not in content_hashes:
+            content_hashes[node_id] = stored_hash
+    missing = [node_id for node_id, value in content_hashes.items() if value is None]
+    if missing:
+        c.execute("SELECT id, text, author, timestamp FROM nodes WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(missing),))
+        content_hashes.update((row[0], content_hash(*row)) for row in c.fetchall())
+    c.execute("""SELECT edges.parent_id, edges.child_id, hashes.subtree_hash
+                 FROM edges JOIN nodes ON nodes.id = edges.child_id LEFT JOIN hashes ON hashes.id = edges.child_id
+                 WHERE edges.parent_id IN (SELECT value FROM json_each(?))""", (json.dumps(list(content_hashes)),))
+    children, known = {}, {}
+    for parent_id, child_id, child_hash in c.fetchall():
+        children.setdefault(parent_id, []).append(child_id)
+        known[child_id] = child_hash
+    hashes = hash_subtrees(content_hashes, children, known)
+    c.executemany("INSERT OR REPLACE INTO hashes (id, content_hash, subtree_hash) VALUES (?, ?, ?)",
+                  [(node_id, content_hashes[node_id], hashes[node_id]) for node_id in content_hashes])
+
+# Define a function to compute the hashes of every node from scratch, as {id: (content hash, subtree hash)}
+def compute_hashes(c):
+    c.execute("SELECT id, text, author, timestamp FROM nodes")
+    content_hashes = {row[0]: content_hash(*row) for row in c.fetchall()}
+    c.execute("SELECT parent_id, child_id FROM edges")
+    children = {}
+    for parent_id, child_id in c.fetchall():
+        if child_id in content_hashes:
+            children.setdefault(parent_id, []).append(child_id)
+    hashes = hash_subtrees(content_hashes, children, {})
+    return {node_id: (content_hashes[node_id], hashes[node_id]) for node_id in content_hashes}
+
+# Define a function to store the hashes of every node from scratch (for new and imported databases)
+def rebuild_hashes(c):
+    hashes = compute_hashes(c)
+    c.execute("DELETE FROM hashes")
+    c.executemany("INSERT INTO hashes (id, content_hash, subtree_hash) VALUES (?, ?, ?)",
+                  [(node_id,) + node_hashes for node_id, node_hashes in hashes.items()])
+
+# Define a function to get the subtree hashes of the roots of the tree
+def root_hashes(c):
+    c.execute("""SELECT nodes.id, hashes.subtree_hash FROM nodes JOIN hashes ON hashes.id = nodes.id
+                 WHERE NOT EXISTS (SELECT 1 FROM edges JOIN nodes AS parents ON parents.id = edges.parent_id
+                                   WHERE edges.child_id = nodes.id)""")
+    return dict(c.fetchall())
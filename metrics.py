@@ -0,0 +1,247 @@
+import functools
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+# The phase timings of the request being handled on this thread, if any
+request_state = threading.local()
+
+# Define a function to escape a label value for the Prometheus text format
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values, extra=''):
+    labels = ['%s="%s"' % (name, escape_label(value)) for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{%s}' % ','.join(labels) if labels else ''
+
+# Define a class for a counter, with one value per combination of labels
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append('%s%s %s' % (self.name, format_labels(self.labels, labels), repr(float(value))))
+        return lines
+
+# Define a class for a histogram, with one set of buckets per combination of labels
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # labels -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (self.name, format_labels(self.labels, labels, 'le="%s"' % bound), cumulative))
+                lines.append('%s_sum%s %s' % (self.name, format_labels(self.labels, labels), repr(total)))
+                lines.append('%s_count%s %d' % (self.name, format_labels(self.labels, labels), cumulative))
+        return lines
+
+# Define a function to render a single value (such as a pool counter read at scrape time)
+def render_value(name, kind, help, value):
+    return ['# HELP %s %s' % (name, help), '# TYPE %s %s' % (name, kind), '%s %s' % (name, repr(float(value)))]
+
+requests_total = Counter('multiloom_requests_total', 'Requests handled, by route, method and status.', ('route', 'method', 'status'))
+request_seconds = Histogram('multiloom_request_duration_seconds', 'Time from receiving a request to sending the last byte of its response.', ('route', 'method'))
+phase_seconds = Histogram('multiloom_request_phase_seconds', 'Time spent in each phase of a request (auth, query, serialize, other).', ('route', 'phase'))
+response_bytes = Histogram('multiloom_response_size_bytes', 'Size of response bodies as sent, after compression.', ('route',), SIZE_BUCKETS)
+statement_seconds = Histogram('multiloom_sqlite_statement_seconds', 'Time spent executing SQLite statements and fetching their rows.', ('operation', 'table'))
+busy_total = Counter('multiloom_sqlite_busy_total', 'Statements that failed because the database was locked.', ('operation', 'table'))
+
+# Define a function to start timing the phases of a request on this thread
+def begin_request():
+    request_state.phases = {}
+    return request_state.phases
+
+# Define a function to finish timing the request on this thread, returning its phase timings
+def end_request():
+    phases = getattr(request_state, 'phases', None)
+    request_state.phases = None
+    return phases or {}
+
+# Define a function to add time to a phase of the request being handled on this thread
+def add_phase(phase, seconds):
+    phases = getattr(request_state, 'phases', None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+# Define a generator passing on the chunks of a streamed response body, timing the work of producing each one into
+# the given phase timings. The body is read after the request has returned, possibly on other threads (over ASGI,
+# each chunk on whichever thread is free), so those of the reading thread belong to another request, if any.
+def timed_chunks(chunks, phases):
+    chunks = iter(chunks)
+    try:
+        while True:
+            previous = getattr(request_state, 'phases', None)
+            request_state.phases = phases
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                request_state.phases = previous
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+# Define a function to label a statement by its operation and main table
+@functools.lru_cache(maxsize=1024)
+def statement_labels(sql):
+    words = sql.split(None, 1)
+    operation = words[0].upper() if words else ''
+    match = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(\w+)', sql, re.IGNORECASE)
+    return operation, match.group(1) if match else ''
+
+# Define cursor and connection classes that time every statement (including fetching its rows, which is when
+# SQLite does most of the work) and count the statements that fail because the database is locked
+class TimedCursor(sqlite3.Cursor):
+    labels = ('', '')
+
+    def timed(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            if 'locked' in str(e) or 'busy' in str(e):
+                busy_total.inc(*self.labels)
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            statement_seconds.observe(seconds, *self.labels)
+            add_phase('query', seconds)
+
+    def execute(self, sql, parameters=()):
+        self.labels = statement_labels(sql)
+        return self.timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        self.labels = statement_labels(sql)
+        return self.timed(super().executemany, sql, parameters)
+
+    def fetchone(self):
+        return self.timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self.timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self.timed(super().fetchall)
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+# Define a class sampling the stacks of every thread at a fixed interval, for finding where time goes in production.
+# It only runs between start() and stop(), so it costs nothing while it is off.
+class SamplingProfiler:
+    def __init__(self, max_stacks=10000):
+        self.lock = threading.Lock()
+        self.max_stacks = max_stacks
+        self.thread = None
+        self.stopping = threading.Event()
+        self.interval = None
+        self.samples = 0
+        self.stacks = {}
+
+    def running(self):
+        return self.thread is not None
+
+    def start(self, interval):
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.interval = interval
+            self.samples = 0
+            self.stacks = {}
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return False
+        self.stopping.set()
+        thread.join()
+        return True
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                self.samples += 1
+                for thread_id, frame in frames.items():
+                    if thread_id == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append('%s:%s:%d' % (frame.f_code.co_filename.rsplit('/', 1)[-1], frame.f_code.co_name, frame.f_lineno))
+                        frame = frame.f_back
+                    key = ';'.join(reversed(stack))
+                    if key in self.stacks or len(self.stacks) < self.max_stacks:
+                        self.stacks[key] = self.stacks.get(key, 0) + 1
+            del frames
+
+    # Get the samples in the folded format read by flame graph tools (one "frame;frame;frame count" line per stack)
+    def folded(self):
+        with self.lock:
+            return ''.join('%s %d\n' % (stack, count) for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]))
+
+    def stats(self):
+        with self.lock:
+            return {'running': self.thread is not None, 'interval': self.interval, 'samples': self.samples, 'stacks': len(self.stacks)}
+
+profiler = SamplingProfiler()
+
+# Define a function to render every metric in the Prometheus text format
+def render(extra=()):
+    lines = []
+    for metric in (requests_total, request_seconds, phase_seconds, response_bytes, statement_seconds, busy_total):
+        lines.extend(metric.render())
+    for name, kind, help, value in extra:
+        lines.extend(render_value(name, kind, help, value))
+    return '\n'.join(lines) + '\n'
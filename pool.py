@@ -0,0 +1,189 @@
+import contextlib
+import queue
+import sqlite3
+import threading
+import time
+
+# fcntl is only needed to share the writer between processes, which is only supported on Unix
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Define an exception for when no connection became free in time
+class PoolTimeout(Exception):
+    pass
+
+# Define a class managing the connections to a tree database: a bounded pool of read-only connections and
+# a single writer connection, so that readers never queue behind the writer (the database runs in WAL mode)
+# With write_lock set, the writer also takes a lock file shared with the other processes serving the database, so that
+# they queue for it in turn instead of retrying against SQLite's lock.
+class ConnectionPool:
+    def __init__(self, path, size=8, timeout=10.0, cache_size=16384, mmap_size=268435456, busy_timeout=5000, cached_statements=256, writer_synchronous='NORMAL', factory=sqlite3.Connection, write_lock=False):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.writer_synchronous = writer_synchronous
+        self.factory = factory
+        if write_lock and fcntl is None:
+            raise RuntimeError('Sharing a database between processes needs fcntl, which is not available on this platform')
+        self.write_lock_path = path + '-writelock' if write_lock else None
+        self.write_lock_file = None
+        self.lock = threading.Lock()
+        self.readers = queue.LifoQueue()
+        self.open_readers = 0
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.counters = {'reader_checkouts': 0, 'reader_waits': 0, 'reader_wait_seconds': 0.0,
+                         'writer_checkouts': 0, 'writer_wait_seconds': 0.0, 'write_lock_wait_seconds': 0.0,
+                         'connections_opened': 0, 'connections_recovered': 0}
+
+    # Open a connection and apply the pragmas every connection should have
+    def connect(self, readonly):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout / 1000, check_same_thread=False,
+                               cached_statements=self.cached_statements, factory=self.factory)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = %s" % ("NORMAL" if readonly else self.writer_synchronous))
+        conn.execute("PRAGMA busy_timeout = %d" % self.busy_timeout)
+        conn.execute("PRAGMA cache_size = -%d" % self.cache_size)
+        conn.execute("PRAGMA mmap_size = %d" % self.mmap_size)
+        if readonly:
+            conn.execute("PRAGMA query_only = 1")
+        with self.lock:
+            self.counters['connections_opened'] += 1
+        return conn
+
+    # Make sure a pooled connection still works, replacing it if it was closed or went stale
+    def check(self, conn, readonly):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            if conn.in_transaction:
+                conn.rollback()
+            return conn
+        except sqlite3.Error:
+            with contextlib.suppress(sqlite3.Error):
+                conn.close()
+            with self.lock:
+                self.counters['connections_recovered'] += 1
+            return self.connect(readonly)
+
+    def acquire_reader(self):
+        with self.lock:
+            self.counters['reader_checkouts'] += 1
+        try:
+            return self.check(self.readers.get_nowait(), True)
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.open_readers < self.size
+            if can_open:
+                self.open_readers += 1
+        if can_open:
+            try:
+                return self.connect(True)
+            except BaseException:
+                with self.lock:
+                    self.open_readers -= 1
+                raise
+        # every reader is in use, so wait for one to come back
+        start = time.perf_counter()
+        try:
+            conn = self.readers.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout('No database connection became free within %gs' % self.timeout)
+        finally:
+            with self.lock:
+                self.counters['reader_waits'] += 1
+                self.counters['reader_wait_seconds'] += time.perf_counter() - start
+        return self.check(conn, True)
+
+    def release_reader(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self.readers.put(conn)
+
+    def acquire_writer(self):
+        start = time.perf_counter()
+        if not self.writer_lock.acquire(timeout=self.timeout):
+            raise PoolTimeout('The database writer did not become free within %gs' % self.timeout)
+        with self.lock:
+            self.counters['writer_checkouts'] += 1
+            self.counters['writer_wait_seconds'] += time.perf_counter() - start
+        try:
+            self.lock_writes()
+        except BaseException:
+            self.writer_lock.release()
+            raise
+        try:
+            self.writer = self.check(self.writer, False) if self.writer else self.connect(False)
+        except BaseException:
+            self.unlock_writes()
+            self.writer_lock.release()
+            raise
+        return self.writer
+
+    def release_writer(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        finally:
+            self.unlock_writes()
+            self.writer_lock.release()
+
+    # Take the lock file shared with the other processes (a no-op without write_lock). The kernel queues the waiting
+    # processes, so each write only waits for the ones ahead of it.
+    def lock_writes(self):
+        if self.write_lock_path is None:
+            return
+        if self.write_lock_file is None:
+            self.write_lock_file = open(self.write_lock_path, 'a')
+        start = time.perf_counter()
+        fcntl.flock(self.write_lock_file, fcntl.LOCK_EX)
+        with self.lock:
+            self.counters['write_lock_wait_seconds'] += time.perf_counter() - start
+
+    def unlock_writes(self):
+        if self.write_lock_file is not None:
+            fcntl.flock(self.write_lock_file, fcntl.LOCK_UN)
+
+    # Context managers for short-lived use outside of a request
+    @contextlib.contextmanager
+    def reader(self):
+        conn = self.acquire_reader()
+        try:
+            yield conn
+        finally:
+            self.release_reader(conn)
+
+    @contextlib.contextmanager
+    def write(self):
+        conn = self.acquire_writer()
+        try:
+            yield conn
+        finally:
+            self.release_writer(conn)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, size=self.size, open_readers=self.open_readers,
+                        idle_readers=self.readers.qsize(), writer_busy=self.writer_lock.locked())
+
+    def close(self):
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self.lock:
+            self.open_readers = 0
+        with self.writer_lock:
+            if self.writer:
+                self.writer.close()
+                self.writer = None
+            if self.write_lock_file is not None:
+                self.write_lock_file.close()
+                self.write_lock_file = None
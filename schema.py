@@ -0,0 +1,153 @@
+import contextlib
+import sqlite3
+
+from merkle import rebuild_hashes
+
+# Define a function to get the (parent_id, child_id) edges of a node from its comma-joined id lists
+def node_edges(node_id, parent_ids, children_ids):
+    edges = [(parent_id, node_id) for parent_id in (parent_ids or '').split(',') if parent_id]
+    edges += [(node_id, child_id) for child_id in (children_ids or '').split(',') if child_id]
+    return edges
+
+# Define a function to give a tree database a new token, so that clients drop the versions they have cached
+# (anything that changes the nodes without going through the change log, such as an import, must call it)
+def rotate_token(c):
+    c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('token', lower(hex(randomblob(6))))")
+
+# Define a function to get the version of a tree: the sequence number of its last change, or, if its history starts
+# after changes it doesn't hold (such as in a snapshot load or an import that replaced a database, see admin.py), the
+# number its changes carry on from
+def tree_version(c):
+    c.execute("SELECT COALESCE(MAX(seq), 0) FROM (SELECT MAX(seq) AS seq FROM history UNION ALL SELECT seq FROM sqlite_sequence WHERE name = 'history')")
+    return c.fetchone()[0]
+
+# Define a function to check whether a tree database has a full-text index
+def has_search_index(c):
+    return c.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes_fts'").fetchone() is not None
+
+def create_search_triggers(c):
+    c.execute('''CREATE TRIGGER IF NOT EXISTS nodes_fts_insert AFTER INSERT ON nodes BEGIN
+                     INSERT INTO nodes_fts (rowid, text) VALUES (new.rowid, new.text);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS nodes_fts_delete AFTER DELETE ON nodes BEGIN
+                     INSERT INTO nodes_fts (nodes_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS nodes_fts_update AFTER UPDATE OF text ON nodes BEGIN
+                     INSERT INTO nodes_fts (nodes_fts, rowid, text) VALUES ('delete', old.rowid, old.text);
+                     INSERT INTO nodes_fts (rowid, text) VALUES (new.rowid, new.text);
+                 END''')
+
+# Define a context manager for loading many nodes into an empty tree: the full-text index is built in one pass at the
+# end, which is much faster than updating it node by node (a load into a tree that has nodes keeps the triggers).
+# The hashes of the nodes are computed at the end too, since loads don't go through the write routes.
+@contextlib.contextmanager
+def bulk_load(c):
+    deferred = has_search_index(c) and not c.execute("SELECT 1 FROM nodes LIMIT 1").fetchone()
+    if deferred:
+        for name in ('nodes_fts_insert', 'nodes_fts_delete', 'nodes_fts_update'):
+            c.execute("DROP TRIGGER %s" % name)
+    yield
+    if deferred:
+        c.execute("INSERT INTO nodes_fts (nodes_fts) VALUES ('rebuild')")
+        create_search_triggers(c)
+    rebuild_hashes(c)
+
+# Define a function to create the tables of a tree database and migrate older databases
+# Everything runs in one transaction that takes the write lock before looking at the database, so that when several
+# processes open it at once, one of them migrates it and the others find it migrated (and a migration that fails
+# leaves the database as it was).
+def init_db(tree_file, timeout=5.0):
+    conn = sqlite3.connect(tree_file, timeout=timeout)
+    try:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        create_tables(c)
+        conn.commit()
+    finally:
+        conn.close()
+
+def create_tables(c):
+    # Create the nodes table
+    c.execute('''CREATE TABLE IF NOT EXISTS nodes
+                 (id TEXT PRIMARY KEY,
+                  parent_ids TEXT,
+                  children_ids TEXT,
+                  text TEXT,
+                  author TEXT,
+                  timestamp TEXT)''')
+
+    # Create the history table (an append-only change log of node ids, timestamps, and operations,
+    # ordered by a monotonic sequence number that clients use as their sync cursor)
+    c.execute('''CREATE TABLE IF NOT EXISTS history
+                 (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                  id TEXT,
+                  timestamp TEXT,
+                  operation TEXT,
+                  author TEXT)''')
+
+    # Create the edges table (one row per parent -> child link, indexed both ways)
+    c.execute('''CREATE TABLE IF NOT EXISTS edges
+                 (parent_id TEXT,
+                  child_id TEXT,
+                  PRIMARY KEY (parent_id, child_id)) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS edges_child ON edges (child_id, parent_id)")
+
+    # Migrate databases created before the edges table existed
+    if c.execute("PRAGMA user_version").fetchone()[0] < 1:
+        for node_id, parent_ids, children_ids in c.execute("SELECT id, parent_ids, children_ids FROM nodes").fetchall():
+            c.executemany("INSERT OR IGNORE INTO edges (parent_id, child_id) VALUES (?, ?)",
+                          node_edges(node_id, parent_ids, children_ids))
+        c.execute("PRAGMA user_version = 1")
+
+    # Migrate databases whose history table was keyed on the node id (which only allowed one operation per node)
+    if c.execute("PRAGMA user_version").fetchone()[0] < 2:
+        if 'seq' not in [column[1] for column in c.execute("PRAGMA table_info(history)").fetchall()]:
+            c.execute("ALTER TABLE history RENAME TO history_old")
+            c.execute('''CREATE TABLE history
+                         (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                          id TEXT,
+                          timestamp TEXT,
+                          operation TEXT,
+                          author TEXT)''')
+            c.execute("INSERT INTO history (id, timestamp, operation, author) SELECT id, timestamp, operation, author FROM history_old ORDER BY rowid")
+            c.execute("DROP TABLE history_old")
+        c.execute("PRAGMA user_version = 2")
+    c.execute("CREATE INDEX IF NOT EXISTS history_node ON history (id, seq)")
+    c.execute("CREATE INDEX IF NOT EXISTS history_author ON history (author, seq)")
+    c.execute("CREATE INDEX IF NOT EXISTS history_timestamp ON history (timestamp)")
+
+    # Create the text_versions table, holding the text that each update of a node replaced as a delta from the new text
+    # (see text_delta.py), keyed by the version of the node it rebuilds
+    c.execute('''CREATE TABLE IF NOT EXISTS text_versions
+                 (id TEXT,
+                  seq INTEGER,
+                  delta TEXT,
+                  PRIMARY KEY (id, seq)) WITHOUT ROWID''')
+
+    # Create the hashes table, holding the content and subtree hashes of every node (see merkle.py), and compute them
+    # for databases that have nodes without them
+    c.execute('''CREATE TABLE IF NOT EXISTS hashes
+                 (id TEXT PRIMARY KEY,
+                  content_hash TEXT,
+                  subtree_hash TEXT) WITHOUT ROWID''')
+    if c.execute("SELECT 1 FROM nodes WHERE id NOT IN (SELECT id FROM hashes) LIMIT 1").fetchone():
+        rebuild_hashes(c)
+
+    # Create the meta table, holding the token that goes into the version tags of the tree
+    c.execute('''CREATE TABLE IF NOT EXISTS meta
+                 (key TEXT PRIMARY KEY,
+                  value TEXT)''')
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('token', lower(hex(randomblob(6))))")
+
+    # Create the full-text index of the node text (an FTS5 table reading its content from the nodes table, kept in sync
+    # by triggers). It is filled in from the nodes whenever its triggers are missing: when it is first created, and
+    # after a bulk load that didn't finish. Search is left out if SQLite lacks FTS5.
+    if not has_search_index(c):
+        try:
+            c.execute('''CREATE VIRTUAL TABLE nodes_fts USING fts5
+                         (text, content='nodes', tokenize='porter unicode61 remove_diacritics 2')''')
+        except sqlite3.OperationalError:
+            pass
+    if has_search_index(c) and not c.execute("SELECT 1 FROM sqlite_master WHERE name = 'nodes_fts_insert'").fetchone():
+        c.execute("INSERT INTO nodes_fts (nodes_fts) VALUES ('rebuild')")
+        create_search_triggers(c)
@@ -1,4 +1,5 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import sqlite3
 import threading
 import uuid
@@ -7,273 +8,1051 @@ import os
 import hashlib
 import json
 import time
+import queue
+
+from schema import has_search_index, init_db, node_edges, tree_version
+from snapshot import snapshot_chunks
+from compaction import (compact_history, compacted_horizon, latest_checkpoint, list_checkpoints, retention_horizon,
+                        write_checkpoint)
+from merkle import root_hashes, tree_hash, update_hashes
+from text_delta import DeltaError, apply_delta, check_delta, diff_texts, invert_delta
+from tree_index import TreeIndex
+from trees import TreeRegistry, load_tree_config
+from pool import ConnectionPool, PoolTimeout
+from writer import GroupCommitWriter, transaction
+from context_cache import ContextCache
+from compression import ResponseCache, choose_encoding, compress, compress_stream
+import metrics
+
+# Define a JSON provider that records the time spent serializing responses
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().dumps(obj, **kwargs)
+        finally:
+            metrics.add_phase('serialize', time.perf_counter() - start)
 
 app = Flask(__name__)
+app.json = TimedJSONProvider(app)
 
 # Load the environment variables
 dotenv.load_dotenv()
 TREE_FILE = os.getenv('TREE_FILE')
-TREE_JSON = os.getenv('TREE_JSON')
 TREE_ID = os.getenv('TREE_ID')
-SERVER_PASSWORD_HASH = hashlib.sha256(os.getenv('SERVER_PASSWORD').encode()).hexdigest()
+SERVER_PASSWORD = os.getenv('SERVER_PASSWORD')
+SERVER_PASSWORD_HASH = hashlib.sha256(SERVER_PASSWORD.encode()).hexdigest() if SERVER_PASSWORD else None
+TREES_CONFIG = os.getenv('TREES_CONFIG')
+TREES_OPEN_MAX = int(os.getenv('TREES_OPEN_MAX', 16))
 SERVER_PORT = os.getenv('SERVER_PORT')
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 1000))
+CHANGES_PAGE_SIZE = int(os.getenv('CHANGES_PAGE_SIZE', 1000))
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', 20))
+EVENTS_QUEUE_SIZE = int(os.getenv('EVENTS_QUEUE_SIZE', 1000))
+EVENTS_KEEPALIVE = float(os.getenv('EVENTS_KEEPALIVE', 15))
+EVENTS_POLL_TIMEOUT = float(os.getenv('EVENTS_POLL_TIMEOUT', 30))
+POOL_SIZE = int(os.getenv('POOL_SIZE', 8))
+POOL_TIMEOUT = float(os.getenv('POOL_TIMEOUT', 10))
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', 16384))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 268435456))
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))
+GROUP_COMMIT = os.getenv('GROUP_COMMIT', '').lower() in ('1', 'true', 'yes')
+GROUP_COMMIT_WINDOW = float(os.getenv('GROUP_COMMIT_WINDOW', 5)) / 1000
+GROUP_COMMIT_MAX_BATCH = int(os.getenv('GROUP_COMMIT_MAX_BATCH', 256))
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+MAX_DEPTH = int(os.getenv('MAX_DEPTH', 100000))
+TREE_INDEX = os.getenv('TREE_INDEX', '').lower() in ('1', 'true', 'yes')
+TREE_INDEX_CACHE_SIZE = int(os.getenv('TREE_INDEX_CACHE_SIZE', 10000))
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 0))
+PROFILER_INTERVAL_MS = float(os.getenv('PROFILER_INTERVAL_MS', 10))
+WORKERS = int(os.getenv('WORKERS', 1))
+SYNC_INTERVAL = float(os.getenv('SYNC_INTERVAL_MS', 100)) / 1000
+SYNC_INDEX_MAX = int(os.getenv('SYNC_INDEX_MAX', 10000))
+HISTORY_KEEP_COUNT = int(os.getenv('HISTORY_KEEP_COUNT', 0))
+HISTORY_KEEP_DAYS = float(os.getenv('HISTORY_KEEP_DAYS', 0))
+CHECKPOINT_INTERVAL = int(os.getenv('CHECKPOINT_INTERVAL', 0))
+CHECKPOINT_KEEP = int(os.getenv('CHECKPOINT_KEEP', 2))
+MAINTENANCE_INTERVAL = float(os.getenv('MAINTENANCE_INTERVAL', 300))
+CONTEXT_CACHE_CHARS = int(os.getenv('CONTEXT_CACHE_CHARS', 4000000))
 
-# If TREE_JSON is specified, delete the existing database
-if TREE_JSON:
-    if os.path.exists(TREE_JSON):
-        # Delete the existing database
-        if os.path.exists(TREE_FILE):
-            os.remove(TREE_FILE)
-
-# Create the nodes table
-conn = sqlite3.connect(TREE_FILE)
-c = conn.cursor()
-c.execute('''CREATE TABLE IF NOT EXISTS nodes
-             (id TEXT PRIMARY KEY,
-              parent_ids TEXT,
-              children_ids TEXT,
-              text TEXT,
-              author TEXT,
-              timestamp TEXT)''')
-conn.commit()
-conn.close()
-
-# Create the history table (just node ids, timestamps, and operations)
-conn = sqlite3.connect(TREE_FILE)
-c = conn.cursor()
-c.execute('''CREATE TABLE IF NOT EXISTS history
-             (id TEXT PRIMARY KEY,
-              timestamp TEXT,
-              operation TEXT,
-              author TEXT)''')
-
-# If TREE_JSON exists, load it into the database
-if TREE_JSON:
-    if os.path.exists(TREE_JSON):
-        with open(TREE_JSON, encoding='utf-8') as f:
-            tree_json = json.load(f)
-            # print(tree_json)
-
-            # get current timestamp
-            timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            conn = sqlite3.connect(TREE_FILE)
-            c = conn.cursor()
-            for node in tree_json['nodes']:
-                node_data = tree_json['nodes'][node]
-                # get parent id(s)
-                if 'parentIds' in node_data:
-                    parent_ids = ','.join(node_data['parentIds'])
-                else:
-                    parent_ids = node_data['parentId']
-                # get children id(s)
-                if 'childrenIds' in node_data:
-                    children_ids = ','.join(node_data['childrenIds'])
-                else:
-                    # we have to find the children ids from the tree_json
-                    children_ids = []
-                    for child in tree_json['nodes']:
-                        if 'parentIds' in tree_json['nodes'][child]:
-                            if node in tree_json['nodes'][child]['parentIds']:
-                                children_ids.append(child)
-                    children_ids = ','.join(children_ids)
-                # insert the node into the database
-                c.execute("INSERT INTO nodes (id, parent_ids, children_ids, text, author, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-                            (node, parent_ids, children_ids, node_data['text'], "Morpheus", timestamp))
-            conn.commit()
-            conn.close()
-
-# Define a function to check if a user is authorized to make changes to the database
+# Define a function to check if a user is authorized to make changes to the tree named by the Tree-Id header
 def is_authorized(key):
+    start = time.perf_counter()
+    password_hash = trees.password_hash(request.headers.get('Tree-Id'))
     # Check if the key is valid
-    if hashlib.sha256(key.encode()).hexdigest() == SERVER_PASSWORD_HASH:
-        return True
-    else:
-        return False
+    authorized = password_hash is not None and hashlib.sha256(key.encode()).hexdigest() == password_hash
+    metrics.add_phase('auth', time.perf_counter() - start)
+    return authorized
 
-# Define a function to create a new connection and cursor object
+# Define a function to get the tree named by the Tree-Id header (opening it if needed), or None if it isn't hosted here
+# The tree stays open at least until the request is finished.
+def get_tree():
+    if 'tree' not in g:
+        tree = trees.acquire(request.headers.get('Tree-Id'))
+        if tree is None:
+            return None
+        g.tree = tree
+        # switch to a new database file if an import has replaced the old one; the request then sticks to one file
+        tree.check_file()
+        g.pool = tree.pool
+        # catch up with the writes of the other worker processes before answering from anything kept in memory
+        if WORKERS > 1:
+            db, c = get_db()
+            tree.sync(c)
+    return g.tree
+
+# Define a function to get a read-only connection and cursor to the tree of the current request
 def get_db():
-    if not hasattr(threading.current_thread(), 'sqlite_db'):
-        threading.current_thread().sqlite_db = sqlite3.connect('tree.db')
-    return threading.current_thread().sqlite_db, threading.current_thread().sqlite_db.cursor()
+    if 'db' not in g:
+        g.db = g.pool.acquire_reader()
+    return g.db, g.db.cursor()
+
+# Define a function to get the writer connection and cursor to the tree of the current request
+# (only one request holds the writer at a time, so writes never fight over SQLite's lock)
+def get_writer():
+    if 'writer' not in g:
+        g.writer = g.pool.acquire_writer()
+    return g.writer, g.writer.cursor()
 
-# Define a function to close the connection when the request is finished
+# Define a function to return the connections to the pool and release the tree when the request is finished
 @app.teardown_appcontext
 def close_db(error):
-    if hasattr(threading.current_thread(), 'sqlite_db'):
-        threading.current_thread().sqlite_db.close()
+    tree = g.pop('tree', None)
+    if tree is None:
+        return
+    pool = g.pop('pool', None)
+    db = g.pop('db', None)
+    if db is not None:
+        pool.release_reader(db)
+    writer = g.pop('writer', None)
+    if writer is not None:
+        pool.release_writer(writer)
+    trees.release(tree.tree_id)
+
+# Define an error handler for when the database is too busy to hand out a connection in time
+@app.errorhandler(PoolTimeout)
+def database_busy(error):
+    return jsonify({'success': False, 'error': 'Database busy'}), 503
+
+# Define a function to convert a row from the nodes table into a dictionary
+def node_to_dict(node):
+    return {
+        'id': node[0],
+        'parent_ids': node[1].split(',') if node[1] else None,
+        'children_ids': node[2].split(',') if node[2] else None,
+        'text': node[3],
+        'author': node[4],
+        'timestamp': node[5]
+    }
+
+# Define a function to convert a row from the history table into a dictionary
+# (rows are selected as id, timestamp, operation, author, seq)
+def history_to_dict(h):
+    return {
+        'node_id': h[0],
+        'timestamp': h[1],
+        'operation': h[2],
+        'author': h[3],
+        'seq': h[4]
+    }
+
+# Define a function to get the page size requested by the client, capped at CHANGES_PAGE_SIZE
+def page_limit(default=CHANGES_PAGE_SIZE):
+    return max(1, min(request.args.get('limit', default, type=int), CHANGES_PAGE_SIZE))
+
+# Define a function to get a page of changes after a sequence number, with the current state of each node
+# (deleted nodes come back as tombstones with a null node)
+# With delta set, the text of a node the client already had at `since` is sent as a delta from that version, when it
+# can be rebuilt (see delta_node); later changes to the same node in the page get an empty delta from the first.
+def get_changes(c, since, limit, delta=False):
+    c.execute("""SELECT history.id, history.timestamp, history.operation, history.author, history.seq, nodes.*
+                 FROM history LEFT JOIN nodes ON nodes.id = history.id
+                 WHERE history.seq > ? ORDER BY history.seq LIMIT ?""", (since, limit))
+    changes = []
+    for row in c.fetchall():
+        change = history_to_dict(row)
+        change['node'] = node_to_dict(row[5:]) if row[5] is not None else None
+        changes.append(change)
+    if delta:
+        node_ids = list({change['node_id'] for change in changes if change['node'] is not None})
+        c.execute("SELECT id, MAX(seq) FROM history WHERE id IN (SELECT value FROM json_each(?)) GROUP BY id",
+                  (json.dumps(node_ids),))
+        versions = dict(c.fetchall())
+        known = {}
+        for change in changes:
+            node = change['node']
+            if node is None:
+                continue
+            if node['id'] not in known:
+                c.execute("SELECT MAX(seq) FROM text_versions WHERE id = ? AND seq <= ?", (node['id'], since))
+                known[node['id']] = c.fetchone()[0]
+            if known[node['id']] is None:
+                node['version'] = versions[node['id']]
+            else:
+                delta_node(c, node, versions[node['id']], known[node['id']])
+            known[node['id']] = versions[node['id']]
+    return changes
+
+# Define a function to check whether a change feed cursor is from before the compacted part of the history, in which
+# case the changes it missed are gone and the client has to start again from a snapshot (or the latest checkpoint).
+# Returns the error to send back, or None if the cursor is still good.
+def expired_cursor(tree, c, since):
+    horizon = compacted_horizon(c)
+    if since is None or since >= horizon - 1:
+        return None
+    return {'success': False, 'error': 'Cursor expired', 'horizon': horizon,
+            'checkpoint': latest_checkpoint(tree.checkpoint_dir)}
+
+# Define a function to get the conditions on the history requested by the client (by node, author, and a time range
+# from `from` up to but not including `to`), as a WHERE clause and its parameters
+def history_filter():
+    conditions = []
+    params = []
+    for arg, condition in (('node', "id = ?"), ('author', "author = ?"), ('from', "timestamp >= ?"), ('to', "timestamp < ?")):
+        if request.args.get(arg) is not None:
+            conditions.append(condition)
+            params.append(request.args.get(arg))
+    return ' AND '.join(conditions), params
+
+# Define a function to check whether the client asked for a streamed response
+# (NDJSON via the Accept header, or an incrementally written JSON document via ?stream=1)
+def stream_format():
+    stream = request.args.get('stream', '').lower()
+    # unless the query asks for NDJSON, the Accept header can change the format, so caches have to key on it
+    if stream != 'ndjson':
+        g.vary_accept = True
+    if stream == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', ''):
+        return 'ndjson'
+    if stream in ('1', 'true', 'json'):
+        return 'json'
+    return None
+
+# Define a function to stream the rows of a query in chunks instead of building the whole response in memory
+# In JSON mode the document has the same shape as the buffered response; if keyed is set, items are written
+# as an object keyed by their 'id' (which is then left out of the item itself). In NDJSON mode every item is
+# written on its own line, followed by a final line holding the success flag and the row count.
+def stream_rows(tree, fmt, key, query, params, to_item, keyed=False):
+    def generate():
+        # the generator outlives the request, so it holds its own connection while it runs
+        with tree.pool.reader() as db:
+            c = db.cursor()
+            c.execute(query, params)
+            count = 0
+            if fmt == 'json':
+                yield '{"success": true, "%s": %s' % (key, '{' if keyed else '[')
+            while True:
+                rows = c.fetchmany(STREAM_CHUNK_SIZE)
+                if not rows:
+                    break
+                start = time.perf_counter()
+                items = []
+                for row in rows:
+                    item = to_item(row)
+                    if fmt == 'ndjson':
+                        items.append(json.dumps(item) + '\n')
+                    elif keyed:
+                        item_id = item.pop('id')
+                        items.append(('' if count == 0 else ', ') + json.dumps(item_id) + ': ' + json.dumps(item))
+                    else:
+                        items.append(('' if count == 0 else ', ') + json.dumps(item))
+                    count += 1
+                metrics.add_phase('serialize', time.perf_counter() - start)
+                yield ''.join(items)
+            if fmt == 'json':
+                yield '%s}' % ('}' if keyed else ']')
+            else:
+                yield json.dumps({'success': True, 'count': count}) + '\n'
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return Response(stream_with_context(metrics.timed_chunks(generate(), metrics.request_state.phases)), mimetype=mimetype)
+
+# Define a class for a subscriber to the change feed, with a bounded queue of pending changes
+# If the queue fills up the subscriber is marked as overflowed and should resume from its cursor
+class Subscriber:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+    # Called by the hub for every change (on the thread that committed it)
+    def put(self, change):
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            self.overflowed = True
+
+# Define a class to fan out committed changes to the subscribers of the change feed
+class EventHub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        # the last sequence number that was published, or None while there are no subscribers
+        self.last_seq = None
+
+    # Add a subscriber (a new Subscriber unless one is given), returning it with the sequence number it follows on from
+    def subscribe(self, c, subscriber=None):
+        subscriber = subscriber or Subscriber()
+        with self.lock:
+            if self.last_seq is None:
+                self.last_seq = tree_version(c)
+            self.subscribers.add(subscriber)
+            return subscriber, self.last_seq
+
+    # Cut every subscriber off (they reconnect from their cursors) and carry on from a sequence number, when the tree
+    # switches to another database file
+    def cut_off(self, seq):
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.overflowed = True
+            if self.last_seq is not None:
+                self.last_seq = seq
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            if not self.subscribers:
+                self.last_seq = None
+
+    # Push the changes committed since the last publish to every subscriber (a no-op when nobody is listening)
+    def publish(self, c):
+        with self.lock:
+            if not self.subscribers:
+                return
+            while True:
+                changes = get_changes(c, self.last_seq, CHANGES_PAGE_SIZE)
+                for change in changes:
+                    for subscriber in self.subscribers:
+                        if not subscriber.overflowed:
+                            subscriber.put(change)
+                if changes:
+                    self.last_seq = changes[-1]['seq']
+                if len(changes) < CHANGES_PAGE_SIZE:
+                    break
+
+# Define a class holding everything the server keeps for one tree: its connections, in-memory index, change feed,
+# version and cached responses. Every tree has its own writer, so a busy tree never holds up writes to the others.
+# When WORKERS is over 1, several processes serve the same database: they take turns at writing through a lock file,
+# and each keeps its in-memory state up to date by following the change log (see sync).
+class Tree:
+    def __init__(self, tree_id, path):
+        self.tree_id = tree_id
+        self.path = path
+        # Keep the structure of the tree in memory if TREE_INDEX is set (it is loaded from the database on first use)
+        self.index = TreeIndex(TREE_INDEX_CACHE_SIZE) if TREE_INDEX else None
+        self.hub = EventHub()
+        self.sync_lock = threading.Lock()
+        # Cache the full tree response, in each encoding it has been asked for, until the next write
+        self.full_tree_cache = ResponseCache()
+        # Cache the hashes of the roots for /reconcile until the next write
+        self.roots_cache = ResponseCache()
+        # Cache the text of the paths from the root to the nodes that contexts were last asked for
+        self.context_cache = ContextCache(CONTEXT_CACHE_CHARS, MAX_DEPTH)
+        # Checkpoints of the tree are written next to its database
+        self.checkpoint_dir = path + '-checkpoints'
+        self.open()
+        if WORKERS > 1:
+            start_background(follow_changes)
+        if CHECKPOINT_INTERVAL or HISTORY_KEEP_COUNT or HISTORY_KEEP_DAYS:
+            start_background(maintain_trees)
+
+    # Open the database file that the path of the tree points to (which `admin.py import` can point at a new one)
+    def open(self):
+        self.file = os.path.realpath(self.path)
+        # Open a bounded pool of read-only connections and a dedicated writer connection to the tree database
+        # (with group commit on, each batch is worth a full sync, since callers are only acknowledged once it is durable)
+        self.pool = ConnectionPool(self.file, POOL_SIZE, POOL_TIMEOUT, SQLITE_CACHE_SIZE, SQLITE_MMAP_SIZE, SQLITE_BUSY_TIMEOUT,
+                                   writer_synchronous='FULL' if GROUP_COMMIT else 'NORMAL', factory=metrics.TimedConnection,
+                                   write_lock=WORKERS > 1)
+        # Create the tables (migrating older databases). The other workers opening the tree wait on the lock file
+        # meanwhile, however long a migration takes, rather than giving up after the busy timeout.
+        self.pool.lock_writes()
+        try:
+            init_db(self.file, SQLITE_BUSY_TIMEOUT / 1000)
+        finally:
+            self.pool.unlock_writes()
+        stat = os.stat(self.file)
+        self.file_id = (stat.st_dev, stat.st_ino)
+        # Keep the version of the tree (its last change sequence number) in memory, so that conditional reads can be
+        # answered without touching the database. Version tags also carry the token of the database, which imports
+        # change since they don't go through the change log.
+        with self.pool.reader() as conn:
+            self.etag_token = conn.execute("SELECT value FROM meta WHERE key = 'token'").fetchone()[0]
+            self.version = tree_version(conn.cursor())
+            self.searchable = has_search_index(conn.cursor())
+        # Funnel writes through a single group-commit writer thread if GROUP_COMMIT is set
+        self.group_writer = GroupCommitWriter(self.pool, GROUP_COMMIT_WINDOW, GROUP_COMMIT_MAX_BATCH, self.committed,
+                                              self.sync if WORKERS > 1 else None) if GROUP_COMMIT else None
+
+    # Switch to a new database file if the path of the tree has been pointed at one since it was opened (checked at the
+    # start of every request, for the cost of a stat). Requests already using the old file finish on it, and its
+    # connections are closed once they are done. Everything kept in memory about the old tree is dropped, and the
+    # subscribers to the change feed are cut off: they come back with cursors from before the new file's history,
+    # which have expired.
+    def check_file(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        if (stat.st_dev, stat.st_ino) == self.file_id:
+            return
+        with self.sync_lock:
+            stat = os.stat(self.path)
+            if (stat.st_dev, stat.st_ino) == self.file_id:
+                return
+            old_pool, old_group_writer = self.pool, self.group_writer
+            self.open()
+            self.forget()
+            self.hub.cut_off(self.version)
+        threading.Thread(target=self.retire, args=(old_pool, old_group_writer), name='retire-pool', daemon=True).start()
+
+    # Drop everything kept in memory about the tree
+    def forget(self):
+        if self.index is not None:
+            self.index.reset()
+        self.full_tree_cache.clear()
+        self.roots_cache.clear()
+        self.context_cache.clear()
+
+    # Close the connections to a database file the tree has switched away from, once the requests using it are done
+    # (anything they left in memory is dropped again afterwards)
+    def retire(self, pool, group_writer):
+        if group_writer is not None:
+            group_writer.close()
+        while True:
+            stats = pool.stats()
+            if stats['idle_readers'] == stats['open_readers'] and not stats['writer_busy']:
+                break
+            time.sleep(0.1)
+        pool.close()
+        with self.sync_lock:
+            self.forget()
+
+    # Get the in-memory tree index, loading it if needed (None if TREE_INDEX is not set)
+    def get_index(self, c):
+        if self.index is not None:
+            self.index.load(c)
+        return self.index
+
+    # Run after every commit: record the new tree version, drop cached responses, and notify the subscribers of the change feed
+    def committed(self, c):
+        if WORKERS > 1:
+            return self.sync(c)
+        seq = tree_version(c)
+        self.invalidate_contexts(c, self.version, seq)
+        self.version = seq
+        self.full_tree_cache.clear()
+        self.hub.publish(c)
+
+    # Catch up with the changes committed by other processes: refresh the nodes they touched in the index (or drop the
+    # index if there are too many), then move the version on, drop cached responses and notify the subscribers
+    def sync(self, c=None):
+        if c is None:
+            with self.pool.reader() as conn:
+                return self.sync(conn.cursor())
+        seq = tree_version(c)
+        if seq == self.version:
+            return
+        with self.sync_lock:
+            if seq <= self.version:
+                return
+            # the history this process hasn't seen may have been compacted, so the changes can't all be listed
+            compacted = self.version < compacted_horizon(c) - 1
+            if self.index is not None:
+                c.execute("SELECT DISTINCT id FROM history WHERE seq > ? AND seq <= ?", (self.version, seq))
+                node_ids = [row[0] for row in c.fetchall()]
+                if len(node_ids) > SYNC_INDEX_MAX or compacted:
+                    self.index.reset()
+                else:
+                    self.index.refresh(c, node_ids)
+            if compacted:
+                self.context_cache.clear()
+            else:
+                self.invalidate_contexts(c, self.version, seq)
+            self.version = seq
+            self.full_tree_cache.clear()
+            self.hub.publish(c)
+
+    # Drop the cached contexts that the changes between two versions of the tree may have affected (creates can't
+    # change the path to an existing node, so only updates and deletes are looked at)
+    def invalidate_contexts(self, c, version, seq):
+        if not self.context_cache.entries:
+            # there is nothing to drop, but a context being read right now mustn't be cached either
+            self.context_cache.clear()
+            return
+        c.execute("SELECT DISTINCT id FROM history WHERE seq > ? AND seq <= ? AND operation != 'create'", (version, seq))
+        self.context_cache.invalidate([row[0] for row in c.fetchall()])
+
+    # Write a checkpoint once CHECKPOINT_INTERVAL changes have been made since the last one, then compact the history
+    # that is past the retention limits (the horizon never passes the latest checkpoint, if there is one)
+    def maintain(self):
+        checkpoint_seq = latest_checkpoint(self.checkpoint_dir)
+        if CHECKPOINT_INTERVAL and self.version - (checkpoint_seq or 0) >= CHECKPOINT_INTERVAL:
+            with self.pool.reader() as conn:
+                checkpoint_seq = write_checkpoint(conn, self.checkpoint_dir, CHECKPOINT_KEEP)
+        if HISTORY_KEEP_COUNT or HISTORY_KEEP_DAYS:
+            with self.pool.write() as db:
+                c = db.cursor()
+                with transaction(db, c):
+                    compact_history(c, retention_horizon(c, HISTORY_KEEP_COUNT, HISTORY_KEEP_DAYS, checkpoint_seq))
+
+    # Get the version tag of the whole tree at a version
+    # The format of a streamed response goes into its tag, since it is another representation of the same version
+    def etag(self, version, fmt=None):
+        return '%s-%d-%s' % (self.etag_token, version, fmt) if fmt else '%s-%d' % (self.etag_token, version)
+
+    # A tree is only closed once nothing is using it: no subscribers to its change feed, no connections checked out
+    # (such as by a streamed response that outlived its request) and no writes queued
+    def idle(self):
+        stats = self.pool.stats()
+        return (not self.hub.subscribers and stats['idle_readers'] == stats['open_readers'] and not stats['writer_busy']
+                and (self.group_writer is None or self.group_writer.queue.empty()))
+
+    def close(self):
+        if self.group_writer is not None:
+            self.group_writer.close()
+        self.pool.close()
+
+# Define a function to start a background thread, once per process (threads don't survive a fork)
+background_lock = threading.Lock()
+background_pids = {}
+
+def start_background(target):
+    with background_lock:
+        if background_pids.get(target.__name__) == os.getpid():
+            return
+        background_pids[target.__name__] = os.getpid()
+    threading.Thread(target=target, name=target.__name__.replace('_', '-'), daemon=True).start()
+
+# Define a function following the writes of the other worker processes, so that the trees with subscribers to their
+# change feed hear about them even while no requests arrive
+def follow_changes():
+    while True:
+        time.sleep(SYNC_INTERVAL)
+        for tree_id in [tree.tree_id for tree in trees.open_trees() if tree.hub.subscribers]:
+            tree = trees.acquire_open(tree_id)
+            if tree is None:
+                continue
+            try:
+                tree.check_file()
+                tree.sync()
+            except Exception:
+                app.logger.exception('Could not follow the changes to tree %s', tree_id)
+            finally:
+                trees.release(tree_id)
+
+# Define a function checkpointing and compacting the history of the open trees every MAINTENANCE_INTERVAL seconds
+def maintain_trees():
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL)
+        for tree_id in [tree.tree_id for tree in trees.open_trees()]:
+            tree = trees.acquire_open(tree_id)
+            if tree is None:
+                continue
+            try:
+                tree.check_file()
+                tree.maintain()
+            except Exception:
+                app.logger.exception('Could not compact the history of tree %s', tree_id)
+            finally:
+                trees.release(tree_id)
+
+# Host the trees listed in TREES_CONFIG, keeping up to TREES_OPEN_MAX of them open, or just the one in TREE_FILE
+if TREES_CONFIG:
+    tree_config = load_tree_config(TREES_CONFIG)
+else:
+    tree_config = {TREE_ID: {'file': TREE_FILE, 'password_hash': SERVER_PASSWORD_HASH}}
+trees = TreeRegistry(tree_config, lambda tree_id, settings: Tree(tree_id, settings['file']), TREES_OPEN_MAX)
+
+# Define a function to answer a conditional GET with 304 Not Modified if the client's copy has the given tag
+# (returns None otherwise, and the tag is then set on the response). Compressed responses carry their encoding in
+# their tag too (see finish_response), so the client's copy may have the tag of the encoding it would be sent now.
+def not_modified(etag):
+    g.etag = etag
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    for tag in (etag, '%s-%s' % (etag, encoding)) if encoding else (etag,):
+        if request.if_none_match.contains(tag):
+            response = Response(status=304)
+            response.set_etag(tag)
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+# Slow requests are logged if they take longer than this (in seconds), or never if it is None
+slow_request_threshold = SLOW_REQUEST_MS / 1000 if SLOW_REQUEST_MS > 0 else None
+
+# Define a function to start timing a request
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    metrics.begin_request()
+
+# Define a function to record the metrics of a request once its response has been sent
+# (registered before finish_response so that it runs after it, and sees the compressed body)
+@app.after_request
+def record_request(response):
+    start = g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    method = request.method
+    request_path = request.full_path.rstrip('?')
+    status = response.status_code
+    phases = metrics.request_state.phases or {}
+    size = [response.content_length or 0]
+    if response.is_streamed:
+        def count_bytes(chunks):
+            try:
+                for chunk in chunks:
+                    size[0] += len(chunk) if isinstance(chunk, bytes) else len(chunk.encode())
+                    yield chunk
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+        response.response = count_bytes(response.response)
+    def finish():
+        seconds = time.perf_counter() - start
+        metrics.end_request()
+        metrics.requests_total.inc(route, method, str(status))
+        metrics.request_seconds.observe(seconds, route, method)
+        metrics.response_bytes.observe(size[0], route)
+        for phase, phase_seconds in phases.items():
+            metrics.phase_seconds.observe(phase_seconds, route, phase)
+        metrics.phase_seconds.observe(max(seconds - sum(phases.values()), 0.0), route, 'other')
+        if slow_request_threshold is not None and seconds >= slow_request_threshold:
+            app.logger.warning('Slow request: %s %s %d took %.3fs (%s), %d bytes', method, request_path, status, seconds,
+                               ', '.join('%s %.3fs' % item for item in sorted(phases.items())) or 'no phases', size[0])
+    response.call_on_close(finish)
+    return response
+
+# Define a function to compress a response if the client accepts it
+def compress_response(response):
+    if 'Content-Encoding' in response.headers or response.mimetype == 'text/event-stream':
+        return
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    if response.is_streamed:
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+            response.headers['Content-Encoding'] = encoding
+    elif response.content_length is not None and response.content_length >= COMPRESS_MIN_SIZE:
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            response.set_data(compress(response.get_data(), encoding))
+            response.headers['Content-Encoding'] = encoding
+
+# Define a function to compress a response and set its version tag, which gets the encoding of the body added to it
+# (every encoding of a response needs a strong tag of its own)
+@app.after_request
+def finish_response(response):
+    if g.pop('vary_accept', False):
+        response.vary.add('Accept')
+    etag = g.pop('etag', None)
+    if response.status_code == 200:
+        compress_response(response)
+        if etag:
+            encoding = response.headers.get('Content-Encoding')
+            response.set_etag('%s-%s' % (etag, encoding) if encoding else etag)
+    return response
+
+# Define a function to format a change as a Server-Sent Event
+def change_to_event(change):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (change['seq'], change['operation'], json.dumps(change))
+
+# Define a function to find which of a list of node ids exist in the database, with one set-based query
+def find_existing(c, node_ids):
+    c.execute("SELECT id FROM nodes WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(node_ids),))
+    return {row[0] for row in c.fetchall()}
+
+# Define a function to get the current text and version of a list of nodes, as a dict of [text, version] lists
+# (the version of a node is the sequence number of its last change)
+def node_versions(c, node_ids):
+    c.execute("""SELECT nodes.id, nodes.text, (SELECT COALESCE(MAX(seq), 0) FROM history WHERE history.id = nodes.id)
+                 FROM nodes WHERE nodes.id IN (SELECT value FROM json_each(?))""", (json.dumps(node_ids),))
+    return {row[0]: [row[1] or '', row[2]] for row in c.fetchall()}
+
+# Define a function to write checked text updates, given as (node_id, text, author, timestamp, delta) tuples where the
+# delta turns the new text back into the old one, and the current [text, version] of the nodes (which is kept up to
+# date, so a node can be updated more than once). The nodes table holds the full current text, and each text it
+# replaces is kept as its delta, keyed by the version it rebuilds. Returns the new version of every update.
+def write_text_updates(c, updates, current, timestamp):
+    # the history rows about to be inserted are numbered on from the last sequence number handed out
+    c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'history'")
+    row = c.fetchone()
+    seq = row[0] if row else 0
+    versions, text_versions = [], []
+    for node_id, text, author, node_timestamp, delta in updates:
+        seq += 1
+        text_versions.append((node_id, current[node_id][1], json.dumps(delta, separators=(',', ':'))))
+        current[node_id] = [text, seq]
+        versions.append(seq)
+    c.executemany("UPDATE nodes SET text = ?, author = ?, timestamp = ? WHERE id = ?",
+                  [(text, author, node_timestamp, node_id) for node_id, text, author, node_timestamp, _ in updates])
+    # Add the operations to the history table
+    c.executemany("INSERT INTO history (timestamp, id, operation, author) VALUES (?, ?, ?, ?)",
+                  [(timestamp, update[0], 'update', update[2]) for update in updates])
+    c.executemany("INSERT OR REPLACE INTO text_versions (id, seq, delta) VALUES (?, ?, ?)", text_versions)
+    update_hashes(c, {update[0] for update in updates})
+    return versions
+
+# Define a function to rebuild the text of a node at an earlier version from its current text, or None if that version
+# isn't kept (it is older than the first update made with text versions, or was compacted away)
+def text_at_version(c, node_id, text, version, current_version):
+    if version == current_version:
+        return text
+    c.execute("SELECT seq, delta FROM text_versions WHERE id = ? AND seq >= ? ORDER BY seq DESC", (node_id, version))
+    seq = None
+    for seq, delta in c.fetchall():
+        text = apply_delta(text, json.loads(delta))
+    return text if seq == version else None
+
+# Define a function to turn the full text of a node sent to a client into a delta from the version of it the client
+# has, if that version can be rebuilt (the full text is left in place otherwise)
+def delta_node(c, node, version, known_version):
+    base_text = text_at_version(c, node['id'], node['text'] or '', known_version, version)
+    if base_text is not None:
+        node['delta'] = diff_texts(base_text, node.pop('text') or '')
+        node['base'] = known_version
+    node['version'] = version
+    return node
+
+# Define a function to check a node sent by a client, returning an error message if it is invalid
+def check_node(node, fields):
+    if not isinstance(node, dict):
+        return 'Expected a node object'
+    for field in fields:
+        if not isinstance(node.get(field), str):
+            return 'Missing or invalid %s' % field
+    return None
+
+# Define a function to save a list of new nodes, returning a result for each of them
+# Every node is validated before anything is written, and nothing is written if any of them is invalid
+def write_creates(db, c, nodes, index):
+    rows, results = [], []
+    for node in nodes:
+        error = check_node(node, ('text', 'author', 'timestamp'))
+        if not error and 'parentIds' not in node and 'parentId' not in node:
+            error = 'Missing parentId'
+        if not error and 'parentIds' in node and not all(isinstance(parent_id, str) for parent_id in node['parentIds'] or []):
+            error = 'Invalid parentIds'
+        if not error and 'childrenIds' in node and not all(isinstance(child_id, str) for child_id in node['childrenIds'] or []):
+            error = 'Invalid childrenIds'
+        if not error and 'id' in node and not isinstance(node['id'], str):
+            error = 'Invalid id'
+        if error:
+            results.append({'id': node.get('id') if isinstance(node, dict) else None, 'success': False, 'error': error})
+            continue
+        # get parent id(s)
+        if 'parentIds' in node:
+            parent_ids = ','.join(node['parentIds'] or [])
+        else:
+            parent_ids = node['parentId']
+        # get children id(s)
+        children_ids = ','.join(node.get('childrenIds') or [])
+        # generate a new id for the node if it doesn't have one
+        node_id = node.get('id') or uuid.uuid4().hex
+        rows.append((node_id, parent_ids, children_ids, node['text'], node['author'], node['timestamp']))
+        results.append({'id': node_id, 'success': True})
+
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+    with transaction(db, c) as after_commit:
+        existing = find_existing(c, [row[0] for row in rows])
+        seen = set()
+        for result in results:
+            if result['success'] and (result['id'] in existing or result['id'] in seen):
+                result.update(success=False, error='Node already exists')
+            seen.add(result['id'])
+        if rows and all(result['success'] for result in results):
+            c.executemany("INSERT INTO nodes (id, parent_ids, children_ids, text, author, timestamp) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            c.executemany("INSERT OR IGNORE INTO edges (parent_id, child_id) VALUES (?, ?)",
+                          [edge for row in rows for edge in node_edges(row[0], row[1], row[2])])
+            # Add the operations to the history table
+            c.executemany("INSERT INTO history (timestamp, id, operation, author) VALUES (?, ?, ?, ?)",
+                          [(timestamp, row[0], 'create', row[4]) for row in rows])
+            update_hashes(c, [row[0] for row in rows])
+            if index is not None:
+                after_commit.append(lambda: index.add(rows))
+    return results
+
+# Define a function to update a list of existing nodes, returning a result for each of them
+# Every node is validated before anything is written; nodes that don't exist are reported as not updated
+def write_updates(db, c, nodes, index):
+    rows, results = [], []
+    for node in nodes:
+        error = check_node(node, ('id', 'text', 'author', 'timestamp'))
+        results.append({'id': node.get('id') if isinstance(node, dict) else None, 'success': not error})
+        if error:
+            results[-1]['error'] = error
+        else:
+            rows.append((node['text'], node['author'], node['timestamp'], node['id']))
+
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+    with transaction(db, c) as after_commit:
+        if rows and all(result['success'] for result in results):
+            current = node_versions(c, [row[3] for row in rows])
+            rows = [row for row in rows if row[3] in current]
+            for result in results:
+                result['updated'] = result['id'] in current
+            texts = {node_id: text for node_id, (text, version) in current.items()}
+            updates = []
+            for text, author, node_timestamp, node_id in rows:
+                updates.append((node_id, text, author, node_timestamp, diff_texts(text, texts[node_id])))
+                texts[node_id] = text
+            write_text_updates(c, updates, current, timestamp)
+            if index is not None:
+                after_commit.append(lambda: index.update([row[3] for row in rows]))
+    return results
+
+# Define a function to apply a list of patches to the text of existing nodes, returning a result for each of them
+# A patch gives the version of the node it was made against as `base`, and either the ops to apply to its text
+# (see text_delta.py) or the new `text`, which is diffed against the base. A patch whose base is no longer the latest
+# version of the node is rejected as a conflict, with the current version, and nothing is written if any patch fails.
+def write_patches(db, c, patches, index):
+    results = []
+    for patch in patches:
+        error = check_node(patch, ('id', 'author', 'timestamp'))
+        if not error and (not isinstance(patch.get('base'), int) or isinstance(patch.get('base'), bool)):
+            error = 'Missing or invalid base'
+        if not error and ('ops' in patch) == ('text' in patch):
+            error = 'Expected either ops or text'
+        if not error and 'text' in patch and not isinstance(patch['text'], str):
+            error = 'Invalid text'
+        if not error and 'ops' in patch:
+            try:
+                check_delta(patch['ops'])
+            except DeltaError as e:
+                error = 'Invalid ops: %s' % e
+        results.append({'id': patch.get('id') if isinstance(patch, dict) else None, 'success': not error})
+        if error:
+            results[-1]['error'] = error
+
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+    with transaction(db, c) as after_commit:
+        if results and all(result['success'] for result in results):
+            current = node_versions(c, [patch['id'] for patch in patches])
+            updates, seen = [], set()
+            for patch, result in zip(patches, results):
+                node_id = patch['id']
+                if node_id in seen:
+                    result.update(success=False, error='Node patched more than once')
+                    continue
+                seen.add(node_id)
+                if node_id not in current:
+                    result.update(success=False, error='Node not found')
+                    continue
+                text, version = current[node_id]
+                if patch['base'] != version:
+                    result.update(success=False, error='Conflict', version=version)
+                    continue
+                if 'ops' in patch:
+                    try:
+                        new_text = apply_delta(text, patch['ops'])
+                    except DeltaError as e:
+                        result.update(success=False, error='Invalid ops: %s' % e)
+                        continue
+                    delta = invert_delta(text, patch['ops'])
+                else:
+                    new_text = patch['text']
+                    delta = diff_texts(new_text, text)
+                updates.append((node_id, new_text, patch['author'], patch['timestamp'], delta))
+            if all(result['success'] for result in results):
+                for result, version in zip(results, write_text_updates(c, updates, current, timestamp)):
+                    result['version'] = version
+                if index is not None:
+                    after_commit.append(lambda: index.update([update[0] for update in updates]))
+    return results
+
+# Define a function to delete a list of nodes, returning a result for each of them
+# Every node is validated before anything is written; nodes that don't exist are reported as not deleted
+def write_deletes(db, c, nodes, author, index):
+    results = []
+    for node in nodes:
+        error = check_node(node, ('id',))
+        results.append({'id': node.get('id') if isinstance(node, dict) else None, 'success': not error})
+        if error:
+            results[-1]['error'] = error
+
+    timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+    with transaction(db, c) as after_commit:
+        if results and all(result['success'] for result in results):
+            existing = find_existing(c, [result['id'] for result in results])
+            for result in results:
+                result['deleted'] = result['id'] in existing
+            c.execute("SELECT parent_id FROM edges WHERE child_id IN (SELECT value FROM json_each(?))", (json.dumps(list(existing)),))
+            parent_ids = {row[0] for row in c.fetchall()}
+            c.executemany("DELETE FROM nodes WHERE id = ?", [(node_id,) for node_id in existing])
+            c.executemany("DELETE FROM edges WHERE parent_id = ? OR child_id = ?", [(node_id, node_id) for node_id in existing])
+            c.executemany("DELETE FROM text_versions WHERE id = ?", [(node_id,) for node_id in existing])
+            # Add the operations to the history table
+            c.executemany("INSERT INTO history (timestamp, id, operation, author) VALUES (?, ?, ?, ?)",
+                          [(timestamp, node_id, 'delete', author) for node_id in existing])
+            update_hashes(c, existing, parent_ids)
+            if index is not None:
+                after_commit.append(lambda: index.remove(existing))
+    return results
+
+# Define a function to run a write (a function taking a connection and cursor) against a tree's database
+# With GROUP_COMMIT set, the write is queued for the tree's group-commit writer and this waits until it has been committed
+def run_write(tree, fn):
+    if tree.group_writer is not None:
+        return tree.group_writer.submit(fn)
+    db, c = get_writer()
+    # with the write lock held, catch up with the other processes so that the write is checked against their writes too
+    if WORKERS > 1:
+        tree.sync(c)
+    result = fn(db, c)
+    tree.committed(c)
+    return result
+
+# Define a function to build the response of a single-node write route from its result
+def single_result(results):
+    if not results[0]['success']:
+        return jsonify({'success': False, 'error': results[0]['error']})
+    return jsonify({'success': True})
+
+# Define a function to build the response of a batch write route from its per-item results
+def batch_results(results):
+    if not all(result['success'] for result in results):
+        return jsonify({'success': False, 'error': 'Invalid nodes', 'results': results})
+    return jsonify({'success': True, 'results': results})
 
 # Define a route for saving a new node to the database
 @app.route('/nodes', methods=['POST'])
 def save_node():
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
-    db, c = get_db()
     data = request.get_json()
-    print(data)
-    # get parent id(s)
-    if 'parentIds' in data:
-        parent_ids = ','.join(data['parentIds'])
-    else:
-        parent_ids = data['parentId']
-    # get children id(s)
-    if 'childrenIds' in data:
-        children_ids = ','.join(data['childrenIds'])
-    else:
-        children_ids = ''
-    text = data['text']
-    author = data['author']
-    timestamp = data['timestamp']
-    if 'id' in data:
-        node_id = data['id']
-    else:
-        # generate a new id for the node
-        node_id = uuid.uuid4().hex
-    c.execute("INSERT INTO nodes (id, parent_ids, children_ids, text, author, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-                (node_id, parent_ids, children_ids, text, author, timestamp))
-    # Add the operation to the history table
-    c.execute("INSERT INTO history (timestamp, id, operation, author) VALUES (?, ?, ?, ?)",
-                (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()), node_id, 'create', author))
-    db.commit()
-    return jsonify({'success': True})
+    results = run_write(tree, lambda db, c: write_creates(db, c, [data], tree.index))
+    return single_result(results)
 
 # Define a route for saving a set of new nodes to the database
 @app.route('/nodes/batch', methods=['POST'])
 def save_nodes():
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
-    db, c = get_db()
     data = request.get_json()
-    for node in data:
-        # get parent id(s)
-        if 'parentIds' in node:
-            parent_ids = ','.join(node['parentIds'])
-        else:
-            parent_ids = node['parentId']
-        # get children id(s)
-        if 'childrenIds' in node:
-            children_ids = ','.join(node['childrenIds'])
-        else:
-            children_ids = ''
-        text = node['text']
-        author = node['author']
-        timestamp = node['timestamp']
-        if 'id' in node:
-            node_id = node['id']
-        else:
-            # generate a new id for the node
-            node_id = uuid.uuid4().hex
-        c.execute("INSERT INTO nodes (id, parent_ids, children_ids, text, author, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-                    (node_id, parent_ids, children_ids, text, author, timestamp))
-        # Add the operation to the history table
-        c.execute("INSERT INTO history (id, timestamp, operation, author) VALUES (?, ?, ?, ?)",
-                    (node_id, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()), 'create', author))
-    db.commit()
-    return jsonify({'success': True})
+    if not isinstance(data, list):
+        return jsonify({'success': False, 'error': 'Expected a list of nodes'})
+    results = run_write(tree, lambda db, c: write_creates(db, c, data, tree.index))
+    return batch_results(results)
 
 # Define a route for updating an existing node in the database
 @app.route('/nodes/<node_id>', methods=['PUT'])
 def update_node(node_id):
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
-    db, c = get_db()
     data = request.get_json()
-    text = data['text']
-    author = data['author']
-    timestamp = data['timestamp']
-    c.execute("UPDATE nodes SET text = ?, author = ?, timestamp = ? WHERE id = ?",
-              (text, author, timestamp, node_id))
-    # Add the operation to the history table
-    c.execute("INSERT INTO history (timestamp, id, operation, author) VALUES (?, ?, ?, ?)",
-                (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()), node_id, 'update', author))
-    db.commit()
-    return jsonify({'success': True})
+    if isinstance(data, dict):
+        data = dict(data, id=node_id)
+    results = run_write(tree, lambda db, c: write_updates(db, c, [data], tree.index))
+    return single_result(results)
 
 # Define a route for updating a set of existing nodes in the database
 @app.route('/nodes/batch', methods=['PUT'])
 def update_nodes():
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
-    db, c = get_db()
     data = request.get_json()
-    for node in data:
-        node_id = node['id']
-        text = node['text']
-        author = node['author']
-        timestamp = node['timestamp']
-        c.execute("UPDATE nodes SET text = ?, author = ?, timestamp = ? WHERE id = ?",
-                  (text, author, timestamp, node_id))
-        # Add the operation to the history table
-        c.execute("INSERT INTO history (timestamp, id, operation, author) VALUES (?, ?, ?, ?)",
-                    (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()), node_id, 'update', author))
-    db.commit()
-    return jsonify({'success': True})
+    if not isinstance(data, list):
+        return jsonify({'success': False, 'error': 'Expected a list of nodes'})
+    results = run_write(tree, lambda db, c: write_updates(db, c, data, tree.index))
+    return batch_results(results)
+
+# Define a route for patching the text of an existing node (see write_patches)
+@app.route('/nodes/<node_id>', methods=['PATCH'])
+def patch_node(node_id):
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    data = request.get_json()
+    if isinstance(data, dict):
+        data = dict(data, id=node_id)
+    result = run_write(tree, lambda db, c: write_patches(db, c, [data], tree.index))[0]
+    result.pop('id')
+    return jsonify(result)
+
+# Define a route for patching the text of a set of existing nodes
+@app.route('/nodes/batch', methods=['PATCH'])
+def patch_nodes():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    data = request.get_json()
+    if not isinstance(data, list):
+        return jsonify({'success': False, 'error': 'Expected a list of patches'})
+    results = run_write(tree, lambda db, c: write_patches(db, c, data, tree.index))
+    return batch_results(results)
 
 # Define a route for deleting a node from the database
 @app.route('/nodes/<node_id>', methods=['DELETE'])
 def delete_node(node_id):
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
-    db, c = get_db()
-    c.execute("DELETE FROM nodes WHERE id = ?", (node_id,))
-    # Add the operation to the history table
     author = request.args.get('author')
-    c.execute("INSERT INTO history (timestamp, id, operation, author) VALUES (?, ?, ?, ?)",
-                (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()), node_id, 'delete', author))
-    db.commit()
-    return jsonify({'success': True})
+    results = run_write(tree, lambda db, c: write_deletes(db, c, [{'id': node_id}], author, tree.index))
+    return single_result(results)
 
 # Define a route for deleting a set of nodes from the database
 @app.route('/nodes/batch', methods=['DELETE'])
 def delete_nodes():
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
-    db, c = get_db()
     data = request.get_json()
-    for node in data:
-        node_id = node['id']
-        c.execute("DELETE FROM nodes WHERE id = ?", (node_id,))
-        # Add the operation to the history table
-        author = request.args.get('author')
-        c.execute("INSERT INTO history (timestamp, id, operation, author) VALUES (?, ?, ?, ?)",
-                    (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime()), node_id, 'delete', author))
-    db.commit()
-    return jsonify({'success': True})
+    if not isinstance(data, list):
+        return jsonify({'success': False, 'error': 'Expected a list of nodes'})
+    author = request.args.get('author')
+    results = run_write(tree, lambda db, c: write_deletes(db, c, data, author, tree.index))
+    return batch_results(results)
 
 # Define a route for checking if a node exists in the database
 @app.route('/nodes/exists/<node_id>', methods=['GET'])
 def node_exists(node_id):
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
     db, c = get_db()
-    c.execute("SELECT * FROM nodes WHERE id = ?", (node_id,))
+    index = tree.get_index(c)
+    if index:
+        return jsonify({'success': True, 'exists': index.exists(node_id)})
+    c.execute("SELECT 1 FROM nodes WHERE id = ?", (node_id,))
     node = c.fetchone()
     if node:
         return jsonify({'success': True, 'exists': True})
@@ -283,57 +1062,87 @@ def node_exists(node_id):
 # Define a route for checking if a list of nodes exists in the database
 @app.route('/nodes/exists', methods=['POST'])
 def nodes_exist():
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
     db, c = get_db()
     data = request.get_json()
     node_ids = data['nodeIds']
-    exists = {}
-    for node_id in node_ids:
-        c.execute("SELECT * FROM nodes WHERE id = ?", (node_id,))
-        node = c.fetchone()
-        if node:
-            exists[node_id] = True
-        else:
-            exists[node_id] = False
+    index = tree.get_index(c)
+    if index:
+        return jsonify({'success': True, 'exists': {node_id: index.exists(node_id) for node_id in node_ids}})
+    existing = find_existing(c, node_ids)
+    exists = {node_id: node_id in existing for node_id in node_ids}
     return jsonify({'success': True, 'exists': exists})
 
+# Define a route for bringing a client's copies of a set of nodes up to date, given the version it has of each:
+# {"versions": {"<node id>": <version>, ...}}. Nodes that have changed since are returned with their text as a delta
+# from the client's version where it can be rebuilt (the full text otherwise), and nodes that are gone are listed
+# as deleted; nodes that are up to date are left out.
+@app.route('/nodes/sync', methods=['POST'])
+def sync_nodes():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    data = request.get_json()
+    known = data.get('versions') if isinstance(data, dict) else None
+    if not isinstance(known, dict) or not all(isinstance(version, int) for version in known.values()):
+        return jsonify({'success': False, 'error': 'Expected the version of each node'})
+    db, c = get_db()
+    # read the nodes and their versions from the same version of the tree
+    c.execute("BEGIN")
+    current = node_versions(c, list(known))
+    changed = [node_id for node_id, (text, version) in current.items() if version != known[node_id]]
+    c.execute("SELECT * FROM nodes WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(changed),))
+    nodes = {}
+    for row in c.fetchall():
+        node = node_to_dict(row)
+        nodes[node['id']] = delta_node(c, node, current[node['id']][1], known[node['id']])
+    c.execute("ROLLBACK")
+    deleted = [node_id for node_id in known if node_id not in current]
+    return jsonify({'success': True, 'nodes': nodes, 'deleted': deleted})
+
 # Define a route for getting all nodes from the database after a given timestamp
 @app.route('/nodes/get/<timestamp>', methods=['GET'])
 def get_nodes(timestamp):
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
     db, c = get_db()
     c.execute("SELECT * FROM nodes WHERE timestamp > ?", (timestamp.replace("%"," "),))
     nodes = c.fetchall()
     # jsonify the nodes
-    nodes = [{
-        'id': node[0],
-        'parent_ids': node[1].split(',') if node[1] else None,
-        'children_ids': node[2].split(',') if node[2] else None,
-        'text': node[3],
-        'author': node[4],
-        'timestamp': node[5]
-    } for node in nodes]
+    nodes = [node_to_dict(node) for node in nodes]
     return jsonify({'success': True, 'nodes': nodes})
 
 # Define a route for getting all node ids from the database
 @app.route('/nodes/ids', methods=['GET'])
 def get_all_node_ids():
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    fmt = stream_format()
+    response = not_modified(tree.etag(tree.version, fmt))
+    if response:
+        return response
+    if fmt:
+        return stream_rows(tree, fmt, 'nodes', "SELECT id FROM nodes", (), lambda node: node[0])
     db, c = get_db()
     c.execute("SELECT id FROM nodes")
     nodes = c.fetchall()
@@ -344,35 +1153,122 @@ def get_all_node_ids():
 # Define a route for getting all nodes from the database
 @app.route('/nodes', methods=['GET'])
 def get_all_nodes():
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
-    db, c = get_db()
-    c.execute("SELECT * FROM nodes")
-    nodes = c.fetchall()
-    # jsonify the nodes
-    nodes = {node[0]:{
-        'parent_ids': node[1].split(',') if node[1] else None,
-        'children_ids': node[2].split(',') if node[2] else None,
-        'text': node[3],
-        'author': node[4],
-        'timestamp': node[5]
-    } for node in nodes}
-    return jsonify({'success': True, 'nodes': nodes})
+    version = tree.version
+    fmt = stream_format()
+    response = not_modified(tree.etag(version, fmt))
+    if response:
+        return response
+    if fmt:
+        return stream_rows(tree, fmt, 'nodes', "SELECT * FROM nodes", (), node_to_dict, keyed=True)
+    # serve the full tree from the cache if it hasn't changed since it was last requested
+    encoding = choose_encoding(request.headers.get('Accept-Encoding', ''))
+    body = tree.full_tree_cache.get(version, encoding)
+    if body is None:
+        data = tree.full_tree_cache.get(version, None)
+        if data is None:
+            db, c = get_db()
+            c.execute("SELECT * FROM nodes")
+            # jsonify the nodes
+            nodes = {}
+            for node in c.fetchall():
+                node = node_to_dict(node)
+                nodes[node.pop('id')] = node
+            data = jsonify({'success': True, 'nodes': nodes}).get_data()
+            tree.full_tree_cache.put(version, None, data)
+        body = compress(data, encoding) if encoding else data
+        tree.full_tree_cache.put(version, encoding, body)
+    response = Response(body, mimetype='application/json')
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+# Define a route for getting a binary snapshot of the whole tree (see snapshot.py for the format)
+@app.route('/snapshot', methods=['GET'])
+def get_snapshot():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    response = not_modified(tree.etag(tree.version))
+    if response:
+        return response
+    def generate():
+        with tree.pool.reader() as db:
+            c = db.cursor()
+            # read both passes over the nodes from the same version of the tree
+            c.execute("BEGIN")
+            yield from snapshot_chunks(c)
+    return Response(stream_with_context(metrics.timed_chunks(generate(), metrics.request_state.phases)),
+                    mimetype='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename="%s.snapshot"' % tree.tree_id})
+
+# Define a route for listing the checkpoints of the tree (snapshots taken every CHECKPOINT_INTERVAL changes), which
+# clients whose change feed cursor has expired can start again from
+@app.route('/checkpoints', methods=['GET'])
+def get_checkpoints():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    checkpoints = []
+    for seq, path in list_checkpoints(tree.checkpoint_dir):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # pruned since it was listed
+            continue
+        checkpoints.append({'seq': seq, 'size': stat.st_size,
+                            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stat.st_mtime))})
+    return jsonify({'success': True, 'checkpoints': checkpoints})
+
+# Define a route for downloading a checkpoint, in the format of /snapshot
+@app.route('/checkpoints/<int:seq>', methods=['GET'])
+def get_checkpoint(seq):
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    path = dict(list_checkpoints(tree.checkpoint_dir)).get(seq)
+    if path is None:
+        return jsonify({'success': False, 'error': 'Checkpoint not found'})
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return jsonify({'success': False, 'error': 'Checkpoint not found'})
+    return send_file(f, mimetype='application/octet-stream', as_attachment=True,
+                     download_name='%s-%d.snapshot' % (tree.tree_id, seq))
 
 # Define a route for getting the number of nodes in the database
 @app.route('/nodes/count', methods=['GET'])
 def get_node_count():
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
     db, c = get_db()
+    index = tree.get_index(c)
+    if index:
+        return jsonify({'success': True, 'count': index.count()})
     c.execute("SELECT COUNT(*) FROM nodes")
     count = c.fetchone()[0]
     return jsonify({'success': True, 'count': count})
@@ -380,135 +1276,625 @@ def get_node_count():
 # Define a route for getting a single node from the database
 @app.route('/nodes/<node_id>', methods=['GET'])
 def get_node(node_id):
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
     db, c = get_db()
-    c.execute("SELECT * FROM nodes WHERE id = ?", (node_id,))
-    node = c.fetchone()
+    # the version of a node is the sequence number of its last change
+    c.execute("SELECT COALESCE(MAX(seq), 0) FROM history WHERE id = ?", (node_id,))
+    version = c.fetchone()[0]
+    response = not_modified('%s-%s-%d' % (tree.etag_token, node_id, version))
+    if response:
+        return response
+    index = tree.get_index(c)
+    if index:
+        node = next(iter(index.get_rows(c, [node_id])), None)
+    else:
+        c.execute("SELECT * FROM nodes WHERE id = ?", (node_id,))
+        node = c.fetchone()
+    if node is None:
+        return jsonify({'success': False, 'error': 'Node not found'})
     # jsonify the node
-    node = {
-        'id': node[0],
-        'parent_ids': node[1].split(',') if node[1] else None,
-        'children_ids': node[2].split(',') if node[2] else None,
-        'text': node[3],
-        'author': node[4],
-        'timestamp': node[5]
-    }
-    return jsonify({'success': True, 'node': node})
+    node = node_to_dict(node)
+    return jsonify({'success': True, 'node': node, 'version': version})
 
 # Define a route for getting the root node from the database
 @app.route('/nodes/root', methods=['GET'])
 def get_root_node():
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
     db, c = get_db()
-    c.execute("SELECT * FROM nodes WHERE parent_ids IS NULL")
-    node = c.fetchone()
+    index = tree.get_index(c)
+    if index:
+        node = next(iter(index.get_rows(c, [index.root_id()])), None)
+    else:
+        c.execute("SELECT * FROM nodes WHERE parent_ids IS NULL")
+        node = c.fetchone()
+    if node is None:
+        return jsonify({'success': False, 'error': 'Node not found'})
     # jsonify the node
-    node = {
-        'id': node[0],
-        'parent_ids': node[1].split(',') if node[1] else None,
-        'children_ids': node[2].split(',') if node[2] else None,
-        'text': node[3],
-        'author': node[4],
-        'timestamp': node[5]
-    }
+    node = node_to_dict(node)
     return jsonify({'success': True, 'node': node})
 
 # Define a route for getting the children of a node from the database
 @app.route('/nodes/<node_id>/children', methods=['GET'])
 def get_children(node_id):
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
     db, c = get_db()
-    c.execute("SELECT * FROM nodes WHERE parent_ids LIKE ?", ('%'+node_id+'%',))
-    nodes = c.fetchall()
+    index = tree.get_index(c)
+    if index:
+        nodes = index.get_rows(c, index.child_ids(node_id))
+    else:
+        c.execute("SELECT nodes.* FROM edges JOIN nodes ON nodes.id = edges.child_id WHERE edges.parent_id = ?", (node_id,))
+        nodes = c.fetchall()
     # jsonify the nodes
-    nodes = [{
-        'id': node[0],
-        'parent_ids': node[1].split(',') if node[1] else None,
-        'children_ids': node[2].split(',') if node[2] else None,
-        'text': node[3],
-        'author': node[4],
-        'timestamp': node[5]
-    } for node in nodes]
+    nodes = [node_to_dict(node) for node in nodes]
     return jsonify({'success': True, 'nodes': nodes})
 
 # Define a route for getting the parents of a node from the database
 @app.route('/nodes/<node_id>/parents', methods=['GET'])
 def get_parents(node_id):
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    db, c = get_db()
+    index = tree.get_index(c)
+    if index:
+        nodes = index.get_rows(c, index.parent_ids(node_id))
+    else:
+        c.execute("SELECT nodes.* FROM edges JOIN nodes ON nodes.id = edges.parent_id WHERE edges.child_id = ?", (node_id,))
+        nodes = c.fetchall()
+    # jsonify the nodes
+    nodes = [node_to_dict(node) for node in nodes]
+    return jsonify({'success': True, 'nodes': nodes})
+
+# Define a route for getting the path from the root to a node in one request
+# Multi-parent nodes are followed through the first of their parent_ids; the nodes are ordered from the root down
+@app.route('/nodes/<node_id>/ancestry', methods=['GET'])
+def get_ancestry(node_id):
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
     db, c = get_db()
-    c.execute("SELECT * FROM nodes WHERE children_ids LIKE ?", ('%'+node_id+'%',))
+    c.execute("""WITH RECURSIVE path(id, depth) AS (
+                     SELECT ?, 0
+                     UNION ALL
+                     SELECT CASE WHEN instr(nodes.parent_ids, ',') THEN substr(nodes.parent_ids, 1, instr(nodes.parent_ids, ',') - 1)
+                                 ELSE nodes.parent_ids END, path.depth + 1
+                     FROM path JOIN nodes ON nodes.id = path.id
+                     WHERE nodes.parent_ids != '' AND path.depth < ?)
+                 SELECT nodes.* FROM path JOIN nodes ON nodes.id = path.id ORDER BY path.depth DESC""", (node_id, MAX_DEPTH))
     nodes = c.fetchall()
+    if not nodes or nodes[-1][0] != node_id:
+        return jsonify({'success': False, 'error': 'Node not found'})
     # jsonify the nodes
-    nodes = [{
-        'id': node[0],
-        'parent_ids': node[1].split(',') if node[1] else None,
-        'children_ids': node[2].split(',') if node[2] else None,
-        'text': node[3],
-        'author': node[4],
-        'timestamp': node[5]
-    } for node in nodes]
+    nodes = [node_to_dict(node) for node in nodes]
     return jsonify({'success': True, 'nodes': nodes})
 
+# Define a route for getting the context of a node: the text of the path from the root to it (following the first
+# parent of multi-parent nodes, like /ancestry), joined together. With max_chars only the end of it is returned,
+# up to that many characters. Contexts are cached (see context_cache.py).
+@app.route('/nodes/<node_id>/context', methods=['GET'])
+def get_context(node_id):
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    max_chars = request.args.get('max_chars', type=int)
+    response = not_modified(tree.etag(tree.version))
+    if response:
+        return response
+    db, c = get_db()
+    # read the path and the text on it from the same version of the tree
+    c.execute("BEGIN")
+    text = tree.context_cache.context(c, node_id, tree.get_index(c))
+    c.execute("ROLLBACK")
+    if text is None:
+        return jsonify({'success': False, 'error': 'Node not found'})
+    length = len(text)
+    if max_chars is not None and length > max(max_chars, 0):
+        text = text[length - max(max_chars, 0):]
+    return jsonify({'success': True, 'text': text, 'length': length, 'truncated': len(text) < length})
+
+# Define a route for starting to reconcile a copy of the tree with this one (see merkle.py for the hashes): returns the
+# tree hash and the subtree hash of each root. If the tree hash differs, the client posts the roots whose hashes
+# differ from its own to POST /reconcile.
+@app.route('/reconcile', methods=['GET'])
+def get_tree_hash():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    version = tree.version
+    response = not_modified(tree.etag(version))
+    if response:
+        return response
+    roots = tree.roots_cache.get(version, None)
+    if roots is None:
+        db, c = get_db()
+        roots = root_hashes(c)
+        tree.roots_cache.put(version, None, roots)
+    return jsonify({'success': True, 'hash': tree_hash(roots.values()), 'roots': roots})
+
+# Define a route for reconciling the branches of the tree that differ from a client's copy
+# The client sends the subtree hashes it has for some nodes, {"hashes": {"<node id>": "<subtree hash>", ...}}, and
+# gets back, for each node whose subtree differs here, its content hash and the subtree hashes of its children. It
+# fetches the nodes whose content differs and sends the children whose hashes differ in the next request, so only
+# the branches that differ are walked. Nodes that don't exist here are listed as missing.
+@app.route('/reconcile', methods=['POST'])
+def reconcile():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    data = request.get_json()
+    hashes = data.get('hashes') if isinstance(data, dict) else None
+    if not isinstance(hashes, dict):
+        return jsonify({'success': False, 'error': 'Expected the hashes of the nodes to compare'})
+    db, c = get_db()
+    # read the hashes of the nodes and their children from the same version of the tree
+    c.execute("BEGIN")
+    c.execute("SELECT id, content_hash, subtree_hash FROM hashes WHERE id IN (SELECT value FROM json_each(?))",
+              (json.dumps(list(hashes)),))
+    nodes = {node_id: {'hash': node_hash, 'subtree': node_subtree_hash, 'children': {}}
+             for node_id, node_hash, node_subtree_hash in c.fetchall() if node_subtree_hash != hashes[node_id]}
+    c.execute("""SELECT edges.parent_id, edges.child_id, hashes.subtree_hash FROM edges JOIN hashes ON hashes.id = edges.child_id
+                 WHERE edges.parent_id IN (SELECT value FROM json_each(?))""", (json.dumps(list(nodes)),))
+    for parent_id, child_id, child_hash in c.fetchall():
+        nodes[parent_id]['children'][child_id] = child_hash
+    c.execute("SELECT value FROM json_each(?) WHERE value NOT IN (SELECT id FROM nodes)", (json.dumps(list(hashes)),))
+    missing = [row[0] for row in c.fetchall()]
+    c.execute("ROLLBACK")
+    return jsonify({'success': True, 'nodes': nodes, 'missing': missing})
+
+# Define a route for getting the descendants of a node in one request, down to a given depth
+# Each node comes with its depth below the requested node (the shortest one, for multi-parent nodes), and the
+# nodes are ordered by depth and paginated with limit/offset
+@app.route('/nodes/<node_id>/subtree', methods=['GET'])
+def get_subtree(node_id):
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    depth = min(request.args.get('depth', MAX_DEPTH, type=int), MAX_DEPTH)
+    limit = page_limit()
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    db, c = get_db()
+    # walk the subtree one level at a time, so that a node with several parents in it is only visited once (at its
+    # shortest depth), and stop as soon as the levels walked so far cover the page
+    c.execute("BEGIN")
+    depths = {node_id: 0}
+    ordered = [node_id]
+    level = [node_id]
+    level_depth = 0
+    while level and level_depth < depth and len(ordered) < offset + limit:
+        c.execute("SELECT DISTINCT child_id FROM edges WHERE parent_id IN (SELECT value FROM json_each(?))", (json.dumps(level),))
+        level = sorted(child_id for child_id, in c.fetchall() if child_id not in depths)
+        level_depth += 1
+        for child_id in level:
+            depths[child_id] = level_depth
+        ordered.extend(level)
+    page = ordered[offset:offset + limit]
+    c.execute("SELECT * FROM nodes WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(page),))
+    rows = {row[0]: row for row in c.fetchall()}
+    c.execute("ROLLBACK")
+    # jsonify the nodes
+    nodes = [dict(node_to_dict(rows[page_id]), depth=depths[page_id]) for page_id in page if page_id in rows]
+    return jsonify({'success': True, 'nodes': nodes, 'more': len(nodes) == limit})
+
+# Define a function to quote every word of a search query, for queries that aren't valid FTS5 syntax
+def quote_terms(query):
+    return ' '.join('"%s"' % term.replace('"', '""') for term in query.split())
+
+# Define a route for searching the text of the nodes, returning the ids of the best matches with a snippet of each
+# The query can use the FTS5 syntax ("exact phrases", prefix*, AND, OR, NOT), and is otherwise searched for word by
+# word. Results can be limited to an author and to the subtree under a node, and are paginated with limit/offset.
+@app.route('/search', methods=['GET'])
+def search_nodes():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    if not tree.searchable:
+        return jsonify({'success': False, 'error': 'Search is not available (SQLite was built without FTS5)'})
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'success': False, 'error': 'Missing query'})
+    response = not_modified(tree.etag(tree.version))
+    if response:
+        return response
+    params = {'query': query, 'author': request.args.get('author'), 'under': request.args.get('under'),
+              'limit': page_limit(SEARCH_PAGE_SIZE), 'offset': max(request.args.get('offset', 0, type=int), 0)}
+    sql = ""
+    conditions = ["nodes_fts MATCH :query"]
+    if params['under'] is not None:
+        sql += """WITH RECURSIVE subtree(id) AS (
+                      SELECT :under
+                      UNION
+                      SELECT edges.child_id FROM subtree JOIN edges ON edges.parent_id = subtree.id) """
+        conditions.append("nodes.id IN subtree")
+    if params['author'] is not None:
+        conditions.append("nodes.author = :author")
+    sql += """SELECT nodes.id, nodes.author, nodes.timestamp, snippet(nodes_fts, 0, '<b>', '</b>', '...', 16), nodes_fts.rank
+              FROM nodes_fts JOIN nodes ON nodes.rowid = nodes_fts.rowid
+              WHERE %s ORDER BY nodes_fts.rank LIMIT :limit OFFSET :offset""" % ' AND '.join(conditions)
+    db, c = get_db()
+    try:
+        c.execute(sql, params)
+    except sqlite3.OperationalError:
+        c.execute(sql, dict(params, query=quote_terms(query)))
+    results = [{'id': row[0], 'author': row[1], 'timestamp': row[2], 'snippet': row[3], 'score': -row[4]} for row in c.fetchall()]
+    return jsonify({'success': True, 'results': results, 'more': len(results) == params['limit']})
+
 # Define a route for getting the history from the database
 @app.route('/history', methods=['GET'])
 def get_history():
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    where, params = history_filter()
+    fmt = stream_format()
+    if fmt:
+        return stream_rows(tree, fmt, 'history', "SELECT id, timestamp, operation, author, seq FROM history %s ORDER BY seq"
+                           % ('WHERE ' + where if where else ''), params, history_to_dict)
     db, c = get_db()
-    c.execute("SELECT * FROM history")
-    history = c.fetchall()
-    # jsonify the history
-    history = [{
-        'node_id': h[0],
-        'timestamp': h[1],
-        'operation': h[2],
-        'author': h[3]
-    } for h in history]
-    return jsonify({'success': True, 'history': history})
+    # return one page of the matching history after the given sequence number (the whole log is only sent streamed)
+    since = request.args.get('since', 0, type=int)
+    limit = page_limit()
+    c.execute("SELECT id, timestamp, operation, author, seq FROM history WHERE seq > ? %s ORDER BY seq LIMIT ?"
+              % ('AND ' + where if where else ''), [since] + params + [limit])
+    history = [history_to_dict(h) for h in c.fetchall()]
+    cursor = history[-1]['seq'] if history else since
+    return jsonify({'success': True, 'history': history, 'cursor': cursor, 'more': len(history) == limit})
 
 # Define a route for getting the history from the database after a certain timestamp
 @app.route('/history/<timestamp>', methods=['GET'])
 def get_history_after(timestamp):
-    # Check if the user is authorized to make changes to the database
+    # Check if the user is authorized to make changes to the tree
     if not is_authorized(request.headers.get('Authorization')):
         return jsonify({'success': False, 'error': 'Unauthorized'})
     # Check if the tree id is correct
-    if request.headers.get('Tree-Id') != TREE_ID:
+    tree = get_tree()
+    if tree is None:
         return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
     db, c = get_db()
-    c.execute("SELECT * FROM history WHERE timestamp > ?", (timestamp,))
+    c.execute("SELECT id, timestamp, operation, author, seq FROM history WHERE timestamp > ? ORDER BY seq", (timestamp,))
     history = c.fetchall()
     # jsonify the history
-    history = [{
-        'node_id': h[0],
-        'timestamp': h[1],
-        'operation': h[2],
-        'author': h[3]
-    } for h in history]
+    history = [history_to_dict(h) for h in history]
     return jsonify({'success': True, 'history': history})
 
-app.run(host="0.0.0.0", port=SERVER_PORT, debug=True)
\ No newline at end of file
+# Define a route for getting the changes to the tree after a sequence number
+# Each page holds creates, updates and delete tombstones in order, plus the cursor to pass as `since` next time
+@app.route('/changes', methods=['GET'])
+def get_changes_after():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    since = request.args.get('since', 0, type=int)
+    limit = page_limit()
+    db, c = get_db()
+    error = expired_cursor(tree, c, since)
+    if error:
+        return jsonify(error)
+    delta = request.args.get('delta', '').lower() in ('1', 'true')
+    if delta:
+        # read the changes and the text versions they are diffed against from the same version of the tree
+        c.execute("BEGIN")
+    changes = get_changes(c, since, limit, delta)
+    if delta:
+        c.execute("ROLLBACK")
+    cursor = changes[-1]['seq'] if changes else since
+    return jsonify({'success': True, 'changes': changes, 'cursor': cursor, 'more': len(changes) == limit})
+
+# Define a function to get the sequence number a change feed request resumes after: `since`, or the Last-Event-ID
+# header of a reconnecting EventSource (None if neither is given)
+def events_since():
+    since = request.args.get('since', type=int)
+    if since is None and request.headers.get('Last-Event-ID', '').isdigit():
+        since = int(request.headers.get('Last-Event-ID'))
+    return since
+
+# Define a function to build the response to a change feed request whose cursor has expired: the error as JSON when
+# long-polling, or as an `expired` event that ends the stream
+def expired_events(error):
+    if request.args.get('mode') == 'poll':
+        return jsonify(error)
+    return Response('event: expired\ndata: %s\n\n' % json.dumps(error), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+# Define functions for servers that wait on the change feed themselves instead of in a request thread (see asgi.py)
+# begin_events checks the request like /events does and subscribes the given subscriber to the tree's feed. It returns
+# the tree (kept open until end_events is called) and the sequence number the subscriber follows on from, or a
+# response to send instead.
+def begin_events(subscriber):
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return None, None, jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = trees.acquire(request.headers.get('Tree-Id'))
+    if tree is None:
+        return None, None, jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    try:
+        tree.check_file()
+        with tree.pool.reader() as conn:
+            error = expired_cursor(tree, conn.cursor(), events_since())
+            if error:
+                trees.release(tree.tree_id)
+                return None, None, expired_events(error)
+            if WORKERS > 1:
+                tree.sync(conn.cursor())
+            subscriber, last_seq = tree.hub.subscribe(conn.cursor(), subscriber)
+    except BaseException:
+        trees.release(tree.tree_id)
+        raise
+    return tree, last_seq, None
+
+def end_events(tree, subscriber):
+    tree.hub.unsubscribe(subscriber)
+    trees.release(tree.tree_id)
+
+# Define a route for subscribing to the changes to the tree as they are committed
+# Changes are pushed as Server-Sent Events; with ?mode=poll the request instead long-polls and returns a page
+# like /changes as soon as there is anything after the cursor. Reconnecting clients resume from `since`
+# (or the Last-Event-ID header) and are first sent everything they missed.
+@app.route('/events', methods=['GET'])
+def get_events():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    since = events_since()
+    with tree.pool.reader() as conn:
+        error = expired_cursor(tree, conn.cursor(), since)
+    if error:
+        return expired_events(error)
+
+    if request.args.get('mode') == 'poll':
+        # only hold a connection while querying, not while waiting
+        with tree.pool.reader() as conn:
+            subscriber, last_seq = tree.hub.subscribe(conn.cursor())
+        try:
+            if since is None:
+                since = last_seq
+            with tree.pool.reader() as conn:
+                changes = get_changes(conn.cursor(), since, CHANGES_PAGE_SIZE)
+            if not changes:
+                # wait for the next commit, then collect whatever else arrived with it
+                timeout = min(request.args.get('timeout', EVENTS_POLL_TIMEOUT, type=float), EVENTS_POLL_TIMEOUT)
+                try:
+                    changes.append(subscriber.queue.get(timeout=timeout))
+                    while len(changes) < CHANGES_PAGE_SIZE:
+                        changes.append(subscriber.queue.get_nowait())
+                except queue.Empty:
+                    pass
+                changes = [change for change in changes if change['seq'] > since]
+        finally:
+            tree.hub.unsubscribe(subscriber)
+        cursor = changes[-1]['seq'] if changes else since
+        return jsonify({'success': True, 'changes': changes, 'cursor': cursor, 'more': len(changes) == CHANGES_PAGE_SIZE})
+
+    def generate():
+        with tree.pool.reader() as conn:
+            subscriber, cursor = tree.hub.subscribe(conn.cursor())
+        try:
+            yield 'retry: 1000\n\n'
+            # replay the changes the client missed, then follow the live feed
+            if since is not None:
+                cursor = since
+                while True:
+                    with tree.pool.reader() as conn:
+                        changes = get_changes(conn.cursor(), cursor, CHANGES_PAGE_SIZE)
+                    for change in changes:
+                        yield change_to_event(change)
+                        cursor = change['seq']
+                    if len(changes) < CHANGES_PAGE_SIZE:
+                        break
+            while not subscriber.overflowed:
+                try:
+                    change = subscriber.queue.get(timeout=EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if change['seq'] > cursor:
+                    yield change_to_event(change)
+                    cursor = change['seq']
+        finally:
+            tree.hub.unsubscribe(subscriber)
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Define a route for getting the connection pool statistics
+@app.route('/stats/pool', methods=['GET'])
+def get_pool_stats():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    return jsonify({'success': True, 'pool': tree.pool.stats()})
+
+# Define a route for getting the group-commit writer statistics (batch sizes, queue latency and commit time)
+@app.route('/stats/writer', methods=['GET'])
+def get_writer_stats():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    if tree.group_writer is None:
+        return jsonify({'success': False, 'error': 'Group commit is not enabled'})
+    return jsonify({'success': True, 'writer': tree.group_writer.stats()})
+
+# Define a route for getting the statistics of the trees hosted by the server (how many are open and in use)
+@app.route('/stats/trees', methods=['GET'])
+def get_tree_stats():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    return jsonify({'success': True, 'trees': trees.stats()})
+
+# Define a route for getting the metrics in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    # the pool and writer figures are summed over the trees that are open
+    open_trees = trees.open_trees()
+    pool_stats = {}
+    for open_tree in open_trees:
+        for key, value in open_tree.pool.stats().items():
+            pool_stats[key] = pool_stats.get(key, 0) + value
+    writer_stats = {}
+    for open_tree in open_trees:
+        if open_tree.group_writer is not None:
+            for key, value in open_tree.group_writer.stats().items():
+                if isinstance(value, (int, float)):
+                    writer_stats[key] = writer_stats.get(key, 0) + value
+    context_stats = {}
+    for open_tree in open_trees:
+        for key, value in open_tree.context_cache.stats().items():
+            context_stats[key] = context_stats.get(key, 0) + value
+    values = [
+        ('multiloom_trees_open', 'gauge', 'Trees with open databases.', len(open_trees)),
+        ('multiloom_pool_reader_checkouts_total', 'counter', 'Read connections handed out.', pool_stats['reader_checkouts']),
+        ('multiloom_pool_reader_waits_total', 'counter', 'Read connection checkouts that had to wait for a free connection.', pool_stats['reader_waits']),
+        ('multiloom_pool_reader_wait_seconds_total', 'counter', 'Time spent waiting for a free read connection.', pool_stats['reader_wait_seconds']),
+        ('multiloom_pool_writer_checkouts_total', 'counter', 'Times the writer connection was handed out.', pool_stats['writer_checkouts']),
+        ('multiloom_pool_writer_wait_seconds_total', 'counter', 'Time spent waiting for the writer connection.', pool_stats['writer_wait_seconds']),
+        ('multiloom_pool_write_lock_wait_seconds_total', 'counter', 'Time spent waiting for other worker processes to finish writing.', pool_stats['write_lock_wait_seconds']),
+        ('multiloom_pool_open_readers', 'gauge', 'Read connections currently open.', pool_stats['open_readers']),
+        ('multiloom_pool_idle_readers', 'gauge', 'Read connections currently idle.', pool_stats['idle_readers']),
+        ('multiloom_event_subscribers', 'gauge', 'Clients subscribed to the change feed.', sum(len(open_tree.hub.subscribers) for open_tree in open_trees)),
+        ('multiloom_context_cache_hits_total', 'counter', 'Contexts served whole from the cache.', context_stats['hits']),
+        ('multiloom_context_cache_partial_hits_total', 'counter', 'Contexts built on the cached context of an ancestor.', context_stats['partial_hits']),
+        ('multiloom_context_cache_misses_total', 'counter', 'Contexts read from the root.', context_stats['misses']),
+        ('multiloom_context_cache_evictions_total', 'counter', 'Contexts evicted from the cache to make room.', context_stats['evictions']),
+        ('multiloom_context_cache_chars', 'gauge', 'Characters of context held in the cache.', context_stats['chars']),
+    ]
+    if writer_stats:
+        values += [
+            ('multiloom_group_commit_batches_total', 'counter', 'Group-commit transactions.', writer_stats['batches']),
+            ('multiloom_group_commit_writes_total', 'counter', 'Writes committed through group commit.', writer_stats['writes']),
+            ('multiloom_group_commit_queue_seconds_total', 'counter', 'Time writes spent queued for group commit.', writer_stats['queue_seconds']),
+            ('multiloom_group_commit_seconds_total', 'counter', 'Time spent running and committing group-commit batches.', writer_stats['commit_seconds']),
+        ]
+    return Response(metrics.render(values), mimetype='text/plain; version=0.0.4')
+
+# Define a route for changing the slow-request log threshold at runtime (0 turns the log off)
+@app.route('/metrics/slow-log', methods=['POST'])
+def set_slow_log():
+    global slow_request_threshold
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    threshold_ms = request.args.get('threshold_ms', type=float)
+    if threshold_ms is None or threshold_ms < 0:
+        return jsonify({'success': False, 'error': 'threshold_ms must be a non-negative number'})
+    slow_request_threshold = threshold_ms / 1000 if threshold_ms > 0 else None
+    return jsonify({'success': True, 'threshold_ms': threshold_ms})
+
+# Define routes for starting and stopping the sampling profiler, and for getting its samples as folded stacks
+@app.route('/metrics/profiler', methods=['POST', 'DELETE'])
+def toggle_profiler():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    if request.method == 'POST':
+        interval_ms = request.args.get('interval_ms', PROFILER_INTERVAL_MS, type=float)
+        if interval_ms <= 0:
+            return jsonify({'success': False, 'error': 'interval_ms must be positive'})
+        if not metrics.profiler.start(interval_ms / 1000):
+            return jsonify({'success': False, 'error': 'The profiler is already running'})
+    else:
+        metrics.profiler.stop()
+    return jsonify({'success': True, 'profiler': metrics.profiler.stats()})
+
+@app.route('/metrics/profiler', methods=['GET'])
+def get_profile():
+    # Check if the user is authorized to make changes to the tree
+    if not is_authorized(request.headers.get('Authorization')):
+        return jsonify({'success': False, 'error': 'Unauthorized'})
+    # Check if the tree id is correct
+    tree = get_tree()
+    if tree is None:
+        return jsonify({'success': False, 'error': 'Invalid Tree-Id'})
+    return Response(metrics.profiler.folded(), mimetype='text/plain')
+
+# Define a function to get the app, ready to serve, for WSGI servers (such as `gunicorn 'server:create_app()'`)
+# and for asgi.py. Databases are built offline, with `admin.py import`, so there is nothing to do before serving.
+def create_app():
+    return app
+
+if __name__ == '__main__':
+    create_app().run(host="0.0.0.0", port=SERVER_PORT, debug=True)
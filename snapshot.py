@@ -0,0 +1,232 @@
+import argparse
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import time
+from array import array
+
+from schema import bulk_load, init_db, node_edges, rotate_token, tree_version
+
+# A snapshot is a header followed by sections, each prefixed with its length in bytes (all integers little-endian):
+#   ids         string table of the node ids, followed by any ids that are referenced but have no node
+#   flags       uint8 per node (bit 0: parent_ids is NULL, bit 1: children_ids is NULL)
+#   parents     uint32 offsets[nodes + 1] into uint32 id references, in parent_ids order
+#   children    uint32 offsets[nodes + 1] into uint32 id references, in children_ids order
+#   authors     string table of distinct authors, then uint32 author reference per node
+#   timestamps  string table of distinct timestamps, then uint32 timestamp reference per node
+#   text        uint64 offsets[nodes + 1] into one contiguous UTF-8 blob
+# A string table is a uint32 count, uint64 offsets[count + 1] and a UTF-8 blob.
+SNAPSHOT_MAGIC = b'MLSNAP01'
+SNAPSHOT_HEADER = struct.Struct('<8sQQ')
+SNAPSHOT_BATCH_SIZE = 50000
+SNAPSHOT_CHUNK_SIZE = 1 << 20
+
+# Define a function to get the little-endian bytes of an array
+def array_bytes(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+# Define a function to read a little-endian array out of a buffer (without copying it on little-endian machines)
+def read_array(view, typecode):
+    if sys.byteorder == 'little':
+        return view.cast(typecode)
+    values = array(typecode, view.tobytes())
+    values.byteswap()
+    return values
+
+# Define a function to encode a string table
+def string_table(strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = array('Q', [0])
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+    return struct.pack('<I', len(encoded)) + array_bytes(offsets) + b''.join(encoded)
+
+# Define a function to frame a section with its length
+def section(data):
+    return struct.pack('<Q', len(data)) + data
+
+# Define a function to write a snapshot of a tree database, yielding it chunk by chunk
+# The cursor should be inside a read transaction, so that both passes over the nodes see the same tree
+def snapshot_chunks(c):
+    seq = tree_version(c)
+    c.execute("SELECT id, parent_ids, children_ids, author, timestamp, length(CAST(text AS BLOB)) FROM nodes ORDER BY rowid")
+    nodes = c.fetchall()
+    ids = {node[0]: i for i, node in enumerate(nodes)}
+    authors, timestamps = {}, {}
+    flags = bytearray()
+    parent_offsets, parent_refs = array('I', [0]), array('I')
+    child_offsets, child_refs = array('I', [0]), array('I')
+    author_refs, timestamp_refs = array('I'), array('I')
+    text_offsets = array('Q', [0])
+    for node_id, parent_ids, children_ids, author, timestamp, length in nodes:
+        flags.append((parent_ids is None) | (children_ids is None) << 1)
+        for refs, offsets, id_list in ((parent_refs, parent_offsets, parent_ids), (child_refs, child_offsets, children_ids)):
+            for ref_id in (id_list or '').split(','):
+                if ref_id:
+                    refs.append(ids.setdefault(ref_id, len(ids)))
+            offsets.append(len(refs))
+        author_refs.append(authors.setdefault(author or '', len(authors)))
+        timestamp_refs.append(timestamps.setdefault(timestamp or '', len(timestamps)))
+        text_offsets.append(text_offsets[-1] + (length or 0))
+
+    yield SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(nodes), seq)
+    yield section(string_table(ids))
+    yield section(bytes(flags))
+    yield section(array_bytes(parent_offsets) + array_bytes(parent_refs))
+    yield section(array_bytes(child_offsets) + array_bytes(child_refs))
+    yield section(string_table(authors) + array_bytes(author_refs))
+    yield section(string_table(timestamps) + array_bytes(timestamp_refs))
+    del nodes, ids, authors, timestamps
+
+    # stream the text blob straight from the database
+    yield struct.pack('<Q', len(array_bytes(text_offsets)) + text_offsets[-1])
+    yield array_bytes(text_offsets)
+    c.execute("SELECT text FROM nodes ORDER BY rowid")
+    chunk = []
+    size = 0
+    while True:
+        rows = c.fetchmany(1000)
+        if not rows:
+            break
+        for (text,) in rows:
+            data = (text or '').encode('utf-8')
+            chunk.append(data)
+            size += len(data)
+        if size >= SNAPSHOT_CHUNK_SIZE:
+            yield b''.join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b''.join(chunk)
+
+# Define a class for reading a snapshot file through a memory map, decoding nodes only as they are read
+class Snapshot:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, self.node_count, self.seq = SNAPSHOT_HEADER.unpack_from(self.map)
+        if magic != SNAPSHOT_MAGIC:
+            self.close()
+            raise ValueError('%s is not a Multiloom snapshot' % path)
+        sections = []
+        position = SNAPSHOT_HEADER.size
+        for _ in range(7):
+            (length,) = struct.unpack_from('<Q', self.map, position)
+            sections.append(self.view[position + 8:position + 8 + length])
+            position += 8 + length
+        n = self.node_count
+        self.ids, _ = self.read_strings(sections[0])
+        self.flags = sections[1]
+        self.parent_offsets = read_array(sections[2][:4 * (n + 1)], 'I')
+        self.parent_refs = read_array(sections[2][4 * (n + 1):], 'I')
+        self.child_offsets = read_array(sections[3][:4 * (n + 1)], 'I')
+        self.child_refs = read_array(sections[3][4 * (n + 1):], 'I')
+        self.authors, rest = self.read_strings(sections[4])
+        self.author_refs = read_array(rest, 'I')
+        self.timestamps, rest = self.read_strings(sections[5])
+        self.timestamp_refs = read_array(rest, 'I')
+        self.text_offsets = read_array(sections[6][:8 * (n + 1)], 'Q')
+        self.text = sections[6][8 * (n + 1):]
+
+    # Read a string table, returning its strings and the rest of the section
+    def read_strings(self, view):
+        (count,) = struct.unpack_from('<I', view)
+        offsets = read_array(view[4:4 + 8 * (count + 1)], 'Q')
+        blob = view[4 + 8 * (count + 1):]
+        strings = [str(blob[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(count)]
+        return strings, blob[offsets[count]:]
+
+    # Get the nodes as rows for the nodes table
+    def rows(self):
+        for i in range(self.node_count):
+            flags = self.flags[i]
+            parent_ids = ','.join(self.ids[ref] for ref in self.parent_refs[self.parent_offsets[i]:self.parent_offsets[i + 1]])
+            children_ids = ','.join(self.ids[ref] for ref in self.child_refs[self.child_offsets[i]:self.child_offsets[i + 1]])
+            text = str(self.text[self.text_offsets[i]:self.text_offsets[i + 1]], 'utf-8')
+            yield (self.ids[i], None if flags & 1 else parent_ids, None if flags & 2 else children_ids, text,
+                   self.authors[self.author_refs[i]], self.timestamps[self.timestamp_refs[i]])
+
+    def close(self):
+        for name in ('parent_offsets', 'parent_refs', 'child_offsets', 'child_refs', 'author_refs', 'timestamp_refs',
+                     'text_offsets', 'text', 'flags'):
+            value = getattr(self, name, None)
+            if isinstance(value, memoryview):
+                value.release()
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+# Define a function to export a tree database to a snapshot file
+def export_snapshot(tree_file, path):
+    conn = sqlite3.connect(tree_file)
+    c = conn.cursor()
+    c.execute("BEGIN")
+    with open(path, 'wb') as f:
+        for chunk in snapshot_chunks(c):
+            f.write(chunk)
+    conn.rollback()
+    conn.close()
+
+# Define a function to load a snapshot file into a tree database, returning the import statistics
+def import_snapshot(tree_file, path, replace=False):
+    if replace and os.path.exists(tree_file):
+        os.remove(tree_file)
+    init_db(tree_file)
+    start = time.perf_counter()
+    snapshot = Snapshot(path)
+    conn = sqlite3.connect(tree_file)
+    c = conn.cursor()
+    # the load can simply be rerun if it fails, so trade durability for speed while it runs
+    c.execute("PRAGMA synchronous = OFF")
+    c.execute("PRAGMA journal_mode = MEMORY")
+    c.execute("PRAGMA cache_size = -262144")
+    with bulk_load(c):
+        rows = []
+        for row in snapshot.rows():
+            rows.append(row)
+            if len(rows) >= SNAPSHOT_BATCH_SIZE:
+                c.executemany("INSERT INTO nodes (id, parent_ids, children_ids, text, author, timestamp) VALUES (?, ?, ?, ?, ?, ?)", rows)
+                c.executemany("INSERT OR IGNORE INTO edges (parent_id, child_id) VALUES (?, ?)",
+                              [edge for row in rows for edge in node_edges(row[0], row[1], row[2])])
+                rows.clear()
+        c.executemany("INSERT INTO nodes (id, parent_ids, children_ids, text, author, timestamp) VALUES (?, ?, ?, ?, ?, ?)", rows)
+        c.executemany("INSERT OR IGNORE INTO edges (parent_id, child_id) VALUES (?, ?)",
+                      [edge for row in rows for edge in node_edges(row[0], row[1], row[2])])
+    # carry on numbering changes from where the snapshotted tree left off, so that client cursors stay valid
+    c.execute("DELETE FROM sqlite_sequence WHERE name = 'history'")
+    c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('history', ?)", (snapshot.seq,))
+    rotate_token(c)
+    conn.commit()
+    conn.close()
+    node_count = snapshot.node_count
+    snapshot.close()
+    seconds = time.perf_counter() - start
+    return {
+        'nodes': node_count,
+        'seconds': round(seconds, 3),
+        'nodes_per_second': round(node_count / seconds) if seconds else node_count
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a Multiloom database to a binary snapshot, or load one into a database.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='write a snapshot of a database')
+    export_parser.add_argument('tree_file', help='the database to export')
+    export_parser.add_argument('snapshot', help='the snapshot file to write')
+    load_parser = subparsers.add_parser('load', help='load a snapshot into a database')
+    load_parser.add_argument('snapshot', help='the snapshot file to load')
+    load_parser.add_argument('tree_file', help='the database to load into')
+    load_parser.add_argument('--replace', action='store_true', help='delete the existing database first')
+    args = parser.parse_args()
+    if args.command == 'export':
+        start = time.perf_counter()
+        export_snapshot(args.tree_file, args.snapshot)
+        print('Exported %s to %s in %.2fs' % (args.tree_file, args.snapshot, time.perf_counter() - start))
+    else:
+        stats = import_snapshot(args.tree_file, args.snapshot, args.replace)
+        print('Loaded %(nodes)d nodes in %(seconds).2fs (%(nodes_per_second)d nodes/s)' % stats)
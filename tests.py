@@ -1,6 +1,31 @@
 import unittest
+import asyncio
+import importlib
 import json
+import uuid
+import gzip
+import hashlib
+import threading
+import tempfile
+import os
+import sys
+import time
+import sqlite3
 import requests
+from unittest import mock
+
+from admin import import_database, verify
+from merkle import content_hash, subtree_hash
+import importer
+from importer import export_tree, read_tree
+from compaction import compact, compact_history, compacted_horizon, list_checkpoints, retention_horizon
+import schema
+from schema import init_db
+from snapshot import Snapshot
+from tree_index import TreeIndex
+from trees import TreeRegistry, load_tree_config
+from pool import ConnectionPool, PoolTimeout
+from writer import GroupCommitWriter, transaction
 
 class TestServer(unittest.TestCase):
 
@@ -60,6 +85,736 @@ class TestServer(unittest.TestCase):
         print(response.json())
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()['success'], True)
+        # without parameters the first page of the log is returned, and only a streamed response holds all of it
+        history = response.json()['history']
+        total = requests.get(f'{self.url}/history?stream=ndjson', headers=self.headers).text.splitlines()
+        self.assertEqual(json.loads(total[-1])['count'], len(total) - 1)
+        self.assertEqual(len(history), min(len(total) - 1, 1000))
+        self.assertEqual(response.json()['cursor'], history[-1]['seq'] if history else 0)
+        self.assertEqual(response.json()['more'], len(history) == 1000)
+        # Test filtering the history by node, one page at a time
+        node_id = str(uuid.uuid4())
+        requests.post(f'{self.url}/nodes', headers=self.headers, json={'id': node_id, 'parentId': None, 'text': 'v1', 'author': 'history-test', 'timestamp': '2022-01-01 00:00:00'})
+        requests.put(f'{self.url}/nodes/{node_id}', headers=self.headers, json={'text': 'v2', 'author': 'history-test', 'timestamp': '2022-01-01 00:00:00'})
+        response = requests.get(f'{self.url}/history', headers=self.headers, params={'node': node_id, 'limit': 1})
+        self.assertEqual([h['operation'] for h in response.json()['history']], ['create'])
+        self.assertTrue(response.json()['more'])
+        response = requests.get(f'{self.url}/history', headers=self.headers,
+                                params={'node': node_id, 'author': 'history-test', 'since': response.json()['cursor']})
+        self.assertEqual([h['operation'] for h in response.json()['history']], ['update'])
+
+    def test_get_children_and_parents(self):
+        # Test that child and parent lookups only match exact ids
+        parent_id = uuid.uuid4().hex
+        child_id = parent_id + '-child'
+        nodes = [
+            {'id': parent_id, 'parentId': None, 'text': 'Parent', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'},
+            {'id': child_id, 'parentIds': [parent_id], 'text': 'Child', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'},
+            {'id': child_id + '-grandchild', 'parentIds': [child_id], 'text': 'Grandchild', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}
+        ]
+        response = requests.post(f'{self.url}/nodes/batch', json=nodes, headers=self.headers)
+        self.assertEqual(response.json()['success'], True)
+        response = requests.get(f'{self.url}/nodes/{parent_id}/children', headers=self.headers)
+        self.assertEqual([node['id'] for node in response.json()['nodes']], [child_id])
+        response = requests.get(f'{self.url}/nodes/{child_id}/parents', headers=self.headers)
+        self.assertEqual([node['id'] for node in response.json()['nodes']], [parent_id])
+
+    def test_get_all_nodes_streamed(self):
+        # Test that the streamed responses match the buffered ones
+        response = requests.get(f'{self.url}/nodes', headers=self.headers)
+        nodes = response.json()['nodes']
+        response = requests.get(f'{self.url}/nodes?stream=1', headers=self.headers)
+        self.assertEqual(response.json(), {'success': True, 'nodes': nodes})
+        headers = dict(self.headers, Accept='application/x-ndjson')
+        response = requests.get(f'{self.url}/nodes/ids', headers=headers)
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        self.assertEqual(sorted(lines[:-1]), sorted(nodes))
+        self.assertEqual(lines[-1], {'success': True, 'count': len(nodes)})
+
+    def test_get_changes(self):
+        # Test that the change log returns creates, updates and delete tombstones after a cursor
+        response = requests.get(f'{self.url}/changes?since=0&limit=1000000', headers=self.headers)
+        since = response.json()['cursor']
+        node_id = uuid.uuid4().hex
+        data = {'id': node_id, 'parentId': None, 'text': 'Test node', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}
+        requests.post(f'{self.url}/nodes', json=data, headers=self.headers)
+        data = {'text': 'Updated node', 'author': 'Updated author', 'timestamp': '2022-01-01 00:00:00'}
+        requests.put(f'{self.url}/nodes/{node_id}', json=data, headers=self.headers)
+        response = requests.get(f'{self.url}/changes?since={since}&limit=2', headers=self.headers)
+        page = response.json()
+        self.assertEqual([change['operation'] for change in page['changes']], ['create', 'update'])
+        self.assertEqual(page['changes'][1]['node']['text'], 'Updated node')
+        self.assertEqual(page['more'], True)
+        requests.delete(f'{self.url}/nodes/{node_id}', headers=self.headers)
+        response = requests.get(f'{self.url}/changes?since={page["cursor"]}', headers=self.headers)
+        page = response.json()
+        self.assertEqual([(change['node_id'], change['operation'], change['node']) for change in page['changes']],
+                         [(node_id, 'delete', None)])
+        self.assertEqual(page['more'], False)
+
+    def test_events(self):
+        # Test that a long-poll returns as soon as a change is committed, and that the event stream replays from a cursor
+        response = requests.get(f'{self.url}/changes?since=0&limit=1000000', headers=self.headers)
+        since = response.json()['cursor']
+        node_id = uuid.uuid4().hex
+        data = {'id': node_id, 'parentId': None, 'text': 'Test node', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}
+        timer = threading.Timer(0.5, requests.post, (f'{self.url}/nodes',), {'json': data, 'headers': self.headers})
+        timer.start()
+        response = requests.get(f'{self.url}/events?mode=poll&since={since}&timeout=10', headers=self.headers)
+        timer.join()
+        self.assertEqual([change['node_id'] for change in response.json()['changes']], [node_id])
+        response = requests.get(f'{self.url}/events?since={since}', headers=self.headers, stream=True)
+        lines = response.iter_lines(decode_unicode=True)
+        self.assertEqual(next(lines), 'retry: 1000')
+        next(lines)
+        self.assertEqual(next(lines), f'id: {since + 1}')
+        self.assertEqual(next(lines), 'event: create')
+        self.assertEqual(json.loads(next(lines)[len('data: '):])['node_id'], node_id)
+        response.close()
+
+    def test_search(self):
+        # Test that search finds created nodes, follows updates and deletes, and filters by author and subtree
+        word = 'zq' + uuid.uuid4().hex[:8]
+        root_id, child_id, other_id = uuid.uuid4().hex, uuid.uuid4().hex, uuid.uuid4().hex
+        nodes = [
+            {'id': root_id, 'parentId': None, 'text': 'The %s begins' % word, 'author': 'Alice', 'timestamp': '2022-01-01 00:00:00'},
+            {'id': child_id, 'parentIds': [root_id], 'text': '%s %s again' % (word, word), 'author': 'Bob', 'timestamp': '2022-01-01 00:00:00'},
+            {'id': other_id, 'parentId': None, 'text': 'Elsewhere, %s' % word, 'author': 'Bob', 'timestamp': '2022-01-01 00:00:00'}
+        ]
+        requests.post(f'{self.url}/nodes/batch', json=nodes, headers=self.headers)
+        response = requests.get(f'{self.url}/search', params={'q': word}, headers=self.headers)
+        results = response.json()['results']
+        self.assertEqual(sorted(result['id'] for result in results), sorted([root_id, child_id, other_id]))
+        self.assertEqual(results[0]['id'], child_id)
+        self.assertIn('<b>%s</b>' % word, results[0]['snippet'])
+        response = requests.get(f'{self.url}/search', params={'q': word, 'author': 'Bob', 'under': root_id}, headers=self.headers)
+        self.assertEqual([result['id'] for result in response.json()['results']], [child_id])
+        response = requests.get(f'{self.url}/search', params={'q': word, 'limit': 2, 'offset': 2}, headers=self.headers)
+        self.assertEqual(len(response.json()['results']), 1)
+        self.assertEqual(response.json()['more'], False)
+        data = {'text': 'Nothing to see', 'author': 'Bob', 'timestamp': '2022-01-01 00:00:00'}
+        requests.put(f'{self.url}/nodes/{child_id}', json=data, headers=self.headers)
+        requests.delete(f'{self.url}/nodes/{other_id}', headers=self.headers)
+        response = requests.get(f'{self.url}/search', params={'q': '"%s' % word}, headers=self.headers)
+        self.assertEqual([result['id'] for result in response.json()['results']], [root_id])
+
+    def test_patch_node(self):
+        # Test patching the text of a node against its version, and syncing it back as a delta
+        node_id = uuid.uuid4().hex
+        text = 'The quick brown fox jumps over the lazy dog. ' * 50
+        requests.post(f'{self.url}/nodes', json={'id': node_id, 'parentId': None, 'text': text, 'author': 'Alice', 'timestamp': '2022-01-01 00:00:00'}, headers=self.headers)
+        base = requests.get(f'{self.url}/nodes/{node_id}', headers=self.headers).json()['version']
+        since = requests.get(f'{self.url}/changes', params={'since': base - 1}, headers=self.headers).json()['cursor']
+        patch = {'base': base, 'ops': [{'retain': 4}, {'delete': 5}, {'insert': 'slow'}], 'author': 'Bob', 'timestamp': '2022-01-01 00:00:00'}
+        response = requests.patch(f'{self.url}/nodes/{node_id}', json=patch, headers=self.headers)
+        self.assertEqual(response.json()['success'], True)
+        version = response.json()['version']
+        # a second patch against the same base conflicts
+        response = requests.patch(f'{self.url}/nodes/{node_id}', json=patch, headers=self.headers)
+        self.assertEqual(response.json(), {'success': False, 'error': 'Conflict', 'version': version})
+        node = requests.get(f'{self.url}/nodes/{node_id}', headers=self.headers).json()['node']
+        self.assertEqual(node['text'], 'The slow brown' + text[len('The quick brown'):])
+        response = requests.get(f'{self.url}/changes', params={'since': since, 'delta': 1}, headers=self.headers)
+        node = response.json()['changes'][0]['node']
+        self.assertEqual((node['base'], node['version'], node['delta']), (base, version, [{'retain': 4}, {'delete': 5}, {'insert': 'slow'}]))
+        self.assertNotIn('text', node)
+        response = requests.post(f'{self.url}/nodes/sync', json={'versions': {node_id: base, 'missing': 1}}, headers=self.headers)
+        self.assertEqual(response.json()['nodes'][node_id]['delta'], [{'retain': 4}, {'delete': 5}, {'insert': 'slow'}])
+        self.assertEqual(response.json()['deleted'], ['missing'])
+
+    def test_batch_validation(self):
+        # Test that a batch with an invalid node is rejected without writing anything
+        node_ids = [uuid.uuid4().hex, uuid.uuid4().hex]
+        nodes = [
+            {'id': node_ids[0], 'parentId': None, 'text': 'Test node', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'},
+            {'id': node_ids[1], 'parentId': None, 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}
+        ]
+        response = requests.post(f'{self.url}/nodes/batch', json=nodes, headers=self.headers)
+        self.assertEqual(response.json()['success'], False)
+        self.assertEqual([result['success'] for result in response.json()['results']], [True, False])
+        response = requests.post(f'{self.url}/nodes/exists', json={'nodeIds': node_ids}, headers=self.headers)
+        self.assertEqual(response.json()['exists'], {node_ids[0]: False, node_ids[1]: False})
+        nodes[1]['text'] = 'Test node'
+        response = requests.post(f'{self.url}/nodes/batch', json=nodes, headers=self.headers)
+        self.assertEqual(response.json()['success'], True)
+        response = requests.post(f'{self.url}/nodes/exists', json={'nodeIds': node_ids}, headers=self.headers)
+        self.assertEqual(response.json()['exists'], {node_ids[0]: True, node_ids[1]: True})
+        response = requests.delete(f'{self.url}/nodes/batch', json=[{'id': node_ids[0]}, {'id': 'missing'}], headers=self.headers)
+        self.assertEqual([result['deleted'] for result in response.json()['results']], [True, False])
+
+    def test_get_node_count(self):
+        # Test that the node count and existence checks follow writes
+        count = requests.get(f'{self.url}/nodes/count', headers=self.headers).json()['count']
+        node_id = uuid.uuid4().hex
+        data = {'id': node_id, 'parentId': None, 'text': 'Test node', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}
+        requests.post(f'{self.url}/nodes', json=data, headers=self.headers)
+        self.assertEqual(requests.get(f'{self.url}/nodes/count', headers=self.headers).json()['count'], count + 1)
+        self.assertEqual(requests.get(f'{self.url}/nodes/exists/{node_id}', headers=self.headers).json()['exists'], True)
+        requests.delete(f'{self.url}/nodes/{node_id}', headers=self.headers)
+        self.assertEqual(requests.get(f'{self.url}/nodes/count', headers=self.headers).json()['count'], count)
+        self.assertEqual(requests.get(f'{self.url}/nodes/exists/{node_id}', headers=self.headers).json()['exists'], False)
+
+    def test_ancestry_and_subtree(self):
+        # Test getting the path to the root and a depth-limited subtree in one request each
+        prefix = uuid.uuid4().hex
+        nodes = [{'id': prefix + '0', 'parentId': None, 'text': 'Node 0', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}]
+        for i in range(1, 6):
+            nodes.append({'id': prefix + str(i), 'parentIds': [prefix + str(i - 1)], 'text': 'Node %d' % i, 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'})
+        nodes.append({'id': prefix + 'x', 'parentIds': [prefix + '1', prefix + '3'], 'text': 'Node x', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'})
+        requests.post(f'{self.url}/nodes/batch', json=nodes, headers=self.headers)
+        response = requests.get(f'{self.url}/nodes/{prefix}5/ancestry', headers=self.headers)
+        self.assertEqual([node['id'] for node in response.json()['nodes']], [prefix + str(i) for i in range(6)])
+        response = requests.get(f'{self.url}/nodes/{prefix}x/ancestry', headers=self.headers)
+        self.assertEqual([node['id'] for node in response.json()['nodes']], [prefix + '0', prefix + '1', prefix + 'x'])
+        response = requests.get(f'{self.url}/nodes/{prefix}1/subtree?depth=2', headers=self.headers)
+        self.assertEqual([(node['id'], node['depth']) for node in response.json()['nodes']],
+                         [(prefix + '1', 0), (prefix + '2', 1), (prefix + 'x', 1), (prefix + '3', 2)])
+        response = requests.get(f'{self.url}/nodes/{prefix}1/subtree?limit=2&offset=3', headers=self.headers)
+        self.assertEqual([node['id'] for node in response.json()['nodes']], [prefix + '3', prefix + '4'])
+        self.assertEqual(response.json()['more'], True)
+        # in a DAG where every node has two parents, each node is listed once, at its shortest depth
+        prefix = uuid.uuid4().hex
+        nodes = [{'id': prefix + '0', 'parentId': None, 'text': 'Node 0', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}]
+        for i in range(1, 300):
+            parent_ids = [prefix + str(i - 1)] + ([prefix + str(i - 2)] if i > 1 else [])
+            nodes.append({'id': prefix + str(i), 'parentIds': parent_ids, 'text': 'Node %d' % i, 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'})
+        requests.post(f'{self.url}/nodes/batch', json=nodes, headers=self.headers)
+        expected = sorted(((i + 1) // 2, prefix + str(i)) for i in range(300))
+        response = requests.get(f'{self.url}/nodes/{prefix}0/subtree?limit=10&offset=145', headers=self.headers)
+        self.assertEqual([(node['depth'], node['id']) for node in response.json()['nodes']], expected[145:155])
+        response = requests.get(f'{self.url}/nodes/{prefix}0/subtree?depth=3', headers=self.headers)
+        self.assertEqual([(node['depth'], node['id']) for node in response.json()['nodes']], expected[:7])
+
+    def test_context(self):
+        # Test that the context of a node is the text of its path, and that it follows edits to an ancestor
+        root_id, child_id, left_id, right_id = (uuid.uuid4().hex for _ in range(4))
+        nodes = [
+            {'id': root_id, 'parentId': None, 'text': 'Once', 'author': 'Alice', 'timestamp': '2022-01-01 00:00:00'},
+            {'id': child_id, 'parentIds': [root_id], 'text': ' upon', 'author': 'Alice', 'timestamp': '2022-01-01 00:00:00'},
+            {'id': left_id, 'parentIds': [child_id], 'text': ' a time', 'author': 'Alice', 'timestamp': '2022-01-01 00:00:00'},
+            {'id': right_id, 'parentIds': [child_id], 'text': ' a midnight', 'author': 'Alice', 'timestamp': '2022-01-01 00:00:00'}
+        ]
+        requests.post(f'{self.url}/nodes/batch', json=nodes, headers=self.headers)
+        response = requests.get(f'{self.url}/nodes/{left_id}/context', headers=self.headers)
+        self.assertEqual(response.json(), {'success': True, 'text': 'Once upon a time', 'length': 16, 'truncated': False})
+        response = requests.get(f'{self.url}/nodes/{right_id}/context', params={'max_chars': 13}, headers=self.headers)
+        self.assertEqual(response.json(), {'success': True, 'text': 'on a midnight', 'length': 20, 'truncated': True})
+        requests.put(f'{self.url}/nodes/{child_id}', json={'text': ' upon', 'author': 'Bob', 'timestamp': '2022-01-01 00:00:00'}, headers=self.headers)
+        requests.put(f'{self.url}/nodes/{root_id}', json={'text': 'Twice', 'author': 'Bob', 'timestamp': '2022-01-01 00:00:00'}, headers=self.headers)
+        response = requests.get(f'{self.url}/nodes/{left_id}/context', headers=self.headers)
+        self.assertEqual(response.json()['text'], 'Twice upon a time')
+        requests.delete(f'{self.url}/nodes/{child_id}', headers=self.headers)
+        response = requests.get(f'{self.url}/nodes/{left_id}/context', headers=self.headers)
+        self.assertEqual(response.json()['text'], ' a time')
+        response = requests.get(f'{self.url}/nodes/{child_id}/context', headers=self.headers)
+        self.assertEqual(response.json(), {'success': False, 'error': 'Node not found'})
+
+    def test_reconcile(self):
+        # Test that the subtree hashes follow writes, and that only the branches that differ are returned
+        root_id, left_id, right_id = (uuid.uuid4().hex for _ in range(3))
+        nodes = [
+            {'id': root_id, 'parentId': None, 'text': 'Root', 'author': 'Alice', 'timestamp': '2022-01-01 00:00:00'},
+            {'id': left_id, 'parentIds': [root_id], 'text': 'Left', 'author': 'Alice', 'timestamp': '2022-01-01 00:00:00'},
+            {'id': right_id, 'parentIds': [root_id], 'text': 'Right', 'author': 'Alice', 'timestamp': '2022-01-01 00:00:00'}
+        ]
+        requests.post(f'{self.url}/nodes/batch', json=nodes, headers=self.headers)
+        left = subtree_hash(content_hash(left_id, 'Left', 'Alice', '2022-01-01 00:00:00'), [])
+        right = subtree_hash(content_hash(right_id, 'Right', 'Alice', '2022-01-01 00:00:00'), [])
+        root = subtree_hash(content_hash(root_id, 'Root', 'Alice', '2022-01-01 00:00:00'), [left, right])
+        self.assertEqual(requests.get(f'{self.url}/reconcile', headers=self.headers).json()['roots'][root_id], root)
+        requests.put(f'{self.url}/nodes/{right_id}', json={'text': 'Wrong', 'author': 'Bob', 'timestamp': '2022-01-01 00:00:00'}, headers=self.headers)
+        response = requests.post(f'{self.url}/reconcile', json={'hashes': {root_id: root, left_id: left, 'missing': left}}, headers=self.headers)
+        self.assertEqual(list(response.json()['nodes']), [root_id])
+        children = response.json()['nodes'][root_id]['children']
+        self.assertEqual(children[left_id], left)
+        self.assertEqual(children[right_id], subtree_hash(content_hash(right_id, 'Wrong', 'Bob', '2022-01-01 00:00:00'), []))
+        self.assertEqual(response.json()['missing'], ['missing'])
+
+    def test_conditional_get(self):
+        # Test that an unchanged tree is answered with 304, and a changed one with the new tree
+        response = requests.get(f'{self.url}/nodes', headers=self.headers)
+        etag = response.headers['ETag']
+        response = requests.get(f'{self.url}/nodes', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 304)
+        data = {'parentId': None, 'text': 'Test node', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}
+        requests.post(f'{self.url}/nodes', json=data, headers=self.headers)
+        response = requests.get(f'{self.url}/nodes', headers=dict(self.headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        # every format and encoding of the tree has a tag of its own, and the format depends on the Accept header
+        etag = response.headers['ETag']
+        ndjson = dict(self.headers, **{'Accept': 'application/x-ndjson'})
+        response = requests.get(f'{self.url}/nodes', headers=dict(ndjson, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('Accept', response.headers['Vary'])
+        response = requests.get(f'{self.url}/nodes', headers=dict(ndjson, **{'If-None-Match': response.headers['ETag']}))
+        self.assertEqual(response.status_code, 304)
+        identity = dict(self.headers, **{'Accept-Encoding': 'identity'})
+        response = requests.get(f'{self.url}/nodes', headers=dict(identity, **{'If-None-Match': etag}))
+        self.assertEqual((response.status_code, response.headers['ETag'] == etag), (200, False))
+        response = requests.get(f'{self.url}/nodes', headers=dict(identity, **{'If-None-Match': response.headers['ETag']}))
+        self.assertEqual(response.status_code, 304)
+
+    def test_compression(self):
+        # Test that large responses are gzip-compressed when the client accepts it
+        data = {'parentId': None, 'text': 'Test node ' * 200, 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}
+        requests.post(f'{self.url}/nodes', json=data, headers=self.headers)
+        response = requests.get(f'{self.url}/nodes', headers=dict(self.headers, **{'Accept-Encoding': 'gzip'}), stream=True)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        nodes = json.loads(gzip.decompress(response.raw.read()))['nodes']
+        self.assertEqual(nodes, requests.get(f'{self.url}/nodes?stream=1', headers=self.headers).json()['nodes'])
+
+    def test_snapshot(self):
+        # Test that the binary snapshot holds the same nodes as the database
+        data = {'parentId': None, 'text': 'Test node \u00e9', 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}
+        requests.post(f'{self.url}/nodes', json=data, headers=self.headers)
+        response = requests.get(f'{self.url}/snapshot', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree.snapshot')
+            with open(path, 'wb') as f:
+                f.write(response.content)
+            snapshot = Snapshot(path)
+            nodes = {row[0]: {'parent_ids': row[1].split(',') if row[1] else None, 'children_ids': row[2].split(',') if row[2] else None,
+                             'text': row[3], 'author': row[4], 'timestamp': row[5]} for row in snapshot.rows()}
+            snapshot.close()
+        self.assertEqual(nodes, requests.get(f'{self.url}/nodes', headers=self.headers).json()['nodes'])
+
+    def test_metrics(self):
+        # Test that requests and SQL statements show up in the metrics
+        requests.get(f'{self.url}/changes', headers=self.headers)
+        response = requests.get(f'{self.url}/metrics', headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('multiloom_requests_total{route="/changes",method="GET",status="200"}', response.text)
+        self.assertIn('multiloom_request_phase_seconds_count{route="/changes",phase="query"}', response.text)
+        self.assertIn('multiloom_sqlite_statement_seconds_count{operation="SELECT",table="history"}', response.text)
+        response = requests.post(f'{self.url}/metrics/profiler?interval_ms=1', headers=self.headers)
+        self.assertTrue(response.json()['profiler']['running'])
+        response = requests.delete(f'{self.url}/metrics/profiler', headers=self.headers)
+        self.assertFalse(response.json()['profiler']['running'])
+
+class TestTreeRegistry(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        # Test that the least recently used idle tree is closed once too many are open, and busy trees are kept open
+        closed = []
+        class FakeTree:
+            def __init__(self, tree_id):
+                self.tree_id = tree_id
+            def idle(self):
+                return True
+            def close(self):
+                closed.append(self.tree_id)
+        config = {tree_id: {'file': tree_id + '.db', 'password_hash': None} for tree_id in 'abc'}
+        trees = TreeRegistry(config, lambda tree_id, settings: FakeTree(tree_id), 2)
+        self.assertIsNone(trees.acquire('d'))
+        trees.acquire('a')
+        trees.acquire('b')
+        trees.release('b')
+        trees.acquire('c')
+        # a is still in use, so b is closed instead
+        self.assertEqual(closed, ['b'])
+        trees.release('a')
+        trees.release('c')
+        self.assertEqual(trees.stats()['open'], 2)
+
+    def test_load_tree_config(self):
+        # Test that passwords are hashed, that paths are resolved against the config file, and that every tree needs a
+        # password of its own
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trees.json')
+            with open(path, 'w') as f:
+                json.dump({'a': {'file': 'a.db', 'password': 'secret'}, 'b': {'file': 'b.db', 'password_hash': 'abc'}}, f)
+            config = load_tree_config(path)
+            self.assertEqual(config['a'], {'file': os.path.join(directory, 'a.db'),
+                                           'password_hash': hashlib.sha256(b'secret').hexdigest()})
+            self.assertEqual(config['b']['password_hash'], 'abc')
+            with open(path, 'w') as f:
+                json.dump({'a': {'file': 'a.db', 'password': 'secret'}, 'c': {'file': 'c.db'}}, f)
+            with self.assertRaisesRegex(ValueError, 'Tree c has no password'):
+                load_tree_config(path)
+
+class TestSchema(unittest.TestCase):
+
+    def test_concurrent_migration(self):
+        # Test that a legacy database is migrated in one transaction, exactly once when opened by several processes at once
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree.db')
+            conn = sqlite3.connect(path)
+            conn.execute("CREATE TABLE nodes (id TEXT PRIMARY KEY, parent_ids TEXT, children_ids TEXT, text TEXT, author TEXT, timestamp TEXT)")
+            conn.execute("CREATE TABLE history (id TEXT PRIMARY KEY, timestamp TEXT, operation TEXT, author TEXT)")
+            conn.executemany("INSERT INTO nodes VALUES (?, ?, ?, 'Text', 'x', 't')", [('a', '', 'b'), ('b', 'a', '')])
+            conn.executemany("INSERT INTO history VALUES (?, 't', 'create', 'x')", [('a',), ('b',)])
+            conn.commit()
+            conn.close()
+            # a migration that fails part of the way through leaves the database as it was
+            with mock.patch.object(schema, 'rebuild_hashes', side_effect=RuntimeError('interrupted')):
+                with self.assertRaises(RuntimeError):
+                    init_db(path)
+            conn = sqlite3.connect(path)
+            self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], 0)
+            self.assertEqual(sorted(row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")),
+                             ['history', 'nodes'])
+            conn.close()
+            errors = []
+            def migrate():
+                try:
+                    init_db(path, timeout=30)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=migrate) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            conn = sqlite3.connect(path)
+            self.assertEqual(conn.execute("SELECT seq, id FROM history ORDER BY seq").fetchall(), [(1, 'a'), (2, 'b')])
+            self.assertEqual(conn.execute("SELECT * FROM edges").fetchall(), [('a', 'b')])
+            self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], 2)
+            conn.close()
+
+class TestTreeIndex(unittest.TestCase):
+
+    def test_refresh(self):
+        # Test that the index picks up nodes written by another process, and that the first root stays the same
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree.db')
+            init_db(path)
+            conn = sqlite3.connect(path)
+            c = conn.cursor()
+            c.execute("INSERT INTO nodes VALUES ('a', NULL, '', 'A', 'x', 't'), ('b', NULL, '', 'B', 'x', 't')")
+            conn.commit()
+            index = TreeIndex(100)
+            index.load(c)
+            c.execute("UPDATE nodes SET text = 'A2', children_ids = 'c' WHERE id = 'a'")
+            c.execute("INSERT INTO nodes VALUES ('c', 'a', '', 'C', 'x', 't')")
+            c.execute("INSERT INTO edges VALUES ('a', 'c')")
+            c.execute("DELETE FROM nodes WHERE id = 'b'")
+            conn.commit()
+            index.refresh(c, ['a', 'c', 'b'])
+            self.assertEqual(index.root_id(), 'a')
+            self.assertEqual(index.child_ids('a'), ['c'])
+            self.assertEqual(index.parent_ids('c'), ['a'])
+            self.assertFalse(index.exists('b'))
+            self.assertEqual(index.get_rows(c, ['a'])[0][3], 'A2')
+            conn.close()
+
+class TestImporter(unittest.TestCase):
+
+    def test_read_tree(self):
+        # Test that every format reads the same nodes, detected or given, with ijson and with json.load
+        nodes = [('a', [], ['b'], 'A', None), ('b', ['a'], [], 'B', None)]
+        trees = [
+            ('loomsidian', {'nodes': {'a': {'text': 'A', 'parentIds': [], 'childrenIds': ['b']},
+                                      'b': {'text': 'B', 'parentId': 'a', 'childrenIds': []}}}, nodes),
+            ('bonsai', [{'id': 'a', 'text': 'A', 'author': 'x'}, {'id': 'b', 'parentId': 'a', 'content': 'B'}],
+             [('a', [], None, 'A', 'x'), ('b', ['a'], None, 'B', None)]),
+            ('bonsai', {'nodes': [{'id': 'a', 'text': 'A', 'childrenIds': ['b']}, {'id': 'b', 'parentIds': ['a'], 'text': 'B', 'children': []}]},
+             nodes),
+            ('loom', {'root': {'id': 'a', 'text': 'A', 'children': [{'id': 'b', 'text': 'B'}]}}, nodes),
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree.json')
+            for fmt, tree, expected in trees:
+                with open(path, 'w') as f:
+                    json.dump(tree, f)
+                for parser in ([importer.ijson, None] if importer.ijson is not None else [None]):
+                    with mock.patch.object(importer, 'ijson', parser):
+                        for given in (None, fmt):
+                            with self.subTest(fmt=fmt, ijson=parser is not None, given=given):
+                                self.assertEqual([tuple(node) for node in read_tree(path, given)], expected)
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_pool(self):
+        # Test that readers are read-only and recycled, that broken ones are replaced, that checkouts time out once
+        # every reader is in use, and that the statistics add up
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree.db')
+            pool = ConnectionPool(path, size=2, timeout=0.1)
+            with pool.write() as db:
+                db.execute("CREATE TABLE t (x INTEGER)")
+                db.execute("INSERT INTO t VALUES (1)")
+                db.commit()
+
+            reader = pool.acquire_reader()
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.execute("INSERT INTO t VALUES (2)")
+            pool.release_reader(reader)
+            # the idle reader is handed out again rather than a new one being opened
+            self.assertIs(pool.acquire_reader(), reader)
+
+            other = pool.acquire_reader()
+            with self.assertRaises(PoolTimeout):
+                pool.acquire_reader()
+
+            # a reader that was closed while idle is replaced by a working one
+            pool.release_reader(other)
+            pool.release_reader(reader)
+            reader.close()
+            replacement = pool.acquire_reader()
+            self.assertIsNot(replacement, reader)
+            self.assertEqual(replacement.execute("SELECT x FROM t").fetchall(), [(1,)])
+            pool.release_reader(replacement)
+
+            stats = pool.stats()
+            self.assertEqual((stats['open_readers'], stats['idle_readers'], stats['size']), (2, 2, 2))
+            self.assertEqual((stats['reader_checkouts'], stats['reader_waits'], stats['connections_recovered']), (5, 1, 1))
+            self.assertEqual((stats['writer_checkouts'], stats['writer_busy']), (1, False))
+            self.assertEqual(stats['connections_opened'], 4)
+            pool.close()
+
+class TestGroupCommitWriter(unittest.TestCase):
+
+    def test_batching(self):
+        # Test that concurrent writes share one transaction, that a failing write only undoes itself, and that callers
+        # only return once their batch has been committed
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree.db')
+            conn = sqlite3.connect(path)
+            conn.execute("CREATE TABLE t (x INTEGER)")
+            conn.close()
+            pool = ConnectionPool(path)
+
+            def count(x=None):
+                reader = sqlite3.connect(path)
+                try:
+                    return reader.execute("SELECT COUNT(*) FROM t WHERE ? IS NULL OR x = ?", (x, x)).fetchone()[0]
+                finally:
+                    reader.close()
+
+            commits = []
+            writer = GroupCommitWriter(pool, 0.5, 100, on_commit=lambda c: commits.append(count()))
+            results = {}
+
+            def write(x):
+                def fn(db, c):
+                    with transaction(db, c) as after_commit:
+                        c.execute("INSERT INTO t VALUES (?)", (x,))
+                        after_commit.append(lambda: results.setdefault(('after_commit', x), len(commits)))
+                        if x == 3:
+                            raise ValueError('bad write')
+                    return x
+                try:
+                    results[x] = writer.submit(fn)
+                except ValueError as e:
+                    results[x] = str(e)
+                # by the time submit returns, the batch has been committed and on_commit has run
+                results[('committed', x)] = (len(commits), count(x))
+
+            threads = [threading.Thread(target=write, args=(x,)) for x in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            writer.close()
+            pool.close()
+            self.assertEqual(writer.stats()['batches'], 1)
+            self.assertEqual(writer.stats()['writes'], 5)
+            self.assertEqual(commits, [4])
+            self.assertEqual([results[x] for x in range(5)], [0, 1, 2, 'bad write', 4])
+            self.assertEqual([results[('committed', x)] for x in range(5)], [(1, 1), (1, 1), (1, 1), (1, 0), (1, 1)])
+            # post-commit actions run after the commit but before on_commit, and not for the failed write
+            self.assertEqual([results.get(('after_commit', x)) for x in range(5)], [0, 0, 0, None, 0])
+
+class TestASGI(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Import a server of its own, on a new tree, for the ASGI app to serve
+        cls.directory = tempfile.TemporaryDirectory()
+        environ = {'TREE_FILE': os.path.join(cls.directory.name, 'tree.db'), 'TREE_ID': 'test', 'SERVER_PASSWORD': '123456'}
+        with mock.patch.dict(os.environ, environ):
+            sys.modules.pop('server', None)
+            sys.modules.pop('asgi', None)
+            cls.server = importlib.import_module('server')
+            cls.asgi = importlib.import_module('asgi')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.trees.close()
+        sys.modules.pop('server', None)
+        sys.modules.pop('asgi', None)
+        cls.directory.cleanup()
+
+    # Call the ASGI app with a request, collecting the messages it sends into sent. The client disconnects once
+    # disconnect is set (if given).
+    async def call(self, app, method, path, body=None, sent=None, disconnect=None):
+        sent = [] if sent is None else sent
+        body = json.dumps(body).encode() if body is not None else b''
+        messages = [{'type': 'http.request', 'body': body}]
+        async def receive():
+            if messages:
+                return messages.pop()
+            await (disconnect or asyncio.Event()).wait()
+            return {'type': 'http.disconnect'}
+        async def send(message):
+            sent.append(message)
+        path, _, query = path.partition('?')
+        scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query.encode(), 'root_path': '',
+                 'headers': [(b'authorization', b'123456'), (b'tree-id', b'test'), (b'content-type', b'application/json'),
+                             (b'content-length', str(len(body)).encode())]}
+        await app(scope, receive, send)
+        return sent
+
+    def response(self, sent):
+        return sent[0]['status'], b''.join(message.get('body', b'') for message in sent[1:])
+
+    def save_node(self, app, text):
+        node_id = uuid.uuid4().hex
+        data = {'id': node_id, 'parentId': None, 'text': text, 'author': 'Test author', 'timestamp': '2022-01-01 00:00:00'}
+        return node_id, self.call(app, 'POST', '/nodes', data)
+
+    # Make the Flask app take at least this long to start responding
+    def slow_start(self, seconds):
+        start_wsgi = self.asgi.start_wsgi
+        return mock.patch.object(self.asgi, 'start_wsgi', lambda environ: time.sleep(seconds) or start_wsgi(environ))
+
+    def test_timeout(self):
+        # Test that a request taking longer than REQUEST_TIMEOUT gets a 504
+        async def run():
+            app = self.asgi.ASGIApp(self.server.app)
+            with self.slow_start(0.3), mock.patch.object(self.asgi, 'REQUEST_TIMEOUT', 0.05):
+                status, body = self.response(await self.call(app, 'GET', '/nodes/count'))
+            await app.shutdown()
+            return status, json.loads(body)
+        self.assertEqual(asyncio.run(run()), (504, {'success': False, 'error': 'Request timed out'}))
+
+    def test_shutdown(self):
+        # Test that shutting down turns new requests away but waits for the ones in flight to finish
+        async def run():
+            app = self.asgi.ASGIApp(self.server.app)
+            finished = []
+            async def request():
+                sent = await self.call(app, 'GET', '/nodes/count')
+                finished.append('request')
+                return self.response(sent)
+            with self.slow_start(0.3):
+                in_flight = asyncio.ensure_future(request())
+                await asyncio.sleep(0.05)
+                shutdown = asyncio.ensure_future(app.shutdown())
+                await asyncio.sleep(0.05)
+                status, body = self.response(await self.call(app, 'GET', '/nodes/count'))
+                self.assertEqual((status, json.loads(body)['error']), (503, 'Server is shutting down'))
+                await shutdown
+                finished.append('shutdown')
+            status, body = await in_flight
+            self.assertEqual((status, json.loads(body)['success']), (200, True))
+            self.assertEqual(finished, ['request', 'shutdown'])
+        asyncio.run(run())
+
+    def test_streaming(self):
+        # Test that the event stream pushes changes as they are committed and ends when the client goes away, and that
+        # NDJSON bodies are sent in several parts, timed as part of their own request whichever thread reads them
+        async def run():
+            app = self.asgi.ASGIApp(self.server.app)
+            sent = []
+            disconnect = asyncio.Event()
+            events = asyncio.ensure_future(self.call(app, 'GET', '/events', sent=sent, disconnect=disconnect))
+            while len(sent) < 2:
+                await asyncio.sleep(0.01)
+            self.assertEqual(sent[0]['status'], 200)
+            self.assertEqual(sent[1]['body'], b'retry: 1000\n\n')
+            node_ids = []
+            for i in range(3):
+                node_id, saved = self.save_node(app, 'Streamed node %d' % i)
+                self.assertEqual(self.response(await saved), (200, b'{"success":true}\n'))
+                node_ids.append(node_id)
+            while len(sent) < 5:
+                await asyncio.sleep(0.01)
+            changes = [json.loads(message['body'].decode().split('data: ')[1]) for message in sent[2:]]
+            self.assertEqual([change['node_id'] for change in changes], node_ids)
+            disconnect.set()
+            await asyncio.wait_for(events, 5)
+
+            stray = {}
+            read_chunks = self.asgi.read_chunks
+            def read_elsewhere(chunks):
+                # as if the thread had last handled another request
+                self.asgi.metrics.request_state.phases = stray
+                try:
+                    return read_chunks(chunks)
+                finally:
+                    self.asgi.metrics.request_state.phases = None
+            with mock.patch.object(self.asgi, 'read_chunks', read_elsewhere), \
+                    mock.patch.object(self.asgi, 'RESPONSE_BUFFER_SIZE', 1), \
+                    mock.patch.object(self.server, 'STREAM_CHUNK_SIZE', 1):
+                sent = await self.call(app, 'GET', '/nodes?stream=ndjson')
+            status, body = self.response(sent)
+            lines = [json.loads(line) for line in body.decode().splitlines()]
+            self.assertEqual(status, 200)
+            self.assertGreater(len(sent), 3)
+            self.assertEqual([node['id'] for node in lines[:-1]], node_ids)
+            self.assertEqual(lines[-1], {'success': True, 'count': 3})
+            self.assertEqual(stray, {})
+            await app.shutdown()
+        asyncio.run(run())
+
+class TestCompaction(unittest.TestCase):
+
+    def test_compact(self):
+        # Test that compaction keeps the latest operation of every live node, and never passes the checkpoint
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree.db')
+            init_db(path)
+            conn = sqlite3.connect(path)
+            c = conn.cursor()
+            c.execute("INSERT INTO nodes VALUES ('a', NULL, '', 'A', 'x', 't')")
+            c.executemany("INSERT INTO history (id, timestamp, operation, author) VALUES (?, 't', ?, 'x')",
+                          [('a', 'create'), ('b', 'create'), ('a', 'update'), ('b', 'delete'), ('a', 'update'), ('c', 'create')])
+            conn.commit()
+            self.assertEqual(retention_horizon(c, keep_count=2), 5)
+            self.assertEqual(retention_horizon(c, keep_count=2, checkpoint_seq=3), 3)
+            self.assertEqual(compact_history(c, 5), 4)
+            conn.commit()
+            c.execute("SELECT seq FROM history ORDER BY seq")
+            self.assertEqual([row[0] for row in c.fetchall()], [5, 6])
+            self.assertEqual(compacted_horizon(c), 5)
+            conn.close()
+            stats = compact(path, keep_count=1, checkpoint_dir=os.path.join(directory, 'checkpoints'))
+            self.assertEqual(stats['checkpoint'], 6)
+            self.assertEqual([seq for seq, _ in list_checkpoints(os.path.join(directory, 'checkpoints'))], [6])
+
+class TestAdmin(unittest.TestCase):
+
+    def test_import_export_and_verify(self):
+        # Test that imports switch the tree to a new file that carries on its change numbering, and that a database
+        # survives an export and import intact
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree.db')
+            init_db(path)
+            conn = sqlite3.connect(path)
+            conn.executemany("INSERT INTO history (id, timestamp, operation, author) VALUES (?, 't', 'create', 'x')", [('a',), ('b',)])
+            conn.commit()
+            conn.close()
+            tree_json = os.path.join(directory, 'tree.json')
+            with open(tree_json, 'w') as f:
+                json.dump({'nodes': [{'id': 'a', 'text': 'A', 'author': 'x'}, {'id': 'b', 'parentId': 'a', 'text': 'B'}]}, f)
+            stats = import_database(path, tree_json)
+            self.assertEqual((stats['nodes'], stats['seq']), (2, 3))
+            self.assertEqual(os.readlink(path), 'tree.db.1')
+            self.assertEqual(verify(path), [])
+            conn = sqlite3.connect(path)
+            c = conn.cursor()
+            self.assertEqual(compacted_horizon(c), 4)
+            self.assertEqual(c.execute("SELECT id, children_ids, author FROM nodes ORDER BY id").fetchall(),
+                             [('a', 'b', 'x'), ('b', '', 'Morpheus')])
+            c.execute("UPDATE hashes SET subtree_hash = '' WHERE id = 'a'")
+            conn.commit()
+            conn.close()
+            self.assertEqual(len(verify(path)), 1)
+
+            exported = os.path.join(directory, 'export.json')
+            export_tree(path, exported)
+            stats = import_database(path, exported)
+            self.assertEqual((stats['nodes'], stats['seq']), (2, 4))
+            self.assertEqual(os.readlink(path), 'tree.db.2')
+            self.assertEqual(verify(path), [])
+            import_database(path, exported)
+            self.assertEqual(sorted(name for name in os.listdir(directory) if name.startswith('tree.db')),
+                             ['tree.db', 'tree.db.2', 'tree.db.3'])
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,103 @@
+import difflib
+
+# A delta is a list of ops applied to a text from its start, in the form the patch routes take:
+#   {"retain": n} keeps the next n characters, {"delete": n} removes them, and {"insert": "..."} inserts text
+# Whatever is left of the text after the last op is kept. Lengths count Unicode code points.
+
+# Define an exception for a delta that doesn't fit the text it is applied to
+class DeltaError(ValueError):
+    pass
+
+# Define a function to check that a delta is well-formed (it says nothing about which texts it fits)
+def check_delta(ops):
+    if not isinstance(ops, list):
+        raise DeltaError('Expected a list of ops')
+    for op in ops:
+        if not isinstance(op, dict) or len(op) != 1:
+            raise DeltaError('Expected each op to be {"retain": n}, {"delete": n} or {"insert": "..."}')
+        (kind, value), = op.items()
+        if kind in ('retain', 'delete'):
+            if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                raise DeltaError('Invalid %s length' % kind)
+        elif kind == 'insert':
+            if not isinstance(value, str):
+                raise DeltaError('Invalid insert text')
+        else:
+            raise DeltaError('Unknown op %s' % kind)
+
+# Define a function to apply a delta to a text
+def apply_delta(text, ops):
+    parts = []
+    position = 0
+    for op in ops:
+        (kind, value), = op.items()
+        if kind == 'insert':
+            parts.append(value)
+            continue
+        if position + value > len(text):
+            raise DeltaError('Delta is longer than the text')
+        if kind == 'retain':
+            parts.append(text[position:position + value])
+        position += value
+    parts.append(text[position:])
+    return ''.join(parts)
+
+# Define a function to get the delta that undoes a delta, given the text it was applied to
+def invert_delta(text, ops):
+    inverse = []
+    position = 0
+    for op in ops:
+        (kind, value), = op.items()
+        if kind == 'retain':
+            inverse.append({'retain': value})
+            position += value
+        elif kind == 'delete':
+            inverse.append({'insert': text[position:position + value]})
+            position += value
+        else:
+            inverse.append({'delete': len(value)})
+    return compact_delta(inverse)
+
+# Define a function to merge adjacent ops of the same kind and drop empty ones and a trailing retain
+def compact_delta(ops):
+    compacted = []
+    for op in ops:
+        (kind, value), = op.items()
+        if not value:
+            continue
+        if compacted and kind in compacted[-1]:
+            compacted[-1] = {kind: compacted[-1][kind] + value}
+        else:
+            compacted.append({kind: value})
+    if compacted and 'retain' in compacted[-1]:
+        compacted.pop()
+    return compacted
+
+# Define a function to get a delta turning one text into another
+# The texts are matched line by line, then the common start and end of each changed run of lines are kept, so an edit
+# of a few characters in a long text gives a delta of about that size (diffing character by character is too slow
+# for long texts).
+def diff_texts(old, new):
+    if old == new:
+        return []
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes():
+        old_part = ''.join(old_lines[i1:i2])
+        if tag == 'equal':
+            ops.append({'retain': len(old_part)})
+        else:
+            new_part = ''.join(new_lines[j1:j2])
+            prefix = common_prefix(old_part, new_part)
+            suffix = common_prefix(old_part[prefix:][::-1], new_part[prefix:][::-1])
+            ops += [{'retain': prefix}, {'delete': len(old_part) - prefix - suffix},
+                    {'insert': new_part[prefix:len(new_part) - suffix]}, {'retain': suffix}]
+    return compact_delta(ops)
+
+def common_prefix(a, b):
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
@@ -0,0 +1,163 @@
+import json
+import threading
+from collections import OrderedDict
+
+from schema import node_edges
+
+# Define a class holding the structure of a tree in memory (ids, roots, parent and child adjacency),
+# with a bounded LRU of node bodies. SQLite stays the source of truth: the index loads itself from the
+# database on first use, and the write routes update it as soon as they commit.
+class TreeIndex:
+    def __init__(self, cache_size):
+        self.lock = threading.RLock()
+        self.cache_size = cache_size
+        self.loaded = False
+        self.nodes = set()
+        # the ids of the nodes without parents, in insertion order
+        self.roots = {}
+        self.parents = {}
+        self.children = {}
+        self.bodies = OrderedDict()
+        # bumped whenever bodies are invalidated, so that a read racing a write can't cache a stale body
+        self.version = 0
+
+    def load(self, c):
+        with self.lock:
+            if self.loaded:
+                return
+            c.execute("SELECT id, parent_ids IS NULL FROM nodes ORDER BY rowid")
+            for node_id, is_root in c.fetchall():
+                self.nodes.add(node_id)
+                if is_root:
+                    self.roots[node_id] = None
+            c.execute("SELECT parent_id, child_id FROM edges")
+            self.add_edges(c.fetchall())
+            self.loaded = True
+
+    def add_edges(self, edges):
+        for parent_id, child_id in edges:
+            self.children.setdefault(parent_id, set()).add(child_id)
+            self.parents.setdefault(child_id, set()).add(parent_id)
+
+    def exists(self, node_id):
+        return node_id in self.nodes
+
+    def count(self):
+        return len(self.nodes)
+
+    def root_id(self):
+        with self.lock:
+            return next(iter(self.roots), None)
+
+    # Get the ids of the existing children (or parents) of a node, in the same order as the edges table
+    def child_ids(self, node_id):
+        with self.lock:
+            return sorted(child_id for child_id in self.children.get(node_id, ()) if child_id in self.nodes)
+
+    def parent_ids(self, node_id):
+        with self.lock:
+            return sorted(parent_id for parent_id in self.parents.get(node_id, ()) if parent_id in self.nodes)
+
+    # Get the rows of a list of nodes, from the LRU where possible and from the database otherwise
+    def get_rows(self, c, node_ids):
+        with self.lock:
+            rows = {}
+            for node_id in node_ids:
+                if node_id in self.bodies:
+                    self.bodies.move_to_end(node_id)
+                    rows[node_id] = self.bodies[node_id]
+            version = self.version
+        missing = [node_id for node_id in node_ids if node_id not in rows]
+        if missing:
+            c.execute("SELECT * FROM nodes WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(missing),))
+            fetched = c.fetchall()
+            with self.lock:
+                for row in fetched:
+                    rows[row[0]] = row
+                    if version == self.version:
+                        self.cache(row)
+        return [rows[node_id] for node_id in node_ids if node_id in rows]
+
+    def cache(self, row):
+        self.bodies[row[0]] = row
+        self.bodies.move_to_end(row[0])
+        while len(self.bodies) > self.cache_size:
+            self.bodies.popitem(last=False)
+
+    # Apply committed writes to the index (a no-op until it has been loaded)
+    def add(self, rows):
+        with self.lock:
+            if not self.loaded:
+                return
+            for row in rows:
+                self.nodes.add(row[0])
+                if row[1] is None:
+                    self.roots[row[0]] = None
+                self.add_edges(node_edges(row[0], row[1], row[2]))
+                self.cache(row)
+
+    def update(self, node_ids):
+        with self.lock:
+            self.version += 1
+            for node_id in node_ids:
+                self.bodies.pop(node_id, None)
+
+    def remove(self, node_ids):
+        with self.lock:
+            self.version += 1
+            for node_id in node_ids:
+                self.bodies.pop(node_id, None)
+                if not self.loaded:
+                    continue
+                self.nodes.discard(node_id)
+                self.roots.pop(node_id, None)
+                for parent_id in self.parents.pop(node_id, ()):
+                    self.children.get(parent_id, set()).discard(node_id)
+                for child_id in self.children.pop(node_id, ()):
+                    self.parents.get(child_id, set()).discard(node_id)
+
+    # Bring the index up to date with nodes written by another process, reading them (and every edge touching them)
+    # back from the database
+    def refresh(self, c, node_ids):
+        with self.lock:
+            self.version += 1
+            for node_id in node_ids:
+                self.bodies.pop(node_id, None)
+            if not self.loaded:
+                return
+            c.execute("SELECT * FROM nodes WHERE id IN (SELECT value FROM json_each(?))", (json.dumps(node_ids),))
+            rows = c.fetchall()
+            c.execute("""SELECT parent_id, child_id FROM edges WHERE parent_id IN (SELECT value FROM json_each(?1))
+                         UNION SELECT parent_id, child_id FROM edges WHERE child_id IN (SELECT value FROM json_each(?1))""",
+                      (json.dumps(node_ids),))
+            edges = c.fetchall()
+            for node_id in node_ids:
+                self.nodes.discard(node_id)
+                for parent_id in self.parents.pop(node_id, ()):
+                    self.children.get(parent_id, set()).discard(node_id)
+                for child_id in self.children.pop(node_id, ()):
+                    self.parents.get(child_id, set()).discard(node_id)
+            # roots keep their place, so that the first root stays the same
+            existing = {row[0] for row in rows}
+            for node_id in node_ids:
+                if node_id not in existing:
+                    self.roots.pop(node_id, None)
+            for row in rows:
+                self.nodes.add(row[0])
+                if row[1] is None:
+                    self.roots.setdefault(row[0], None)
+                else:
+                    self.roots.pop(row[0], None)
+                self.cache(row)
+            self.add_edges(edges)
+
+    # Forget everything, so that the index loads itself again on next use
+    def reset(self):
+        with self.lock:
+            self.version += 1
+            self.loaded = False
+            self.nodes = set()
+            self.roots = {}
+            self.parents = {}
+            self.children = {}
+            self.bodies = OrderedDict()
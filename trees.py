@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# Define a function to load the trees a server hosts from a JSON file mapping each tree id to its database and credentials:
+#   {"<tree id>": {"file": "<tree id>.db", "password": "<password>"}, ...}
+# ("password_hash", the SHA-256 of the password, can be given instead of "password"; relative paths are resolved
+# against the directory of the file). Every tree needs a password, since SERVER_PASSWORD doesn't apply to them.
+def load_tree_config(path):
+    with open(path) as f:
+        trees = json.load(f)
+    config = {}
+    for tree_id, settings in trees.items():
+        if 'file' not in settings:
+            raise ValueError('Tree %s has no database file' % tree_id)
+        password_hash = settings.get('password_hash')
+        if password_hash is None and settings.get('password') is not None:
+            password_hash = hashlib.sha256(settings['password'].encode()).hexdigest()
+        if password_hash is None:
+            raise ValueError('Tree %s has no password' % tree_id)
+        config[tree_id] = {
+            'file': os.path.join(os.path.dirname(os.path.abspath(path)), settings['file']),
+            'password_hash': password_hash
+        }
+    return config
+
+# Define a class keeping the most recently used trees open, up to a cap. Trees are opened on first use, and closed
+# once they fall off the end of the LRU, unless a request is still using them or they are otherwise busy.
+# Tree objects are made by open_tree(tree_id, settings), and need idle() and close() methods.
+class TreeRegistry:
+    def __init__(self, config, open_tree, max_open):
+        self.config = config
+        self.open_tree = open_tree
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.trees = OrderedDict()
+        # the number of requests using each open tree
+        self.users = {}
+        # a lock per tree being opened, so that a slow open only holds up requests for that tree
+        self.opening = {}
+        self.counters = {'opened': 0, 'closed': 0}
+
+    def password_hash(self, tree_id):
+        settings = self.config.get(tree_id)
+        return settings['password_hash'] if settings else None
+
+    # Get an open tree (opening it if needed) and mark it as in use until it is released, or None if it isn't hosted here
+    def acquire(self, tree_id):
+        settings = self.config.get(tree_id)
+        if settings is None:
+            return None
+        with self.lock:
+            tree = self.use(tree_id)
+            if tree is not None:
+                return tree
+            opening = self.opening.setdefault(tree_id, threading.Lock())
+        with opening:
+            with self.lock:
+                tree = self.use(tree_id)
+                if tree is not None:
+                    return tree
+            tree = self.open_tree(tree_id, settings)
+            with self.lock:
+                self.trees[tree_id] = tree
+                self.users[tree_id] = 1
+                self.opening.pop(tree_id, None)
+                self.counters['opened'] += 1
+                evicted = self.evict()
+        for old_tree in evicted:
+            old_tree.close()
+        return tree
+
+    # Like acquire, but only for a tree that is already open (None otherwise)
+    def acquire_open(self, tree_id):
+        with self.lock:
+            return self.use(tree_id)
+
+    def use(self, tree_id):
+        tree = self.trees.get(tree_id)
+        if tree is not None:
+            self.trees.move_to_end(tree_id)
+            self.users[tree_id] += 1
+        return tree
+
+    def release(self, tree_id):
+        with self.lock:
+            if tree_id in self.users:
+                self.users[tree_id] -= 1
+            evicted = self.evict()
+        for old_tree in evicted:
+            old_tree.close()
+
+    # Take the least recently used trees that nobody is using out of the registry until it is back under the cap
+    # (it stays over the cap while every tree is in use); the caller closes them outside of the lock
+    def evict(self):
+        evicted = []
+        for tree_id in list(self.trees):
+            if len(self.trees) <= self.max_open:
+                break
+            if self.users[tree_id] == 0 and self.trees[tree_id].idle():
+                evicted.append(self.trees.pop(tree_id))
+                del self.users[tree_id]
+                self.counters['closed'] += 1
+        return evicted
+
+    def open_trees(self):
+        with self.lock:
+            return list(self.trees.values())
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, hosted=len(self.config), open=len(self.trees), max_open=self.max_open,
+                        in_use={tree_id: users for tree_id, users in self.users.items() if users})
+
+    def close(self):
+        with self.lock:
+            trees = list(self.trees.values())
+            self.trees.clear()
+            self.users.clear()
+        for tree in trees:
+            tree.close()
@@ -0,0 +1,154 @@
+import contextlib
+import queue
+import threading
+import time
+
+# The post-commit actions of the writes in the group-commit batch being run on this thread, if any
+batch_state = threading.local()
+
+# Define a context manager that runs a set of writes in one explicit transaction, rolling back if any of them fails
+# It yields a list of actions to run once the writes are committed (such as updating in-memory caches). Inside a
+# group-commit batch the writes run in a savepoint instead, so that a failing write only undoes itself, and the
+# actions are deferred until the whole batch has been committed.
+@contextlib.contextmanager
+def transaction(db, c):
+    after_commit = []
+    batch = getattr(batch_state, 'after_commit', None)
+    if batch is None:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            yield after_commit
+        except BaseException:
+            db.rollback()
+            raise
+        db.commit()
+        for action in after_commit:
+            action()
+    else:
+        c.execute("SAVEPOINT write")
+        try:
+            yield after_commit
+        except BaseException:
+            c.execute("ROLLBACK TO write")
+            c.execute("RELEASE write")
+            raise
+        c.execute("RELEASE write")
+        batch.extend(after_commit)
+
+# Define a class for a write waiting in the group-commit queue
+class PendingWrite:
+    def __init__(self, fn):
+        self.fn = fn
+        self.queued = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+# Define a class that funnels writes through a single thread, committing everything that arrives within a short
+# window (up to a size cap) in one transaction. Callers block until the transaction holding their write is committed.
+# on_begin(c) is run at the start of every batch's transaction, and on_commit(c) once it has been committed.
+class GroupCommitWriter:
+    def __init__(self, pool, window, max_batch, on_commit=None, on_begin=None):
+        self.pool = pool
+        self.window = window
+        self.max_batch = max_batch
+        self.on_commit = on_commit
+        self.on_begin = on_begin
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.counters = {'batches': 0, 'writes': 0, 'failed_batches': 0, 'max_batch_size': 0,
+                         'queue_seconds': 0.0, 'max_queue_seconds': 0.0, 'commit_seconds': 0.0}
+        # number of batches by size, bucketed by powers of two
+        self.batch_sizes = {}
+        self.thread = threading.Thread(target=self.run, name='group-commit-writer', daemon=True)
+        self.thread.start()
+
+    # Queue a write (a function taking a connection and cursor) and wait for it to be committed
+    def submit(self, fn):
+        write = PendingWrite(fn)
+        self.queue.put(write)
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def run(self):
+        while True:
+            write = self.queue.get()
+            if write is None:
+                break
+            batch = [write]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    write = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if write is None:
+                    self.queue.put(None)
+                    break
+                batch.append(write)
+            self.commit(batch)
+
+    def commit(self, batch):
+        start = time.perf_counter()
+        after_commit = []
+        try:
+            with self.pool.write() as db:
+                c = db.cursor()
+                c.execute("BEGIN IMMEDIATE")
+                if self.on_begin is not None:
+                    self.on_begin(c)
+                batch_state.after_commit = after_commit
+                try:
+                    for write in batch:
+                        try:
+                            write.result = write.fn(db, c)
+                        except Exception as e:
+                            write.error = e
+                finally:
+                    batch_state.after_commit = None
+                db.commit()
+                for action in after_commit:
+                    action()
+                if self.on_commit is not None:
+                    self.on_commit(c)
+        except Exception as e:
+            # the commit itself failed, so none of the writes in the batch were applied
+            for write in batch:
+                if write.error is None:
+                    write.error = e
+            with self.lock:
+                self.counters['failed_batches'] += 1
+        finally:
+            self.record(batch, start)
+            for write in batch:
+                write.done.set()
+
+    def record(self, batch, start):
+        now = time.perf_counter()
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['writes'] += len(batch)
+            self.counters['max_batch_size'] = max(self.counters['max_batch_size'], len(batch))
+            self.counters['commit_seconds'] += now - start
+            for write in batch:
+                self.counters['queue_seconds'] += start - write.queued
+                self.counters['max_queue_seconds'] = max(self.counters['max_queue_seconds'], start - write.queued)
+            bucket = 1 << (len(batch) - 1).bit_length()
+            self.batch_sizes[bucket] = self.batch_sizes.get(bucket, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            batches = self.counters['batches'] or 1
+            writes = self.counters['writes'] or 1
+            return dict(self.counters, window=self.window, max_batch=self.max_batch, queued=self.queue.qsize(),
+                        mean_batch_size=self.counters['writes'] / batches,
+                        mean_queue_seconds=self.counters['queue_seconds'] / writes,
+                        batch_sizes={'<=%d' % bucket: count for bucket, count in sorted(self.batch_sizes.items())})
+
+    # Stop the writer thread once everything already queued has been committed
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()